@@ -0,0 +1,275 @@
+"""Sweep the interpolation strategies and their parameters over a set of scenes, measuring the runtime, peak
+memory and error of each against a reference depth, and report the Pareto frontier of the settings
+
+Run from the root of the repository with mdb_fwdet installed (python -m pip install ./mdb_fwdet):
+
+    python -m benchmarks.accuracy_sweep --sizes 1k --seeds 0 1 2
+    python -m benchmarks.accuracy_sweep --strategies tps kriging_local --references references.json
+
+references.json lists hydraulic model results to use as the reference depth as well as the synthetic truth:
+
+    [{"name": "narran_2012", "flood_extent_path": "...", "dem_path": "...", "channel_path": "...",
+      "depth_path": "...", "bounds": [left, bottom, right, top]}]
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+import pandas
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import from_bounds
+from shapely.geometry import box
+from xarray import DataArray
+
+from mdb_fwdet.delaunay_triangulation_interpolation_strategy import DelaunayTriangulationInterpolationStrategy
+from mdb_fwdet.euclidean_allocation_interpolation_strategy import EuclideanAllocationInterpolationStrategy
+from mdb_fwdet.fwdet_estimator import FwdetEstimator
+from mdb_fwdet.kriging_interpolation_strategy import KrigingInterpolationStrategy
+from mdb_fwdet.region import Region
+from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+from mdb_fwdet.stage_profiler import StageProfiler
+from mdb_fwdet.synthetic_scene import SyntheticScene
+from mdb_fwdet.tiled_tps_interpolation_strategy import TiledTpsInterpolationStrategy
+from mdb_fwdet.tps_interpolation_strategy import TpsInterpolationStrategy
+
+from hydrological_connectivity.processing.compare_flood_rasters_rasterio import CompareFloodRastersRasterIo
+
+from benchmarks.benchmark_suite import BenchmarkSuite
+
+
+def decode_depth(depth: DataArray) -> np.ndarray:
+    """Depth (metres, float32) of the wet pixels of the estimator's uint16 mm output - NaN for dry and nodata"""
+    values = np.asarray(depth)
+    return np.where((values == 0) | (values == np.iinfo(np.uint16).max), np.nan,
+                    values.astype(np.float32) / 1000)
+
+
+def error_statistics(difference: np.ndarray, reference: np.ndarray) -> dict:
+    """Statistics of difference (reference - estimate, NaN where either is missing) over the pixels with a
+    reference depth. Coverage is the fraction of those that were estimated"""
+    compared = ~np.isnan(difference)
+    reference_pixels = int(np.count_nonzero(~np.isnan(reference)))
+    if not compared.any():
+        return {'rmse': np.nan, 'mae': np.nan, 'bias': np.nan, 'p90_absolute_error': np.nan,
+                'compared_pixels': 0, 'coverage': 0.0}
+    errors = difference[compared].astype(np.float64)
+    return {'rmse': float(np.sqrt(np.mean(errors ** 2))), 'mae': float(np.mean(np.abs(errors))),
+            'bias': float(np.mean(errors)), 'p90_absolute_error': float(np.percentile(np.abs(errors), 90)),
+            'compared_pixels': int(errors.size),
+            'coverage': errors.size / reference_pixels if reference_pixels > 0 else 0.0}
+
+
+class SyntheticReference():
+    """A synthetic scene - the estimate is compared to the scene's true depth"""
+
+    def __init__(self, scene: SyntheticScene, name: str):
+        self.scene = scene
+        self.name = name
+
+    def spatial_inputs(self) -> SpatialFloodExtentInputs:
+        return self.scene.spatial_inputs()
+
+    def errors(self, depth: DataArray, directory: str) -> dict:
+        # the estimator can't see the water under cloud so it is compared on the observed wet pixels
+        truth = np.where(self.scene.generate()['mim'] == SpatialFloodExtentInputs.WOFS_WET_VALUE,
+                         self.scene.truth, np.nan)
+        return error_statistics(truth - decode_depth(depth), truth)
+
+
+class HydraulicModelReference():
+    """The inputs of a reach with a hydraulic model result - the estimate (on the DEM's grid) is written as a
+    raster and compared to the model's depth by CompareFloodRastersRasterIo"""
+
+    def __init__(self, name: str, flood_extent_path: str, dem_path: str, channel_path: str, depth_path: str,
+                 bounds: tuple = None):
+        self.name = name
+        self.flood_extent_path = flood_extent_path
+        self.dem_path = dem_path
+        self.channel_path = channel_path
+        """Channel depth raster (None for no channel correction)"""
+        self.depth_path = depth_path
+        """The hydraulic model's depth (metres) - the reference"""
+        if bounds is None:
+            with rasterio.open(dem_path) as src_dem:
+                bounds = tuple(src_dem.bounds)
+        self.region_of_interest_albers = box(*bounds)
+        """Region (EPSG:3577) compared"""
+
+    def from_dict(reference: dict):
+        return HydraulicModelReference(reference['name'], reference['flood_extent_path'], reference['dem_path'],
+                                       reference.get('channel_path'), reference['depth_path'],
+                                       reference.get('bounds'))
+
+    def spatial_inputs(self) -> SpatialFloodExtentInputs:
+        """The DEM in the region of interest, with the flood extent and channel warped to its grid (as the
+        hydrological tasks read them)"""
+        (left, bottom, right, top) = self.region_of_interest_albers.bounds
+        with rasterio.open(self.dem_path) as src_dem:
+            window = from_bounds(left, bottom, right, top, src_dem.transform)
+            self.transform = src_dem.window_transform(window)
+            dem = src_dem.read(1, masked=True, window=window).astype(np.float32).filled(np.nan)
+        (rows, cols) = dem.shape
+        mim = self.warp(self.flood_extent_path, dem.shape, Resampling.nearest, SpatialFloodExtentInputs.WOFS_NODATA_VALUE)
+        if self.channel_path is not None:
+            channel = self.warp(self.channel_path, dem.shape, Resampling.bilinear, np.nan).astype(np.float32)
+        else:
+            channel = np.full(dem.shape, np.nan, dtype=np.float32)
+        (x, _) = self.transform * (np.arange(cols) + 0.5, np.full(cols, 0.5))
+        (_, y) = self.transform * (np.full(rows, 0.5), np.arange(rows) + 0.5)
+        coords = {'y': y, 'x': x}
+        return SpatialFloodExtentInputs(*[DataArray(array, coords=coords, dims=['y', 'x'])
+                                          for array in (mim.astype(np.uint8), dem, channel)])
+
+    def warp(self, path: str, shape: tuple, resampling: Resampling, nodata) -> np.ndarray:
+        with rasterio.open(path) as source:
+            with WarpedVRT(source, crs='EPSG:3577', resampling=resampling, transform=self.transform,
+                           width=shape[1], height=shape[0]) as vrt:
+                return vrt.read(1, masked=True).filled(nodata)
+
+    def errors(self, depth: DataArray, directory: str) -> dict:
+        comparison_raster = os.path.join(directory, f'{self.name}_estimate.tif')
+        with rasterio.open(comparison_raster, 'w', driver='GTiff', dtype=rasterio.float32, count=1,
+                           crs='EPSG:3577', nodata=np.nan, transform=self.transform, width=depth.shape[1],
+                           height=depth.shape[0]) as dst:
+            dst.write(decode_depth(depth), indexes=1)
+        compare = CompareFloodRastersRasterIo(self.depth_path, comparison_raster, self.region_of_interest_albers,
+                                              os.path.join(directory, f'{self.name}_difference.tif'),
+                                              include_all_pixels_as_error=False)
+        compare.execute()
+        truth = np.ma.filled(compare.truth.astype(np.float32), np.nan)
+        truth[truth <= 0] = np.nan
+        return error_statistics(np.ma.filled(compare.depth_difference.astype(np.float32), np.nan), truth)
+
+
+class AccuracySweep():
+    """Run the estimator with each strategy and set of parameters on each reference and record the runtime (the
+    fastest of the repeats), the peak memory (traced on a separate run) and the error of each. pareto_frontier
+    picks the settings no other setting beats on every measure.
+
+    Usage:
+        sweep = AccuracySweep([SyntheticReference(SyntheticScene((1000, 1000), seed=seed), f'1k_{seed}')
+                               for seed in range(3)])
+        results = sweep.run()
+        print(AccuracySweep.pareto_frontier(AccuracySweep.summary(results)))
+    """
+
+    PARAMETER_GRIDS: Dict[str, tuple] = {
+        'delaunay': (DelaunayTriangulationInterpolationStrategy, {}),
+        'euclidean_allocation': (EuclideanAllocationInterpolationStrategy, {'smoothing': ['gaussian', 'mean', None]}),
+        'tps': (TpsInterpolationStrategy, {'averaging_constant': [15, 30, 60, 120], 'neighbors': [25, 50, 100, 200]}),
+        'tiled_tps': (TiledTpsInterpolationStrategy, {'averaging_constant': [15, 30, 60, 120],
+                                                      'max_points_per_tile': [500, 2000]}),
+        'kriging_local': (KrigingInterpolationStrategy, {'engine': ['local'], 'averaging_constant': [15, 30, 60, 120]}),
+        # cubic in the number of lumped perimeter points - only the coarser lattices
+        'kriging_exact': (KrigingInterpolationStrategy, {'averaging_constant': [60, 120]})}
+    """Strategy class and the values of each parameter to sweep (every combination is run)"""
+
+    OBJECTIVES = ('wall_seconds', 'peak_bytes', 'rmse')
+    """Measures (smaller is better) the Pareto frontier is taken over"""
+
+    def __init__(self, references: list, strategies: List[str] = None, repeats=2, working_directory: str = None):
+        self.references = references
+        """Scenes with a reference depth (SyntheticReference or HydraulicModelReference)"""
+        self.strategies = strategies if strategies is not None else list(AccuracySweep.PARAMETER_GRIDS)
+        self.repeats = repeats
+        """Timed runs of each setting on each reference (the fastest is recorded)"""
+        self.working_directory = working_directory
+        """Directory for the rasters compared to the hydraulic models (a temporary one by default)"""
+
+    def settings(self) -> list:
+        """(strategy name, parameters) of every setting swept"""
+        settings = []
+        for strategy in self.strategies:
+            (_, grid) = AccuracySweep.PARAMETER_GRIDS[strategy]
+            names = sorted(grid)
+            settings.extend((strategy, dict(zip(names, values)))
+                            for values in itertools.product(*[grid[name] for name in names]))
+        return settings
+
+    def run(self) -> pandas.DataFrame:
+        """A row per setting and reference"""
+        with tempfile.TemporaryDirectory(prefix='fwdet_sweep_') as temporary_directory:
+            directory = self.working_directory if self.working_directory is not None else temporary_directory
+            os.makedirs(directory, exist_ok=True)
+            records = []
+            for reference in self.references:
+                spatial_inputs = reference.spatial_inputs()
+                region = Region(0, (0, spatial_inputs.dem.shape[0], 0, spatial_inputs.dem.shape[1]))
+                for (strategy, parameters) in self.settings():
+                    record = dict(self.measure(strategy, parameters, spatial_inputs, region, reference, directory),
+                                  reference=reference.name, strategy=strategy,
+                                  parameters=json.dumps(parameters, sort_keys=True))
+                    logging.info(f"{reference.name} {strategy} {record['parameters']}: "
+                                 f"{record['wall_seconds']:.3f}s rmse {record['rmse']:.3f}m")
+                    records.append(record)
+        return pandas.DataFrame.from_records(records)
+
+    def measure(self, strategy: str, parameters: dict, spatial_inputs: SpatialFloodExtentInputs, region: Region,
+                reference, directory: str) -> dict:
+        (strategy_class, _) = AccuracySweep.PARAMETER_GRIDS[strategy]
+        estimator = FwdetEstimator(strategy_class(**parameters))
+        profiler = StageProfiler()
+        for repeat in range(self.repeats):
+            with profiler.span('estimate', repeat=repeat):
+                depth = estimator.calculate(spatial_inputs, region)
+        # tracing slows the run down so the memory is measured on a run that isn't timed
+        with StageProfiler(trace_memory=True).span('estimate') as traced:
+            estimator.calculate(spatial_inputs, region)
+        return dict(wall_seconds=min(span['wall_seconds'] for span in profiler.spans),
+                    cpu_seconds=min(span['process_cpu_seconds'] for span in profiler.spans),
+                    peak_bytes=traced['traced_peak_bytes'], **reference.errors(depth, directory))
+
+    def summary(results: pandas.DataFrame) -> pandas.DataFrame:
+        """Each setting across the references - total runtime, largest peak memory and mean errors"""
+        return results.groupby(['strategy', 'parameters'], sort=False).agg(
+            wall_seconds=('wall_seconds', 'sum'), peak_bytes=('peak_bytes', 'max'), rmse=('rmse', 'mean'),
+            mae=('mae', 'mean'), bias=('bias', 'mean'), p90_absolute_error=('p90_absolute_error', 'mean'),
+            coverage=('coverage', 'mean')).reset_index()
+
+    def pareto_frontier(summary: pandas.DataFrame, objectives=OBJECTIVES) -> pandas.DataFrame:
+        """The settings that no other setting matches or beats on every objective (and beats on one), most
+        accurate first"""
+        values = summary[list(objectives)].to_numpy(dtype=np.float64)
+        values = np.where(np.isnan(values), np.inf, values)
+        dominated = [bool(np.any(np.all(values <= row, axis=1) & np.any(values < row, axis=1))) for row in values]
+        return summary[~np.array(dominated, dtype=bool)].sort_values(list(objectives)[::-1])
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Sweep the interpolation strategies for accuracy and cost')
+    parser.add_argument('--sizes', nargs='+', default=['1k'], choices=list(BenchmarkSuite.SIZES))
+    parser.add_argument('--seeds', nargs='+', type=int, default=[0, 1, 2])
+    parser.add_argument('--strategies', nargs='+', default=None, choices=list(AccuracySweep.PARAMETER_GRIDS))
+    parser.add_argument('--references', default=None,
+                        help='JSON file listing hydraulic model results to compare to (see the module docstring)')
+    parser.add_argument('--repeats', type=int, default=2)
+    parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         'accuracy_sweep.csv'),
+                        help='CSV file of the result of every setting on every reference')
+    parser.add_argument('--working-directory', default=None)
+    arguments = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    references = [SyntheticReference(SyntheticScene(BenchmarkSuite.SIZES[size], seed=seed), f'{size}_seed{seed}')
+                  for size in arguments.sizes for seed in arguments.seeds]
+    if arguments.references is not None:
+        with open(arguments.references) as references_file:
+            references.extend(HydraulicModelReference.from_dict(reference) for reference in json.load(references_file))
+    results = AccuracySweep(references, arguments.strategies, arguments.repeats, arguments.working_directory).run()
+    results['commit'] = BenchmarkSuite.commit()
+    results.to_csv(arguments.output, index=False)
+    with pandas.option_context('display.width', 200, 'display.max_colwidth', 80):
+        print(AccuracySweep.pareto_frontier(AccuracySweep.summary(results)).to_string(index=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
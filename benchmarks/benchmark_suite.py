@@ -0,0 +1,334 @@
+"""Time the flood depth methods on synthetic scenes and record the results per commit
+
+Run from the root of the repository with mdb_fwdet installed (python -m pip install ./mdb_fwdet):
+
+    python -m benchmarks.benchmark_suite --sizes 1k 5k
+    python -m benchmarks.benchmark_suite --sizes 1k --cases strategy_tps estimator --repeats 5
+    python -m benchmarks.benchmark_suite --report
+
+Nothing is read from or written to s3 - the scenes are generated (see SyntheticScene) and the rasters of the
+hydrological tasks are written to a local working directory.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from typing import Dict, List
+
+import numpy as np
+import pandas
+from shapely.geometry import box
+
+from mdb_fwdet.delaunay_triangulation_interpolation_strategy import DelaunayTriangulationInterpolationStrategy
+from mdb_fwdet.euclidean_allocation_interpolation_strategy import EuclideanAllocationInterpolationStrategy
+from mdb_fwdet.flood_depth_engine import FloodDepthEngine
+from mdb_fwdet.fwdet_estimator import FwdetEstimator
+from mdb_fwdet.kriging_interpolation_strategy import KrigingInterpolationStrategy
+from mdb_fwdet.perimeter_points import PerimeterPoints
+from mdb_fwdet.region import Region
+from mdb_fwdet.region_definition import RegionDefinition
+from mdb_fwdet.stage_profiler import StageProfiler
+from mdb_fwdet.synthetic_scene import SyntheticScene
+from mdb_fwdet.tiled_tps_interpolation_strategy import TiledTpsInterpolationStrategy
+from mdb_fwdet.tps_interpolation_strategy import TpsInterpolationStrategy
+
+from hydrological_connectivity.datatypes.fwdet_outputs import FwdetOutputs
+from hydrological_connectivity.datatypes.hydraulic_model import HydraulicModel
+from hydrological_connectivity.datatypes.simple_outputs import SimpleOutputs
+from hydrological_connectivity.datatypes.tvd_outputs import TvdOutputs
+from hydrological_connectivity.processing.fwdet_task import FwdetTask
+from hydrological_connectivity.processing.simple_task import SimpleTask
+from hydrological_connectivity.processing.tvd_task import TvdTask
+
+
+def largest_region_shape() -> tuple:
+    """(rows, columns) of the bounding box of the largest MDB region"""
+    return max(((row1 - row0, col1 - col0) for (row0, row1, col0, col1) in RegionDefinition.MDB_REGIONS.values()),
+               key=lambda shape: shape[0] * shape[1])
+
+
+class BenchmarkSuite():
+    """Time each case (an interpolation strategy, the estimator, the engine or a hydrological task) on synthetic
+    scenes of each size. Every result is appended as a JSON line to results_path with the commit it was run at,
+    and is flagged as a regression when it is slower than the last result of the same case, size and host at
+    another commit by more than the threshold.
+
+    Usage:
+        suite = BenchmarkSuite('benchmarks/results.jsonl', sizes=('1k', '5k'))
+        records = suite.run()
+        BenchmarkSuite.regressions(records)
+    """
+
+    SIZES: Dict[str, tuple] = {'1k': (1000, 1000), '5k': (5000, 5000), '15k': (15000, 15000),
+                               'region': largest_region_shape()}
+
+    def __init__(self, results_path: str, sizes=('1k',), cases: List[str] = None, repeats=3,
+                 regression_threshold=0.2, noise_seconds=0.05, working_directory: str = None, workers=2, seed=0):
+        self.results_path = results_path
+        """JSON lines file the results are appended to"""
+        self.sizes = sizes
+        """Names of the scene sizes (keys of SIZES) to run"""
+        self.cases = cases if cases is not None else list(self.case_functions())
+        """Names of the cases to run (all of them by default)"""
+        self.repeats = repeats
+        """Times each case is run - the fastest is recorded (the others are noise from the machine)"""
+        self.regression_threshold = regression_threshold
+        """Fractional slowdown against the previous commit that is flagged as a regression"""
+        self.noise_seconds = noise_seconds
+        """Slowdowns shorter than this are never flagged (timer and scheduling noise of the quick cases)"""
+        self.working_directory = working_directory
+        """Local directory for the rasters and outputs of the hydrological tasks (a temporary one by default)"""
+        self.workers = workers
+        """Worker processes of the LocalCluster of the engine_cluster case"""
+        self.seed = seed
+        """Seed of the synthetic scenes"""
+
+    def case_functions(self) -> dict:
+        """Name of each case -> (function building the case's timed callable, largest scene in pixels or None).
+        Building the callable (e.g. extracting perimeter points or writing rasters) isn't timed"""
+        return {'strategy_delaunay': (self.strategy_case(DelaunayTriangulationInterpolationStrategy), None),
+                'strategy_euclidean_allocation': (self.strategy_case(EuclideanAllocationInterpolationStrategy), None),
+                'strategy_tps': (self.strategy_case(TpsInterpolationStrategy), None),
+                'strategy_tiled_tps': (self.strategy_case(TiledTpsInterpolationStrategy), None),
+                'strategy_kriging_local': (self.strategy_case(KrigingInterpolationStrategy, engine='local'), None),
+                # cubic in the number of lumped perimeter points
+                'strategy_kriging_exact': (self.strategy_case(KrigingInterpolationStrategy), 1000 * 1000),
+                'estimator': (self.estimator_case(chunked=False), None),
+                'estimator_chunked': (self.estimator_case(chunked=True), None),
+                'engine_serial': (self.engine_serial_case, None),
+                'engine_cluster': (self.engine_cluster_case, None),
+                'simple_task': (self.task_case('simple'), None),
+                'simple_task_streaming': (self.task_case('simple', streaming=True), None),
+                'tvd_task': (self.task_case('tvd'), None),
+                'tvd_task_streaming': (self.task_case('tvd', streaming=True), None),
+                'fwdet_task': (self.task_case('fwdet'), None),
+                'fwdet_task_streaming': (self.task_case('fwdet', streaming=True), None)}
+
+    def strategy_case(self, strategy_class, **strategy_options):
+        def build(scene: SyntheticScene, directory: str, stack: ExitStack):
+            arrays = scene.generate()
+            perimeter_points = PerimeterPoints.from_flood_extent(arrays['mim'], arrays['dem'])
+            strategy = strategy_class(**strategy_options)
+            return lambda: strategy.interpolate(perimeter_points)
+        return build
+
+    def estimator_case(self, chunked: bool):
+        def build(scene: SyntheticScene, directory: str, stack: ExitStack):
+            spatial_inputs = scene.spatial_inputs()
+            estimator = FwdetEstimator(DelaunayTriangulationInterpolationStrategy(), chunked=chunked)
+            region = Region(0, (0, scene.shape[0], 0, scene.shape[1]))
+            return lambda: estimator.calculate(spatial_inputs, region)
+        return build
+
+    def region_definition(self, scene: SyntheticScene) -> RegionDefinition:
+        """Regions of roughly 4000 pixels square (at least 2 x 2)"""
+        regions = scene.regions(per_side=max(2, math.ceil(max(scene.shape) / 4000)))
+        return RegionDefinition(regions, scene.region_grid(regions))
+
+    def engine_serial_case(self, scene: SyntheticScene, directory: str, stack: ExitStack):
+        engine = FloodDepthEngine(scene.spatial_inputs(), self.region_definition(scene),
+                                  FwdetEstimator(DelaunayTriangulationInterpolationStrategy()))
+        return lambda: engine.merge_results_into_one_raster(engine.calculate())
+
+    def engine_cluster_case(self, scene: SyntheticScene, directory: str, stack: ExitStack):
+        from dask.distributed import Client, LocalCluster
+        cluster = stack.enter_context(LocalCluster(n_workers=self.workers, threads_per_worker=1,
+                                                   dashboard_address=None))
+        client = stack.enter_context(Client(cluster))
+        region_definition = self.region_definition(scene)
+        spatial_inputs = scene.spatial_inputs()
+        engine = FloodDepthEngine(spatial_inputs, region_definition,
+                                  FwdetEstimator(DelaunayTriangulationInterpolationStrategy()))
+
+        def run():
+            depth_by_region = engine.calculate_dask(client)
+            return engine.merge_results_into_one_raster_dask(client, depth_by_region).result()
+        return run
+
+    def task_case(self, method: str, streaming=False):
+        def build(scene: SyntheticScene, directory: str, stack: ExitStack):
+            paths = self.scene_rasters(scene, directory)
+            output_path = os.path.join(directory, f"{method}{'_streaming' if streaming else ''}.tif")
+            hydraulic_model = HydraulicModel('synthetic', None, {}, {})
+            simulation_timespan = {'start': None, 'end': None}
+            region_of_interest = box(*scene.bounds())
+            if method == 'simple':
+                task = SimpleTask(SimpleOutputs('synthetic', None, paths['mim'], paths['dem'], hydraulic_model,
+                                                simulation_timespan, region_of_interest, None, 0, output_path),
+                                  streaming)
+            elif method == 'tvd':
+                task = TvdTask(TvdOutputs('synthetic', paths['mim'], paths['dem'], hydraulic_model,
+                                          simulation_timespan, scene.thalweg_coordinates(), region_of_interest,
+                                          None, 0, output_path), streaming)
+            else:
+                task = FwdetTask(FwdetOutputs('synthetic', paths['mim'], paths['dem'], paths['channel'],
+                                              hydraulic_model, simulation_timespan, region_of_interest, None, 0,
+                                              output_path), streaming)
+            return task.execute
+        return build
+
+    def scene_rasters(self, scene: SyntheticScene, directory: str) -> Dict[str, str]:
+        """The scene's rasters in the size's directory (written the first time they are needed)"""
+        paths = {name: os.path.join(directory, f'{name}.tif') for name in ('dem', 'mim', 'channel', 'truth')}
+        if not all(os.path.exists(path) for path in paths.values()):
+            paths = scene.write_rasters(directory)
+        return paths
+
+    def run(self) -> List[dict]:
+        """Run the cases at each size, append the results to results_path and return them"""
+        with ExitStack() as stack:
+            working_directory = self.working_directory
+            if working_directory is None:
+                working_directory = stack.enter_context(tempfile.TemporaryDirectory(prefix='fwdet_benchmark_'))
+            run_context = BenchmarkSuite.run_context()
+            history = BenchmarkSuite.load(self.results_path)
+            case_functions = self.case_functions()
+            records = []
+            for size in self.sizes:
+                shape = BenchmarkSuite.SIZES[size]
+                scene = SyntheticScene(shape, seed=self.seed)
+                directory = os.path.join(working_directory, size)
+                os.makedirs(directory, exist_ok=True)
+                for case in self.cases:
+                    (build, max_pixels) = case_functions[case]
+                    if max_pixels is not None and shape[0] * shape[1] > max_pixels:
+                        logging.info(f"Skipping {case} at {size} (more than {max_pixels} pixels)")
+                        continue
+                    record = dict(run_context, case=case, size=size, shape=list(shape),
+                                  **self.time_case(build, scene, directory))
+                    record.update(BenchmarkSuite.compare(record, history, self.regression_threshold,
+                                                         self.noise_seconds))
+                    logging.info(BenchmarkSuite.describe(record))
+                    self.append(record)
+                    records.append(record)
+        return records
+
+    def time_case(self, build, scene: SyntheticScene, directory: str) -> dict:
+        """The fastest of the repeated runs (with the median and the CPU time and memory of the fastest)"""
+        profiler = StageProfiler()
+        with ExitStack() as stack:
+            run = build(scene, directory, stack)
+            for repeat in range(self.repeats):
+                with profiler.span('case', repeat=repeat):
+                    run()
+        spans = pandas.DataFrame.from_records(profiler.spans)
+        fastest = spans.loc[spans['wall_seconds'].idxmin()]
+        return {'repeats': self.repeats, 'wall_seconds': float(fastest['wall_seconds']),
+                'median_wall_seconds': float(spans['wall_seconds'].median()),
+                'cpu_seconds': float(fastest['process_cpu_seconds']),
+                'max_rss_change_bytes': int(spans['rss_change_bytes'].max()),
+                'peak_rss_bytes': int(spans['peak_rss_bytes'].max())}
+
+    def run_context() -> dict:
+        """Where and at what commit the benchmarks are run"""
+        return {'commit': BenchmarkSuite.commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': socket.gethostname(), 'python': platform.python_version(), 'numpy': np.__version__,
+                'cpu_count': os.cpu_count()}
+
+    def commit() -> str:
+        """Abbreviated hash of HEAD ('-dirty' if there are uncommitted changes), None outside a git repository"""
+        try:
+            return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                                  check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def load(results_path: str) -> pandas.DataFrame:
+        """Every result recorded in results_path"""
+        if not os.path.exists(results_path):
+            return pandas.DataFrame()
+        with open(results_path) as results_file:
+            return pandas.DataFrame.from_records([json.loads(line) for line in results_file if line.strip()])
+
+    def append(self, record: dict):
+        directory = os.path.dirname(os.path.abspath(self.results_path))
+        os.makedirs(directory, exist_ok=True)
+        with open(self.results_path, 'a') as results_file:
+            results_file.write(json.dumps(record) + '\n')
+
+    def compare(record: dict, history: pandas.DataFrame, regression_threshold=0.2, noise_seconds=0.05) -> dict:
+        """The latest result of the same case, size and host at another commit (the baseline) and whether the
+        record is a regression against it"""
+        comparison = {'baseline_commit': None, 'baseline_wall_seconds': None, 'change': None, 'regression': False}
+        if len(history) == 0:
+            return comparison
+        previous = history[(history['case'] == record['case']) & (history['size'] == record['size']) &
+                           (history['host'] == record['host']) & (history['commit'] != record['commit'])]
+        if len(previous) == 0:
+            return comparison
+        baseline = previous.iloc[-1]
+        change = record['wall_seconds'] / baseline['wall_seconds'] - 1
+        comparison.update(baseline_commit=baseline['commit'],
+                          baseline_wall_seconds=float(baseline['wall_seconds']), change=change,
+                          regression=bool(change > regression_threshold and
+                                          record['wall_seconds'] - baseline['wall_seconds'] > noise_seconds))
+        return comparison
+
+    def regressions(records) -> pandas.DataFrame:
+        """The results (a DataFrame or list of records) flagged as regressions"""
+        records = pandas.DataFrame.from_records(records) if not isinstance(records, pandas.DataFrame) else records
+        if len(records) == 0:
+            return records
+        return records[records['regression'].astype(bool)]
+
+    def report(results: pandas.DataFrame) -> pandas.DataFrame:
+        """The fastest time of each case and size (rows) at each commit (columns), in the order they were run"""
+        if len(results) == 0:
+            return results
+        commits = list(dict.fromkeys(results['commit']))
+        return results.pivot_table(index=['case', 'size'], columns='commit', values='wall_seconds',
+                                   aggfunc='min')[commits]
+
+    def describe(record: dict) -> str:
+        description = f"{record['case']} {record['size']}: {record['wall_seconds']:.3f}s"
+        if record['baseline_commit'] is not None:
+            description += f" ({record['change']:+.0%} on {record['baseline_commit']})"
+        if record['regression']:
+            description += " REGRESSION"
+        return description
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Benchmark the flood depth methods on synthetic scenes')
+    parser.add_argument('--results', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'results.jsonl'),
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--sizes', nargs='+', default=['1k'], choices=list(BenchmarkSuite.SIZES))
+    parser.add_argument('--cases', nargs='+', default=None, help='Cases to run (all by default)')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Fractional slowdown flagged as a regression')
+    parser.add_argument('--working-directory', default=None,
+                        help='Directory for the rasters of the hydrological tasks (temporary by default)')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes of the LocalCluster')
+    parser.add_argument('--report', action='store_true', help='Print the recorded results by commit and exit')
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help='Exit with status 1 if any result is a regression')
+    arguments = parser.parse_args(arguments)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    if arguments.report:
+        print(BenchmarkSuite.report(BenchmarkSuite.load(arguments.results)).to_string())
+        return 0
+    suite = BenchmarkSuite(arguments.results, arguments.sizes, arguments.cases, arguments.repeats,
+                           arguments.threshold, working_directory=arguments.working_directory,
+                           workers=arguments.workers)
+    unknown = set(suite.cases) - set(suite.case_functions())
+    if unknown:
+        parser.error(f"Unknown cases {sorted(unknown)} - choose from {list(suite.case_functions())}")
+    regressions = BenchmarkSuite.regressions(suite.run())
+    for record in regressions.to_dict('records'):
+        logging.warning(BenchmarkSuite.describe(record))
+    return 1 if arguments.fail_on_regression and len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from hydrological_connectivity.definitions.definitions_generator import DefinitionsGenerator
+from hydrological_connectivity.definitions.model_definitions import DepthModelType, ModelDefinitions
+
+
+class BatchTaskRunner():
+    """Run the tasks for the outputs of a DefinitionsGenerator across a pool of processes.
+
+    Every task is recorded in a JSON lines ledger (started/done/failed with timings) so a crashed or
+    interrupted run resumes where it stopped. Tasks the ledger records as done are skipped (their outputs may
+    have been moved elsewhere since), as are tasks not in the ledger whose outputs already exist. The outputs
+    of a task the ledger records as started or failed may be partial so it is run again.
+
+    Usage:
+        definition = DefinitionsGeneratorFactory.get_generator()
+        definition.generate()
+        BatchTaskRunner('ledger.jsonl', max_workers=8).run(definition)
+    """
+
+    def __init__(self, ledger_path, max_workers=None, model_types=None, accumulation_thresholds=None,
+                 streaming=False, retry_failed=True):
+        self.ledger_path = ledger_path
+        """JSON lines file recording the state of every task"""
+        self.max_workers = max_workers
+        """Number of processes (None is the number of processors)"""
+        self.model_types = model_types if model_types is not None else [
+            DepthModelType.Simple, DepthModelType.TVD, DepthModelType.FwDET, DepthModelType.HAND]
+        """Which of the models to run"""
+        self.accumulation_thresholds = accumulation_thresholds if accumulation_thresholds is not None else \
+            ModelDefinitions.get_model_types()[DepthModelType.HAND]['accumulation_threshold']
+        """HAND is run once for each accumulation threshold"""
+        self.streaming = streaming
+        """Run the simple, TVD and FwDET tasks in their streaming (block window) mode"""
+        self.retry_failed = retry_failed
+        """Re-run tasks that failed in a previous run (otherwise they are skipped)"""
+        self.task_function = BatchTaskRunner.run_task
+        """Runs a single task in a worker process - task_function(model_type, outputs, accumulation_threshold,
+        streaming) returns the elapsed seconds (a module level function, so it can be sent to the processes)"""
+
+    def jobs(self, definition: DefinitionsGenerator):
+        """(model type, outputs, accumulation threshold) of every task of the definition"""
+        jobs = []
+        if DepthModelType.Simple in self.model_types:
+            jobs.extend([(DepthModelType.Simple, outputs, None)
+                        for outputs in definition.simple_outputs])
+        if DepthModelType.TVD in self.model_types:
+            jobs.extend([(DepthModelType.TVD, outputs, None)
+                        for outputs in definition.tvd_outputs])
+        if DepthModelType.FwDET in self.model_types:
+            jobs.extend([(DepthModelType.FwDET, outputs, None)
+                        for outputs in definition.fwdet_outputs])
+        if DepthModelType.HAND in self.model_types:
+            jobs.extend([(DepthModelType.HAND, outputs, accumulation_threshold)
+                         for outputs in definition.hand_outputs
+                         for accumulation_threshold in self.accumulation_thresholds])
+        return jobs
+
+    def job_key(model_type, outputs, accumulation_threshold=None):
+        key = f"{model_type.name}:{outputs.output_path}"
+        if accumulation_threshold is not None:
+            key += f":{accumulation_threshold}"
+        return key
+
+    def output_exists(model_type, outputs, accumulation_threshold=None):
+        """Whether all of the files a task writes are already there"""
+        if model_type == DepthModelType.HAND:
+            return all(outputs.exists(accumulation_threshold, ext) for ext in ['hand', 'str', 'dep'])
+        if model_type == DepthModelType.FwDET:
+            return outputs.exists(None)
+        return outputs.exists('all') and outputs.exists('ind')
+
+    def read_ledger(self):
+        """The latest record of each task in the ledger"""
+        records = {}
+        if not os.path.isfile(self.ledger_path):
+            return records
+        with open(self.ledger_path) as ledger:
+            for line in ledger:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a partial line left by a crash
+                    continue
+                records[record['key']] = record
+        return records
+
+    def end_partial_line(self):
+        """End a partial line left in the ledger by a crash, so the records appended next can be read"""
+        if not os.path.isfile(self.ledger_path) or os.path.getsize(self.ledger_path) == 0:
+            return
+        with open(self.ledger_path, 'rb+') as ledger:
+            ledger.seek(-1, os.SEEK_END)
+            if ledger.read(1) != b'\n':
+                ledger.write(b'\n')
+
+    def write_ledger(self, ledger, record):
+        ledger.write(json.dumps(record) + '\n')
+        ledger.flush()
+        os.fsync(ledger.fileno())
+
+    def run_task(model_type, outputs, accumulation_threshold=None, streaming=False):
+        """Run a single task (in a worker process). Returns the elapsed time in seconds"""
+        start_time = time.time()
+        if model_type == DepthModelType.Simple:
+            from hydrological_connectivity.processing.simple_task import SimpleTask
+            SimpleTask(outputs, streaming=streaming).execute()
+        elif model_type == DepthModelType.TVD:
+            from hydrological_connectivity.processing.tvd_task import TvdTask
+            TvdTask(outputs, streaming=streaming).execute()
+        elif model_type == DepthModelType.FwDET:
+            from hydrological_connectivity.processing.fwdet_task import FwdetTask
+            FwdetTask(outputs, streaming=streaming).execute()
+        elif model_type == DepthModelType.HAND:
+            # pysheds is only needed for HAND
+            from hydrological_connectivity.processing.hand_task import HandTask
+            hand_task = HandTask(outputs)
+            hand_task.accumulation_threshold = accumulation_threshold
+            hand_task.execute()
+        return time.time() - start_time
+
+    def pending(self, definition: DefinitionsGenerator):
+        """The jobs still to run - not in the ledger as done (or failed), or not in the ledger and without outputs
+        on disk. A task started but not finished is run again (over the outputs it left)"""
+        records = self.read_ledger()
+        pending = []
+        for (model_type, outputs, accumulation_threshold) in self.jobs(definition):
+            key = BatchTaskRunner.job_key(
+                model_type, outputs, accumulation_threshold)
+            status = records[key]['status'] if key in records else None
+            if status == 'done':
+                logging.info(f"Already done: {key}")
+                continue
+            if status == 'failed' and not self.retry_failed:
+                logging.info(f"Previously failed, skipping: {key}")
+                continue
+            if status is None and BatchTaskRunner.output_exists(model_type, outputs, accumulation_threshold):
+                logging.info(f"Already exists: {key}")
+                continue
+            if status == 'started':
+                # a crash while writing can leave the outputs there but partial
+                logging.info(f"Resuming interrupted task: {key}")
+            pending.append((key, model_type, outputs, accumulation_threshold))
+        return pending
+
+    def run(self, definition: DefinitionsGenerator):
+        """Run every pending task of the definition. Returns the ledger records of this run"""
+        pending = self.pending(definition)
+        logging.info(f"{len(pending)} tasks to run")
+        records = []
+        start_time = time.time()
+        self.end_partial_line()
+        with open(self.ledger_path, 'a') as ledger, ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            for (key, model_type, outputs, accumulation_threshold) in pending:
+                self.write_ledger(ledger, {'key': key, 'model': model_type.name, 'output_path': outputs.output_path,
+                                           'status': 'started', 'time': time.time()})
+                futures[executor.submit(self.task_function, model_type, outputs,
+                                        accumulation_threshold, self.streaming)] = (key, model_type, outputs)
+
+            for future in as_completed(futures):
+                (key, model_type, outputs) = futures[future]
+                record = {'key': key, 'model': model_type.name,
+                          'output_path': outputs.output_path, 'time': time.time()}
+                try:
+                    record['seconds'] = future.result()
+                    record['status'] = 'done'
+                    logging.info(
+                        f"Completed {key} in {record['seconds']:.1f} seconds")
+                except Exception as e:
+                    record['status'] = 'failed'
+                    record['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+                    logging.exception(f"Failed {key}")
+                self.write_ledger(ledger, record)
+                records.append(record)
+
+        BatchTaskRunner.log_summary(records, time.time() - start_time)
+        return records
+
+    def log_summary(records, elapsed):
+        """Log the number of tasks and time taken by each model"""
+        for model in sorted({record['model'] for record in records}):
+            done = [record['seconds'] for record in records
+                    if record['model'] == model and record['status'] == 'done']
+            failed = len([record for record in records
+                          if record['model'] == model and record['status'] == 'failed'])
+            if len(done) > 0:
+                logging.info(f"{model}: {len(done)} done (total {sum(done):.1f}s, mean {sum(done)/len(done):.1f}s, "
+                             f"max {max(done):.1f}s), {failed} failed")
+            else:
+                logging.info(f"{model}: 0 done, {failed} failed")
+        logging.info(f"Batch took {elapsed:.1f} seconds")
@@ -0,0 +1,287 @@
+import logging
+import math
+import os
+import numpy
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
+
+from hydrological_connectivity.processing.label_statistics import LabelStatistics
+
+
+class BlockStreamer():
+    """Read a zone of the DEM (and the flood extent/channel warped onto it) a window at a time. Windows are
+    aligned with the native blocks of the DEM (several blocks are combined until a window is at least
+    min_window_size pixels high and wide) so each read decodes whole COG tiles.
+
+    The zone is snapped to whole DEM pixels, so every window lines up with the DEM and the output grid.
+
+    Usage:
+        with BlockStreamer(dem_path, flood_extent_path, region_of_interest_albers) as streamer:
+            for (block_index, window) in streamer.windows():
+                dem = streamer.read_dem(window)
+    """
+
+    def __init__(self, dem_path, flood_extent_path, region_of_interest_albers, channel_path=None, min_window_size=512):
+        self.dem_path = dem_path
+        self.flood_extent_path = flood_extent_path
+        self.channel_path = channel_path
+        self.region_of_interest_albers = region_of_interest_albers
+        self.min_window_size = min_window_size
+        """Windows combine native DEM blocks until they are at least this many pixels high and wide"""
+
+    def __enter__(self):
+        left, bottom, right, top = self.region_of_interest_albers.bounds
+        self.src_dem = rasterio.open(self.dem_path)
+        self.zone_window = from_bounds(
+            left, bottom, right, top, self.src_dem.transform).round_offsets().round_lengths()
+        """Window of the zone within the DEM (whole pixels)"""
+        logging.info(f'{self.zone_window}')
+        self.transform = self.src_dem.window_transform(self.zone_window)
+        self.crs = self.src_dem.crs
+        self.shape = (self.zone_window.height, self.zone_window.width)
+
+        self.src_flood_extent = rasterio.open(self.flood_extent_path)
+        self.flood_extent_vrt = WarpedVRT(self.src_flood_extent, crs='EPSG:3577', resampling=Resampling.nearest,
+                                          transform=self.transform, width=self.shape[1], height=self.shape[0])
+        if self.channel_path is not None:
+            self.src_channel = rasterio.open(self.channel_path)
+            self.channel_vrt = WarpedVRT(self.src_channel, crs='EPSG:3577', resampling=Resampling.bilinear,
+                                         transform=self.transform, width=self.shape[1], height=self.shape[0])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.channel_path is not None:
+            self.channel_vrt.close()
+            self.src_channel.close()
+        self.flood_extent_vrt.close()
+        self.src_flood_extent.close()
+        self.src_dem.close()
+
+    def window_edges(self, offset, length, block_length):
+        """Edges (relative to the zone) of the windows along one axis, on the native block boundaries"""
+        step = block_length * max(math.ceil(self.min_window_size / block_length), 1)
+        first = (offset // block_length) * block_length
+        edges = [edge - offset for edge in range(first + step, offset + length, step)]
+        return [0] + edges + [length]
+
+    def block_grid(self):
+        """Row and column edges of the grid of windows"""
+        (block_height, block_width) = self.src_dem.block_shapes[0]
+        row_edges = self.window_edges(
+            self.zone_window.row_off, self.zone_window.height, block_height)
+        col_edges = self.window_edges(
+            self.zone_window.col_off, self.zone_window.width, block_width)
+        return (row_edges, col_edges)
+
+    def windows(self):
+        """(block row, block column) and Window (relative to the zone) of every window in the zone"""
+        (row_edges, col_edges) = self.block_grid()
+        for block_row in range(len(row_edges) - 1):
+            for block_col in range(len(col_edges) - 1):
+                yield ((block_row, block_col),
+                       Window(col_edges[block_col], row_edges[block_row],
+                              col_edges[block_col + 1] - col_edges[block_col],
+                              row_edges[block_row + 1] - row_edges[block_row]))
+
+    def with_halo(self, window: Window, halo: int):
+        """Grow a window by halo pixels (clipped to the zone). Returns the grown window and the slices
+        of the original window within it"""
+        row_start = max(window.row_off - halo, 0)
+        col_start = max(window.col_off - halo, 0)
+        row_end = min(window.row_off + window.height + halo, self.shape[0])
+        col_end = min(window.col_off + window.width + halo, self.shape[1])
+        inner = (slice(window.row_off - row_start, window.row_off - row_start + window.height),
+                 slice(window.col_off - col_start, window.col_off - col_start + window.width))
+        return (Window(col_start, row_start, col_end - col_start, row_end - row_start), inner)
+
+    def read_dem(self, window: Window) -> numpy.ndarray:
+        """Elevation of a window of the zone (nan where there is no data)"""
+        dem_window = Window(self.zone_window.col_off + window.col_off, self.zone_window.row_off + window.row_off,
+                            window.width, window.height)
+        dem_masked = self.src_dem.read(1, masked=True, window=dem_window)
+        dem = dem_masked.data
+        dem[numpy.ma.getmaskarray(dem_masked)] = numpy.nan
+        return dem
+
+    def read_flood_extent(self, window: Window) -> numpy.ndarray:
+        """Flood extent (WOfS classes) of a window of the zone"""
+        return self.flood_extent_vrt.read(1, window=window)
+
+    def read_channel(self, window: Window) -> numpy.ndarray:
+        """Channel depth of a window of the zone"""
+        return self.channel_vrt.read(1, window=window)
+
+    def sample_dem(self, rows, cols) -> numpy.ndarray:
+        """Elevation at (zone) pixel positions, without reading the zone"""
+        positions = [self.src_dem.xy(self.zone_window.row_off + row, self.zone_window.col_off + col)
+                     for (row, col) in zip(rows, cols)]
+        samples = numpy.ma.concatenate(
+            list(self.src_dem.sample(positions, indexes=1, masked=True)))
+        return samples.astype(numpy.float64).filled(numpy.nan)
+
+    def writer(self, path, dtype, nodata=numpy.nan):
+        """A BlockWriter with the grid of the zone"""
+        return BlockWriter(path, self.transform, self.shape, dtype, nodata, crs=self.crs)
+
+
+class BlockWriter():
+    """Write a raster a window at a time. Windows go to a tiled GeoTIFF next to the output which is
+    converted to a COG (with overviews) when the writer is closed"""
+
+    def __init__(self, path, transform, shape, dtype, nodata=numpy.nan, crs='EPSG:3577', tile_size=512):
+        self.path = path
+        self.transform = transform
+        self.shape = shape
+        self.dtype = dtype
+        self.nodata = nodata
+        self.crs = crs
+        self.tile_size = tile_size
+        self.temporary_path = path.replace('.tif', '_partial.tif')
+        """Tiled GeoTIFF the windows are written to (removed once the COG is written)"""
+
+    def __enter__(self):
+        logging.info(f"Saving to disk: {self.path}")
+        self.dst = rasterio.open(
+            self.temporary_path, 'w',
+            driver='GTiff',
+            compress='LZW',
+            tiled=True,
+            blockxsize=self.tile_size,
+            blockysize=self.tile_size,
+            BIGTIFF='IF_SAFER',
+            dtype=self.dtype,
+            count=1,
+            crs=self.crs,
+            nodata=self.nodata,
+            transform=self.transform,
+            width=self.shape[1],
+            height=self.shape[0])
+        return self
+
+    def write(self, block: numpy.ndarray, window: Window):
+        self.dst.write(block.astype(self.dtype, copy=False), indexes=1, window=window)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.dst.close()
+        if exc_type is None:
+            rasterio.shutil.copy(self.temporary_path, self.path, driver='COG', compress='LZW',
+                                 resampling='average', overview_resampling='average', BIGTIFF='IF_SAFER')
+        os.remove(self.temporary_path)
+
+
+class StreamingLabelStatistics():
+    """Statistics of the connected (3x3) regions of a mask, accumulated a window at a time (two passes).
+
+    Pass 1: add_block labels each window independently, accumulating the count, sum and sum of squares of
+    the values of each label (see LabelStatistics) and keeping the labels along the window edges.
+    finish() joins labels that touch across window edges (connected components of the label graph).
+    Pass 2: block_regions relabels a window and returns the (zone wide) region of each pixel."""
+
+    def __init__(self):
+        self.structure = numpy.ones((3, 3))
+        self.offsets = {}
+        """First (zone wide) label of each window"""
+        self.edges = {}
+        """Labels along the (top, bottom, left, right) edges of each window"""
+        self.label_count = 0
+        self.counts = []
+        self.sums = []
+        self.squares = []
+        self.shift = None
+        """Subtracted from the values before accumulating the sum of squares (numerical stability)"""
+        self.total_count = 0
+        self.total_sum = 0.
+        self.total_square = 0.
+        self.total_min = numpy.inf
+        self.total_max = -numpy.inf
+
+    def label_block(self, mask: numpy.ndarray):
+        return scipy.ndimage.label(mask, structure=self.structure)
+
+    def add_block(self, block_index, values: numpy.ndarray, mask: numpy.ndarray):
+        """Pass 1 - accumulate the statistics of values within the regions of mask in a window"""
+        (labels, num_ids) = self.label_block(mask)
+        if self.shift is None and num_ids > 0:
+            self.shift = float(values[mask][0])
+        (counts, sums, squares) = LabelStatistics.accumulate(
+            numpy.where(mask, values, 0), labels, num_ids + 1, self.shift or 0.)
+        self.counts.append(counts[1:])
+        self.sums.append(sums[1:])
+        self.squares.append(squares[1:])
+        if num_ids > 0:
+            self.total_count += int(numpy.sum(counts[1:]))
+            self.total_sum += float(numpy.sum(sums[1:]))
+            self.total_square += float(numpy.sum(squares[1:]))
+            wet_values = values[mask]
+            self.total_min = min(self.total_min, float(numpy.min(wet_values)))
+            self.total_max = max(self.total_max, float(numpy.max(wet_values)))
+
+        offset = self.label_count
+        zone_labels = numpy.where(labels > 0, labels + offset, 0)
+        self.offsets[block_index] = offset
+        self.edges[block_index] = (zone_labels[0, :], zone_labels[-1, :],
+                                   zone_labels[:, 0], zone_labels[:, -1])
+        self.label_count += num_ids
+
+    def touching(self, first: numpy.ndarray, second: numpy.ndarray):
+        """Pairs of labels that touch (including diagonally) across two adjacent edges"""
+        pairs = []
+        for shift in (-1, 0, 1):
+            a = first[max(-shift, 0):len(first) - max(shift, 0)]
+            b = second[max(shift, 0):len(second) - max(-shift, 0)]
+            both = (a > 0) & (b > 0)
+            pairs.append(numpy.column_stack([a[both], b[both]]))
+        return pairs
+
+    def finish(self):
+        """Join the labels that touch across windows and total the statistics of each region"""
+        pairs = []
+        for ((block_row, block_col), (top, bottom, left, right)) in self.edges.items():
+            if (block_row + 1, block_col) in self.edges:
+                pairs.extend(self.touching(
+                    bottom, self.edges[(block_row + 1, block_col)][0]))
+            if (block_row, block_col + 1) in self.edges:
+                pairs.extend(self.touching(
+                    right, self.edges[(block_row, block_col + 1)][2]))
+            # corners - only the diagonal neighbour can touch
+            if (block_row + 1, block_col + 1) in self.edges:
+                pairs.extend(self.touching(
+                    bottom[-1:], self.edges[(block_row + 1, block_col + 1)][0][:1]))
+            if (block_row + 1, block_col - 1) in self.edges:
+                pairs.extend(self.touching(
+                    bottom[:1], self.edges[(block_row + 1, block_col - 1)][0][-1:]))
+        pairs = numpy.concatenate(pairs) if pairs else numpy.empty((0, 2), dtype=numpy.int64)
+
+        graph = scipy.sparse.coo_matrix((numpy.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                                        shape=(self.label_count + 1, self.label_count + 1))
+        (self.region_count, self.region) = scipy.sparse.csgraph.connected_components(graph, directed=False)
+        """The region of each (zone wide) label"""
+
+        labels = numpy.arange(1, self.label_count + 1)
+        counts = numpy.concatenate(self.counts) if self.counts else numpy.empty(0)
+        sums = numpy.concatenate(self.sums) if self.sums else numpy.empty(0)
+        squares = numpy.concatenate(self.squares) if self.squares else numpy.empty(0)
+        self.region_counts = numpy.bincount(self.region[labels], weights=counts, minlength=self.region_count)
+        region_sums = numpy.bincount(self.region[labels], weights=sums, minlength=self.region_count)
+        region_squares = numpy.bincount(self.region[labels], weights=squares, minlength=self.region_count)
+        (self.region_means, self.region_stds) = LabelStatistics.combine(
+            self.region_counts, region_sums, region_squares, self.shift or 0.)
+        del self.counts, self.sums, self.squares
+
+    def block_regions(self, block_index, mask: numpy.ndarray) -> numpy.ndarray:
+        """Pass 2 - the region of each pixel of mask in a window (-1 outside of the mask)"""
+        (labels, _) = self.label_block(mask)
+        return numpy.where(labels > 0, self.region[labels + self.offsets[block_index]], -1)
+
+    def totals(self):
+        """Count, mean, standard deviation, minimum and maximum of the values across all of the regions"""
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            shifted_mean = self.total_sum / self.total_count
+            std = math.sqrt(max(self.total_square / self.total_count - shifted_mean * shifted_mean, 0))
+        return (self.total_count, shifted_mean + (self.shift or 0.), std, self.total_min, self.total_max)
@@ -8,6 +8,7 @@ from rasterio.vrt import WarpedVRT
 import scipy
 import scipy.ndimage
 from hydrological_connectivity.datatypes.fwdet_outputs import FwdetOutputs
+from hydrological_connectivity.processing.block_streaming import BlockStreamer
 import time
 import rasterio.mask
 import rasterio.warp
@@ -19,7 +20,7 @@ from scipy.ndimage import gaussian_filter
 class FwdetTask():
     """Caculate flood depth using a fwdet method (Cohen et al. 2017, 2019)"""
 
-    def __init__(self, fwdet_outputs: FwdetOutputs):
+    def __init__(self, fwdet_outputs: FwdetOutputs, streaming=False):
         self.WOfS_nodata_value = 0
         self.WOfS_dry_value = 2
         self.WOfS_wet_value = 3
@@ -29,8 +30,15 @@ class FwdetTask():
             self.method = os.environ["FWDET_INTERP_METHOD"]
         else:
             self.method = ""
+        self.streaming = streaming
+        """Process the zone a DEM block window at a time (bounded memory) instead of reading it whole"""
+        self.streaming_window_size = 512
+        """Minimum height and width (in pixels) of the windows read when streaming"""
 
     def execute(self):
+        if self.streaming:
+            self.execute_streaming()
+            return
         self.read_dem()
         self.read_flood_extent()
         self.save_to_disk()
@@ -94,7 +102,9 @@ class FwdetTask():
               (time.time() - start_time))
 
         start_time = time.time()
-        dem_extract = border * self.dem
+        # Sparse list of border cells with a valid elevation (cells at 0.0 are dropped, as the dense extract did)
+        y1, x1 = numpy.nonzero(border & ~numpy.ma.getmaskarray(self.dem) & (self.dem.data != 0.0))
+        newarr = self.dem.data[y1, x1]
         # clean memory for next steps
         del border
         print("--- Extract DEM to borders %s seconds ---" %
@@ -103,25 +113,9 @@ class FwdetTask():
         # ## Interpolation using linear interpolation
 
         start_time = time.time()
-        nrow, ncol = dem_extract.shape
-        x = numpy.arange(0, ncol)
-        y = numpy.arange(0, nrow)
-        dem_extract = numpy.ma.masked_where(dem_extract == 0.0, dem_extract)
-        xx, yy = numpy.meshgrid(x, y)
-        # get only the valid values
-        x1 = xx[~dem_extract.mask]
-        y1 = yy[~dem_extract.mask]
-        newarr = dem_extract[~dem_extract.mask]
-        del dem_extract
-
         if self.method == "SMOOTHING":
-            GD_nearest = interpolate.griddata((x1, y1), newarr.ravel(),
-                                              (xx, yy), method='nearest', fill_value=numpy.nan)
-            # Apply a low pass filter
-            GD1 = gaussian_filter(GD_nearest, sigma=1)
-            # For radius - see https://stackoverflow.com/questions/25216382/gaussian-filter-in-scipy
-            # Set sigma/truncate - this default setting would give width of 9 (truncate=4)
-            logging.info("Using nearest plus smoothing")
+            interpolator = interpolate.NearestNDInterpolator(
+                (x1, y1), newarr.ravel())
         elif self.method == "RIMFIM":
             # Also try linear trend removal then kriging
             # use lstsq(A,b) from scipy.linalg import lstsq
@@ -130,12 +124,19 @@ class FwdetTask():
             # import sklearn
             # gp = sklearn.gaussian_process.GaussianProcessRegressor(kernel=your_chosen_kernel)
             # gp.fit(X, y)
-            logging.exception(f"Have not implemented RIMFIM method")
+            raise NotImplementedError("Have not implemented RIMFIM method")
         else:
-            GD1 = interpolate.griddata((x1, y1), newarr.ravel(),
-                                       (xx, yy), method='linear', fill_value=numpy.nan)
+            interpolator = interpolate.LinearNDInterpolator(
+                (x1, y1), newarr.ravel(), fill_value=numpy.nan)
+        GD1 = FwdetTask.evaluate_by_row(interpolator, self.dem.shape)
+        if self.method == "SMOOTHING":
+            # Apply a low pass filter
+            GD1 = gaussian_filter(GD1, sigma=1)
+            # For radius - see https://stackoverflow.com/questions/25216382/gaussian-filter-in-scipy
+            # Set sigma/truncate - this default setting would give width of 9 (truncate=4)
+            logging.info("Using nearest plus smoothing")
         # clean memory for next steps
-        del newarr, x, y, xx, yy, x1, y1
+        del newarr, x1, y1, interpolator
         print("--- Interpolation %s seconds ---" % (time.time() - start_time))
 
         # ## Estimate water depth
@@ -159,7 +160,7 @@ class FwdetTask():
                     window = from_bounds(
                         left, bottom, right, top, vrt.transform)
                     channel = numpy.ma.asarray(
-                        vrt.read(1, window=window).astype(numpy.float))
+                        vrt.read(1, window=window).astype(numpy.float64))
             del channel_wgs84, vrt
 
             channel[numpy.logical_or(channel.mask, numpy.isnan(channel))] = 0
@@ -171,6 +172,94 @@ class FwdetTask():
                   (time.time() - start_time))
         self.water_depth = water_depth
 
+    def evaluate_by_row(interpolator, shape, rows_per_strip=1024):
+        """Evaluate an interpolator (of x=column, y=row) over a grid, a strip of rows at a time"""
+        nrow, ncol = shape
+        x = numpy.arange(0, ncol)
+        result = numpy.full(shape, numpy.nan)
+        for row_start in range(0, nrow, rows_per_strip):
+            row_end = min(row_start + rows_per_strip, nrow)
+            xx, yy = numpy.meshgrid(x, numpy.arange(row_start, row_end))
+            result[row_start:row_end, :] = interpolator(xx, yy)
+        return result
+
+    def execute_streaming(self):
+        """Streaming equivalent of execute - the zone is read twice, a window at a time. The first pass
+        extracts the (sparse) border cells, the second interpolates across them and writes the water depth"""
+        if self.method == "RIMFIM":
+            # fails rather than reporting success without writing the output
+            raise NotImplementedError("Have not implemented RIMFIM method")
+        structure1 = numpy.ones((3, 3))
+        with BlockStreamer(self.fwdet_outputs.dem_path, self.fwdet_outputs.flood_extent_path,
+                           self.fwdet_outputs.region_of_interest_albers, channel_path=self.fwdet_outputs.channel_path,
+                           min_window_size=self.streaming_window_size) as streamer:
+            self.dem_transform = streamer.transform
+
+            start_time = time.time()
+            border_rows, border_cols, border_elevations = [], [], []
+            for (_, window) in streamer.windows():
+                # the border of a window depends on the flood extent one pixel beyond it
+                (halo_window, inner) = streamer.with_halo(window, 1)
+                flood_extent = streamer.read_flood_extent(halo_window)
+                not_wet = flood_extent == self.WOfS_dry_value
+                nodata = flood_extent == self.WOfS_nodata_value
+                border = (scipy.ndimage.binary_dilation(
+                    not_wet, structure=structure1) & ~not_wet & ~nodata)[inner]
+                dem = streamer.read_dem(window)
+                y1, x1 = numpy.nonzero(border & ~numpy.isnan(dem) & (dem != 0.0))
+                border_rows.append(y1 + window.row_off)
+                border_cols.append(x1 + window.col_off)
+                border_elevations.append(dem[y1, x1])
+            y1 = numpy.concatenate(border_rows)
+            x1 = numpy.concatenate(border_cols)
+            newarr = numpy.concatenate(border_elevations)
+            # in the (row major) order of the whole zone so the triangulation is the same
+            order = numpy.lexsort((x1, y1))
+            (y1, x1, newarr) = (y1[order], x1[order], newarr[order])
+            del border_rows, border_cols, border_elevations, order
+            print("--- Extract DEM to borders %s seconds ---" %
+                  (time.time() - start_time))
+
+            start_time = time.time()
+            if self.method == "SMOOTHING":
+                interpolator = interpolate.NearestNDInterpolator(
+                    (x1, y1), newarr.ravel())
+                # gaussian_filter(sigma=1) reaches 4 pixels (truncate=4)
+                halo = 4
+                logging.info("Using nearest plus smoothing")
+            else:
+                interpolator = interpolate.LinearNDInterpolator(
+                    (x1, y1), newarr.ravel(), fill_value=numpy.nan)
+                halo = 0
+            del newarr, x1, y1
+
+            with streamer.writer(self.fwdet_outputs.output_path, numpy.float64) as writer:
+                for (_, window) in streamer.windows():
+                    (halo_window, inner) = streamer.with_halo(window, halo)
+                    xx, yy = numpy.meshgrid(
+                        numpy.arange(halo_window.col_off, halo_window.col_off + halo_window.width),
+                        numpy.arange(halo_window.row_off, halo_window.row_off + halo_window.height))
+                    GD1 = interpolator(xx, yy)
+                    if self.method == "SMOOTHING":
+                        GD1 = gaussian_filter(GD1, sigma=1)
+                    GD1 = GD1[inner]
+
+                    dem = streamer.read_dem(window)
+                    water_depth = GD1 - dem
+                    water_depth[water_depth < 0] = 0
+                    water_depth[(streamer.read_flood_extent(window) != self.WOfS_wet_value) |
+                                numpy.isnan(dem)] = numpy.nan
+
+                    if self.fwdet_outputs.channel_path is not None:
+                        channel = streamer.read_channel(
+                            window).astype(numpy.float64)
+                        channel[numpy.isnan(channel)] = 0
+                        channel[channel < 0] = 0
+                        water_depth[~numpy.isnan(water_depth)] += channel[~numpy.isnan(water_depth)]
+                    writer.write(water_depth, window)
+            print("--- Interpolation and substraction %s seconds ---" %
+                  (time.time() - start_time))
+
     def save_to_disk(self):
         waterdepth_path = self.fwdet_outputs.output_path
         logging.info(f"Saving to disk: {waterdepth_path}")
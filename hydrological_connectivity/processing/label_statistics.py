@@ -0,0 +1,42 @@
+import numpy
+
+
+class LabelStatistics():
+    """Statistics of values grouped by a label image (e.g. from scipy.ndimage.label), computed with
+    bincount - a single pass over the pixels per statistic rather than a pass per label"""
+
+    def accumulate(values: numpy.ndarray, labels: numpy.ndarray, label_count: int, shift=0.):
+        """Count, sum and sum of squares (of values - shift) of the values of labels 0..label_count-1"""
+        labels = labels.ravel().astype(numpy.intp, copy=False)
+        values = values.ravel().astype(numpy.float64)
+        shifted = values - shift
+        counts = numpy.bincount(labels, minlength=label_count)
+        sums = numpy.bincount(labels, weights=shifted, minlength=label_count)
+        squares = numpy.bincount(
+            labels, weights=shifted * shifted, minlength=label_count)
+        return (counts, sums, squares)
+
+    def combine(counts, sums, squares, shift=0.):
+        """Mean and (population) standard deviation from accumulated counts, sums and sums of squares"""
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            shifted_mean = sums / counts
+            std = numpy.sqrt(numpy.maximum(
+                squares / counts - shifted_mean * shifted_mean, 0))
+        return (shifted_mean + shift, std)
+
+    def per_label(values: numpy.ndarray, labels: numpy.ndarray, label_count: int):
+        """Count, mean and standard deviation (ddof=0) of the values of each label"""
+        valid = labels > 0
+        # shift by a typical value so the sum of squares doesn't lose precision (e.g. elevations)
+        shift = float(values[valid][0]) if numpy.any(valid) else 0.
+        (counts, sums, squares) = LabelStatistics.accumulate(
+            values, labels, label_count, shift)
+        (means, stds) = LabelStatistics.combine(counts, sums, squares, shift)
+        return (counts, means, stds)
+
+    def depth_by_label(levels: numpy.ndarray, labels: numpy.ndarray, dem: numpy.ndarray, dtype=numpy.float32):
+        """The water level of each pixel's label less the elevation, in a single preallocated array"""
+        depth = numpy.empty(labels.shape, dtype=dtype)
+        numpy.take(levels.astype(dtype, copy=False), labels, out=depth)
+        numpy.subtract(depth, dem, out=depth, casting='unsafe')
+        return depth
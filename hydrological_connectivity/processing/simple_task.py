@@ -8,6 +8,8 @@ from rasterio.vrt import WarpedVRT
 import scipy
 import scipy.ndimage
 from hydrological_connectivity.datatypes.simple_outputs import SimpleOutputs
+from hydrological_connectivity.processing.block_streaming import BlockStreamer, StreamingLabelStatistics
+from hydrological_connectivity.processing.label_statistics import LabelStatistics
 import time
 import rasterio.mask
 import rasterio.warp
@@ -17,14 +19,21 @@ from rasterio.windows import from_bounds
 class SimpleTask():
     """Caculate flood depth using a simplistic method"""
 
-    def __init__(self, simple_outputs: SimpleOutputs):
+    def __init__(self, simple_outputs: SimpleOutputs, streaming=False):
         self.WOfS_nodata_value = 0
         self.WOfS_dry_value = 2
         self.WOfS_wet_value = 3
 
         self.simple_outputs = simple_outputs
+        self.streaming = streaming
+        """Process the zone a DEM block window at a time (bounded memory) instead of reading it whole"""
+        self.streaming_window_size = 512
+        """Minimum height and width (in pixels) of the windows read when streaming"""
 
     def execute(self):
+        if self.streaming:
+            self.execute_streaming()
+            return
         self.read_dem()
         self.read_flood_extent()
         self.save_to_disk()
@@ -81,16 +90,13 @@ class SimpleTask():
         wet_non_nan = numpy.where(
             (self.flood_extent == self.WOfS_wet_value) & (~numpy.isnan(dem)), 1, 0)
         groups, num_ids = scipy.ndimage.label(wet_non_nan, structure=structure)
-        group_ids = numpy.arange(0, num_ids + 1)
 
         # Individual
-        groups_mean = scipy.ndimage.mean(dem, groups, group_ids)
-        groups_std = scipy.ndimage.standard_deviation(
-            dem, groups, group_ids)
-        # groups_max = scipy.ndimage.maximum(dem, groups, group_ids)
+        (_, groups_mean, groups_std) = LabelStatistics.per_label(
+            dem, groups, num_ids + 1)
         groups_max = groups_mean+2*groups_std
-        self.water_depth_i = numpy.array(
-            [groups_max[x] for x in groups]) - dem
+        self.water_depth_i = LabelStatistics.depth_by_label(
+            groups_max, groups, dem)
         self.water_depth_i[self.water_depth_i < 0] = 0
         self.water_depth_i[self.out_mask | numpy.isnan(dem)] = numpy.nan
 
@@ -130,3 +136,49 @@ class SimpleTask():
                 resampling='average',
                 overview_resampling='average') as dst:
             dst.write(self.water_depth_i, indexes=1)
+
+    def execute_streaming(self):
+        """Streaming equivalent of execute - the zone is read twice, a window at a time. The first pass
+        accumulates the statistics of the wet areas, the second writes the water depths"""
+        start_time = time.time()
+        with BlockStreamer(self.simple_outputs.dem_path, self.simple_outputs.flood_extent_path,
+                           self.simple_outputs.region_of_interest_albers,
+                           min_window_size=self.streaming_window_size) as streamer:
+            statistics = StreamingLabelStatistics()
+            dem_dtype = streamer.src_dem.dtypes[0]
+            for (block_index, window) in streamer.windows():
+                dem = streamer.read_dem(window)
+                wet = (streamer.read_flood_extent(window) ==
+                       self.WOfS_wet_value) & (~numpy.isnan(dem))
+                statistics.add_block(block_index, dem, wet)
+            statistics.finish()
+            logging.info("--- %s seconds ---" % (time.time() - start_time))
+
+            (_, mean, std, min, max2) = statistics.totals()
+            max = mean + 2 * std
+            logging.info(
+                f"The estimated maximum water height is {max}m from mean {mean} + 2 * stdev of {std} (min was {min})")
+            if (max2 < max):
+                logging.info(
+                    f"The maximum water height is {max2}m - using that instead")
+                max = max2
+            groups_max = statistics.region_means + 2 * statistics.region_stds
+
+            with streamer.writer(self.simple_outputs.output_path.replace('.tif', f'_all.tif'), dem_dtype) as all_writer, \
+                    streamer.writer(self.simple_outputs.output_path.replace('.tif', f'_ind.tif'), numpy.float32) as ind_writer:
+                for (block_index, window) in streamer.windows():
+                    dem = streamer.read_dem(window)
+                    flood_extent = streamer.read_flood_extent(window)
+                    out_mask = (flood_extent != self.WOfS_wet_value) | numpy.isnan(dem)
+
+                    water_depth_a = (max - dem).astype(dem_dtype)
+                    water_depth_a[water_depth_a < 0] = 0
+                    water_depth_a[out_mask] = numpy.nan
+                    all_writer.write(water_depth_a, window)
+
+                    regions = statistics.block_regions(block_index, ~out_mask)
+                    water_depth_i = LabelStatistics.depth_by_label(
+                        groups_max, regions, dem)
+                    water_depth_i[water_depth_i < 0] = 0
+                    water_depth_i[out_mask] = numpy.nan
+                    ind_writer.write(water_depth_i, window)
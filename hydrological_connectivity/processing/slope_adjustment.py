@@ -0,0 +1,48 @@
+import numpy
+from sklearn import linear_model
+
+
+class SlopeAdjustment():
+    """Adjust a DEM for the slope of a river. The gradient is fitted once and evaluated over the grid
+    a strip of rows at a time (with broadcasting) rather than refitted for every small tile"""
+
+    def __init__(self, gradient_fn, base_height, final_height_adjustment=0, rows_per_strip=1024):
+        self.gradient_fn = gradient_fn
+        """The fitted gradient over a grid - gradient_fn(cols, rows) is len(rows) x len(cols)"""
+        self.base_height = base_height
+        """Height added back to the DEM once the gradient is removed (the lowest of the sample heights)"""
+        self.final_height_adjustment = final_height_adjustment
+        self.rows_per_strip = rows_per_strip
+        """Number of rows of the gradient evaluated at a time"""
+
+    def fit_plane(points, heights):
+        """Fit a plane to heights at (row, column) points. Returns its gradient_fn"""
+        clf = linear_model.LinearRegression()
+        clf.fit(points, heights)
+        (row_slope, col_slope) = numpy.ravel(clf.coef_)
+        intercept = numpy.ravel(clf.intercept_)[0]
+
+        def gradient_fn(cols, rows):
+            return (intercept + row_slope * numpy.asarray(rows, dtype=numpy.float64)[:, None] +
+                    col_slope * numpy.asarray(cols, dtype=numpy.float64)[None, :])
+        return gradient_fn
+
+    def from_interpolation_fn(points, heights, interpolation_fn):
+        """gradient_fn of an interpolation_fn(points, heights, cols, rows) (e.g. for a non-planar gradient)"""
+        return lambda cols, rows: interpolation_fn(points, heights, cols, rows)
+
+    def adjust_window(self, dem: numpy.ndarray, row_start=0, col_start=0):
+        """Adjust a window of the DEM starting at (row_start, col_start). Returns the adjusted DEM (nan where
+        the DEM is) and the gradient, both with the data type of the DEM"""
+        adjusted_dem = numpy.empty_like(dem)
+        gradient = numpy.empty_like(dem)
+        cols = numpy.arange(col_start, col_start + dem.shape[1])
+        for strip_start in range(0, dem.shape[0], self.rows_per_strip):
+            strip_end = min(strip_start + self.rows_per_strip, dem.shape[0])
+            strip_gradient = self.gradient_fn(
+                cols, numpy.arange(row_start + strip_start, row_start + strip_end))
+            gradient[strip_start:strip_end] = strip_gradient
+            adjusted_dem[strip_start:strip_end] = (dem[strip_start:strip_end] - strip_gradient +
+                                                   self.base_height + self.final_height_adjustment)
+        adjusted_dem[numpy.isnan(dem)] = numpy.nan
+        return (adjusted_dem, gradient)
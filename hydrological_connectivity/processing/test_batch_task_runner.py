@@ -0,0 +1,113 @@
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from hydrological_connectivity.datatypes.hydraulic_model import HydraulicModel
+from hydrological_connectivity.datatypes.simple_outputs import SimpleOutputs
+from hydrological_connectivity.definitions.model_definitions import DepthModelType
+from hydrological_connectivity.processing.batch_task_runner import BatchTaskRunner
+
+
+def write_outputs(model_type, outputs, accumulation_threshold=None, streaming=False):
+    """Stands in for BatchTaskRunner.run_task - writes the task's outputs (or fails if asked to)"""
+    if 'fail' in os.path.basename(outputs.output_path):
+        raise RuntimeError(f"Failed {outputs.output_path}")
+    for ext in ('all', 'ind'):
+        with open(outputs.output_path.replace('.tif', f'_{ext}.tif'), 'w') as output:
+            output.write('')
+    return 0.
+
+
+class TestBatchTaskRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.ledger_path = os.path.join(self.directory.name, 'ledger.jsonl')
+        hydraulic_model = HydraulicModel('test', None, {}, {})
+        self.outputs = {name: SimpleOutputs('test', None, 'flood_extent.tif', 'dem.tif', hydraulic_model,
+                                            {'start': None, 'end': None}, None, None, 0,
+                                            os.path.join(self.directory.name, f'{name}.tif'))
+                        for name in ('first', 'second', 'fail')}
+        self.definition = SimpleNamespace(simple_outputs=list(self.outputs.values()), tvd_outputs=[],
+                                          fwdet_outputs=[], hand_outputs=[])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def runner(self, retry_failed=True):
+        runner = BatchTaskRunner(self.ledger_path, max_workers=1, model_types=[DepthModelType.Simple],
+                                 accumulation_thresholds=[], retry_failed=retry_failed)
+        runner.task_function = write_outputs
+        return runner
+
+    def key(self, name):
+        return BatchTaskRunner.job_key(DepthModelType.Simple, self.outputs[name])
+
+    def pending_names(self, runner):
+        return sorted(os.path.basename(outputs.output_path)[:-4] for (_, _, outputs, _) in
+                      runner.pending(self.definition))
+
+    def write_ledger(self, *lines):
+        with open(self.ledger_path, 'w') as ledger:
+            ledger.write(''.join(lines))
+
+    def record(self, name, status):
+        return json.dumps({'key': self.key(name), 'model': 'Simple', 'status': status}) + '\n'
+
+    def test_run(self):
+        runner = self.runner()
+        records = runner.run(self.definition)
+        self.assertEqual(sorted((record['key'], record['status']) for record in records),
+                         sorted([(self.key('first'), 'done'), (self.key('second'), 'done'),
+                                 (self.key('fail'), 'failed')]))
+        self.assertIn('RuntimeError', [record for record in records if record['status'] == 'failed'][0]['error'])
+        self.assertEqual({key: record['status'] for (key, record) in runner.read_ledger().items()},
+                         {self.key('first'): 'done', self.key('second'): 'done', self.key('fail'): 'failed'})
+        self.assertEqual(self.pending_names(runner), ['fail'])
+
+    def test_skip(self):
+        # outputs on disk are skipped, as are tasks done in a previous run (whose outputs were moved elsewhere)
+        write_outputs(DepthModelType.Simple, self.outputs['first'])
+        self.write_ledger(self.record('second', 'done'))
+        runner = self.runner()
+        self.assertEqual(self.pending_names(runner), ['fail'])
+        runner.run(self.definition)
+        self.assertFalse(os.path.isfile(self.outputs['second'].output_path.replace('.tif', '_all.tif')))
+
+    def test_resume_after_started(self):
+        # interrupted - started but neither done nor failed (its outputs, partly written, are there)
+        self.write_ledger(self.record('first', 'done'), self.record('second', 'started'))
+        write_outputs(DepthModelType.Simple, self.outputs['second'])
+        runner = self.runner()
+        self.assertEqual(self.pending_names(runner), ['fail', 'second'])
+        records = runner.run(self.definition)
+        self.assertEqual(runner.read_ledger()[self.key('second')]['status'], 'done')
+        self.assertNotIn(self.key('first'), [record['key'] for record in records])
+
+    def test_partial_line(self):
+        # a crash while writing a record leaves a partial line - ignored, and the records appended after it
+        # start on a line of their own
+        self.write_ledger(self.record('first', 'started'), self.record('second', 'done')[:20])
+        runner = self.runner()
+        self.assertEqual(list(runner.read_ledger()), [self.key('first')])
+        runner.run(self.definition)
+        with open(self.ledger_path) as ledger:
+            lines = ledger.read().splitlines()
+        self.assertEqual(lines[1], self.record('second', 'done')[:20])
+        self.assertEqual(sorted(json.loads(line)['status'] for line in lines[2:]),
+                         ['done', 'done', 'failed', 'started', 'started', 'started'])
+        self.assertEqual(runner.read_ledger()[self.key('second')]['status'], 'done')
+
+    def test_retry_failed(self):
+        self.write_ledger(self.record('first', 'failed'), self.record('second', 'done'))
+        self.assertEqual(self.pending_names(self.runner(retry_failed=False)), ['fail'])
+        self.assertEqual(self.pending_names(self.runner(retry_failed=True)), ['fail', 'first'])
+        records = self.runner(retry_failed=True).run(self.definition)
+        self.assertEqual({record['key']: record['status'] for record in records},
+                         {self.key('first'): 'done', self.key('fail'): 'failed'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+import os
+import tempfile
+import unittest
+
+import numpy
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import array_bounds, from_origin
+from shapely.geometry import box
+
+from hydrological_connectivity.datatypes.fwdet_outputs import FwdetOutputs
+from hydrological_connectivity.datatypes.hydraulic_model import HydraulicModel
+from hydrological_connectivity.datatypes.simple_outputs import SimpleOutputs
+from hydrological_connectivity.datatypes.tvd_outputs import TvdOutputs
+from hydrological_connectivity.processing.block_streaming import BlockStreamer
+from hydrological_connectivity.processing.fwdet_task import FwdetTask
+from hydrological_connectivity.processing.simple_task import SimpleTask
+from hydrological_connectivity.processing.tvd_task import TvdTask
+
+
+class TestBlockStreaming(unittest.TestCase):
+    """The streaming mode of each task writes the same outputs as reading the zone whole, with windows
+    (16 pixels) much smaller than the zone and water bodies crossing their edges and corners"""
+
+    SHAPE = (70, 90)
+    BLOCK_SIZE = 16
+    TRANSFORM = from_origin(1000000.0, -3500000.0, 30.0, 30.0)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        (nrow, ncol) = TestBlockStreaming.SHAPE
+        (rows, cols) = numpy.indices(TestBlockStreaming.SHAPE)
+        generator = numpy.random.default_rng(0)
+        dem = (100 + 0.05 * rows + 0.02 * cols + generator.normal(0, 0.3, TestBlockStreaming.SHAPE)).astype(
+            numpy.float32)
+        dem[60:63, 70:73] = numpy.nan
+        # a border cell (the right edge of the round water body) at 0.0 - dropped, as the dense border extract did
+        dem[32, 54] = 0.0
+
+        flood_extent = numpy.full(TestBlockStreaming.SHAPE, 2, dtype=numpy.uint8)
+        # only diagonally connected, through the corner of windows (1, 1) and (0, 0)
+        diagonal = numpy.arange(8, 24)
+        flood_extent[diagonal, diagonal] = 3
+        # through the corner of windows (0, 2) and (1, 1)
+        flood_extent[diagonal, 47 - diagonal] = 3
+        # across the edges and corner of four windows
+        flood_extent[(rows - 32) ** 2 + (cols - 48) ** 2 <= 36] = 3
+        # across every column of windows, with cloud over part of it - the dry pixels along its bottom are in
+        # the next row of windows
+        flood_extent[45:48, 5:85] = 3
+        flood_extent[45:58, 58:66] = 0
+        # a water body with no data under it
+        flood_extent[58:65, 68:75] = 3
+        self.dem_path = self.write(os.path.join(self.directory.name, 'dem.tif'), dem, numpy.nan)
+        self.flood_extent_path = self.write(os.path.join(self.directory.name, 'flood_extent.tif'), flood_extent, None)
+        channel = numpy.where(cols == rows + 1, 0.5, numpy.nan).astype(numpy.float32)
+        self.channel_path = self.write(os.path.join(self.directory.name, 'channel.tif'), channel, numpy.nan)
+
+        self.region_of_interest = box(*array_bounds(nrow, ncol, TestBlockStreaming.TRANSFORM))
+        self.hydraulic_model = HydraulicModel('test', None, {}, {})
+        self.simulation_timespan = {'start': None, 'end': None}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, path, array, nodata):
+        with rasterio.open(path, 'w', driver='GTiff', tiled=True, blockxsize=TestBlockStreaming.BLOCK_SIZE,
+                           blockysize=TestBlockStreaming.BLOCK_SIZE, dtype=array.dtype, count=1, crs='EPSG:3577',
+                           nodata=nodata, transform=TestBlockStreaming.TRANSFORM, width=array.shape[1],
+                           height=array.shape[0]) as dst:
+            dst.write(array, indexes=1)
+        return path
+
+    def output_path(self, name):
+        return os.path.join(self.directory.name, f'{name}.tif')
+
+    def assert_same_outputs(self, whole_path, streaming_path):
+        with rasterio.open(whole_path) as whole, rasterio.open(streaming_path) as streaming:
+            self.assertEqual(whole.transform, streaming.transform)
+            expected = whole.read(1)
+            actual = streaming.read(1)
+        self.assertTrue(numpy.array_equal(numpy.isnan(expected), numpy.isnan(actual)), streaming_path)
+        self.assertTrue(numpy.allclose(expected, actual, rtol=0, atol=1e-4, equal_nan=True), streaming_path)
+
+    def run_task(self, task, streaming):
+        task.streaming = streaming
+        task.streaming_window_size = TestBlockStreaming.BLOCK_SIZE
+        task.execute()
+
+    def test_windows(self):
+        with BlockStreamer(self.dem_path, self.flood_extent_path, self.region_of_interest,
+                           min_window_size=TestBlockStreaming.BLOCK_SIZE) as streamer:
+            windows = [window for (_, window) in streamer.windows()]
+            self.assertEqual(streamer.shape, TestBlockStreaming.SHAPE)
+            self.assertEqual(len(windows), 5 * 6)
+            self.assertEqual(sum(window.width * window.height for window in windows), 70 * 90)
+
+    def test_simple_task(self):
+        for streaming in (False, True):
+            name = 'simple_streaming' if streaming else 'simple'
+            self.run_task(SimpleTask(SimpleOutputs('test', None, self.flood_extent_path, self.dem_path,
+                                                   self.hydraulic_model, self.simulation_timespan,
+                                                   self.region_of_interest, None, 0, self.output_path(name))),
+                          streaming)
+        for ext in ('all', 'ind'):
+            self.assert_same_outputs(self.output_path(f'simple_{ext}'), self.output_path(f'simple_streaming_{ext}'))
+
+    def test_tvd_task(self):
+        # two points along the diagonal water body (longitude, latitude)
+        to_wgs84 = Transformer.from_crs('EPSG:3577', 'EPSG:4326')
+        coords = []
+        for (row, col) in [(10, 10), (20, 20)]:
+            (x, y) = TestBlockStreaming.TRANSFORM * (col + 0.5, row + 0.5)
+            (latitude, longitude) = to_wgs84.transform(x, y)
+            coords.append((longitude, latitude))
+        for streaming in (False, True):
+            name = 'tvd_streaming' if streaming else 'tvd'
+            self.run_task(TvdTask(TvdOutputs('test', self.flood_extent_path, self.dem_path, self.hydraulic_model,
+                                             self.simulation_timespan, coords, self.region_of_interest, None, 0,
+                                             self.output_path(name))),
+                          streaming)
+        for ext in ('adj', 'all', 'ind'):
+            self.assert_same_outputs(self.output_path(f'tvd_{ext}'), self.output_path(f'tvd_streaming_{ext}'))
+
+    def test_fwdet_task(self):
+        for channel_path in (None, self.channel_path):
+            for streaming in (False, True):
+                name = f"fwdet{'_channel' if channel_path else ''}{'_streaming' if streaming else ''}"
+                self.run_task(FwdetTask(FwdetOutputs('test', self.flood_extent_path, self.dem_path, channel_path,
+                                                     self.hydraulic_model, self.simulation_timespan,
+                                                     self.region_of_interest, None, 0, self.output_path(name))),
+                              streaming)
+        self.assert_same_outputs(self.output_path('fwdet'), self.output_path('fwdet_streaming'))
+        self.assert_same_outputs(self.output_path('fwdet_channel'), self.output_path('fwdet_channel_streaming'))
+
+    def test_fwdet_task_smoothing(self):
+        # nearest border cell (the same tree of border cells, in the same order, so the same choice between
+        # equidistant ones) smoothed across the window edges
+        for streaming in (False, True):
+            name = f"fwdet_smoothing{'_streaming' if streaming else ''}"
+            task = FwdetTask(FwdetOutputs('test', self.flood_extent_path, self.dem_path, self.channel_path,
+                                          self.hydraulic_model, self.simulation_timespan, self.region_of_interest,
+                                          None, 0, self.output_path(name)))
+            task.method = "SMOOTHING"
+            self.run_task(task, streaming)
+        self.assert_same_outputs(self.output_path('fwdet_smoothing'), self.output_path('fwdet_smoothing_streaming'))
+
+    def test_fwdet_task_rimfim(self):
+        # both modes fail rather than writing an output
+        for streaming in (False, True):
+            task = FwdetTask(FwdetOutputs('test', self.flood_extent_path, self.dem_path, None, self.hydraulic_model,
+                                          self.simulation_timespan, self.region_of_interest, None, 0,
+                                          self.output_path('fwdet_rimfim')))
+            task.method = "RIMFIM"
+            with self.assertRaises(NotImplementedError):
+                self.run_task(task, streaming)
+            self.assertFalse(os.path.exists(self.output_path('fwdet_rimfim')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+
+import numpy
+import scipy.ndimage
+
+from hydrological_connectivity.processing.block_streaming import StreamingLabelStatistics
+from hydrological_connectivity.processing.label_statistics import LabelStatistics
+
+
+class TestLabelStatistics(unittest.TestCase):
+
+    def setUp(self):
+        generator = numpy.random.default_rng(0)
+        # elevations (large relative to their spread, as in the tasks) and water bodies of every size
+        self.values = (150 + generator.normal(0, 2, (120, 100))).astype(numpy.float32)
+        self.mask = scipy.ndimage.binary_opening(generator.random((120, 100)) > 0.55)
+        (self.labels, self.label_count) = scipy.ndimage.label(self.mask, structure=numpy.ones((3, 3)))
+
+    def test_per_label(self):
+        # the same as the scipy.ndimage statistics (a pass per label) they replace
+        (counts, means, stds) = LabelStatistics.per_label(self.values, self.labels, self.label_count + 1)
+        index = numpy.arange(1, self.label_count + 1)
+        self.assertGreater(self.label_count, 50)
+        self.assertTrue(numpy.array_equal(counts[1:], scipy.ndimage.sum(
+            numpy.ones(self.labels.shape), self.labels, index)))
+        self.assertTrue(numpy.allclose(means[1:], scipy.ndimage.mean(self.values, self.labels, index),
+                                       rtol=0, atol=1e-9))
+        self.assertTrue(numpy.allclose(stds[1:], scipy.ndimage.standard_deviation(self.values, self.labels, index),
+                                       rtol=0, atol=1e-9))
+
+    def test_depth_by_label(self):
+        (_, means, stds) = LabelStatistics.per_label(self.values, self.labels, self.label_count + 1)
+        levels = means + 2 * stds
+        depth = LabelStatistics.depth_by_label(levels, self.labels, self.values)
+        self.assertEqual(depth.dtype, numpy.float32)
+        self.assertTrue(numpy.allclose(depth, numpy.array([levels[x] for x in self.labels]) - self.values,
+                                       rtol=0, atol=1e-4))
+
+    def test_streaming_label_statistics(self):
+        # windows of 16 pixels - the regions joined across them have the statistics of the whole
+        statistics = StreamingLabelStatistics()
+        windows = [((row // 16, col // 16), (slice(row, row + 16), slice(col, col + 16)))
+                   for row in range(0, 120, 16) for col in range(0, 100, 16)]
+        for (block_index, window) in windows:
+            statistics.add_block(block_index, self.values[window], self.mask[window])
+        statistics.finish()
+        regions = numpy.full(self.labels.shape, -1)
+        for (block_index, window) in windows:
+            regions[window] = statistics.block_regions(block_index, self.mask[window])
+
+        (_, means, stds) = LabelStatistics.per_label(self.values, self.labels, self.label_count + 1)
+        # one region per label (and one for the background)
+        self.assertEqual(statistics.region_count, self.label_count + 1)
+        self.assertTrue(numpy.allclose(statistics.region_means[regions[self.mask]], means[self.labels[self.mask]]))
+        self.assertTrue(numpy.allclose(statistics.region_stds[regions[self.mask]], stds[self.labels[self.mask]]))
+        (count, mean, std, minimum, maximum) = statistics.totals()
+        wet_values = self.values[self.mask]
+        self.assertEqual(count, len(wet_values))
+        self.assertAlmostEqual(mean, numpy.mean(wet_values, dtype=numpy.float64), places=9)
+        self.assertAlmostEqual(std, numpy.std(wet_values, dtype=numpy.float64), places=9)
+        self.assertEqual((minimum, maximum), (numpy.min(wet_values), numpy.max(wet_values)))
+
+
+if __name__ == '__main__':
+    unittest.main()
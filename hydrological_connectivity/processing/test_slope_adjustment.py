@@ -0,0 +1,50 @@
+import unittest
+
+import numpy
+from sklearn import linear_model
+
+from hydrological_connectivity.processing.slope_adjustment import SlopeAdjustment
+
+
+class TestSlopeAdjustment(unittest.TestCase):
+
+    def setUp(self):
+        # the river's sample points (row, column) and heights, as TvdTask.fit_slope samples them
+        self.points = numpy.array([[3, 5], [8, 14], [14, 20], [19, 33], [27, 41]])
+        self.heights = numpy.array([104.2, 103.9, 103.1, 102.8, 101.7])
+        generator = numpy.random.default_rng(0)
+        self.dem = (100 + generator.normal(0, 1, (45, 60))).astype(numpy.float32)
+        self.dem[10:12, 30:34] = numpy.nan
+
+    def predict(self, rows, cols):
+        """The gradient as TvdTask.interpolate_gradient predicted it - LinearRegression over every grid point"""
+        clf = linear_model.LinearRegression()
+        clf.fit(self.points, self.heights)
+        c = numpy.zeros((len(rows) * len(cols), 2), dtype=int)
+        c[:, 0] = numpy.repeat(rows, len(cols))
+        c[:, 1] = numpy.tile(cols, len(rows))
+        return clf.predict(c).reshape((len(rows), len(cols)))
+
+    def test_fit_plane(self):
+        gradient_fn = SlopeAdjustment.fit_plane(self.points, self.heights)
+        for (rows, cols) in [(numpy.arange(45), numpy.arange(60)), (numpy.arange(20, 25), numpy.arange(7, 50))]:
+            self.assertTrue(numpy.allclose(gradient_fn(cols, rows), self.predict(rows, cols), rtol=0, atol=1e-10))
+
+    def test_adjust_window(self):
+        slope_adjustment = SlopeAdjustment(SlopeAdjustment.fit_plane(self.points, self.heights),
+                                           numpy.min(self.heights), final_height_adjustment=0.5, rows_per_strip=7)
+        (adjusted_dem, gradient) = slope_adjustment.adjust_window(self.dem)
+        expected_gradient = self.predict(numpy.arange(45), numpy.arange(60))
+        self.assertEqual(adjusted_dem.dtype, numpy.float32)
+        self.assertTrue(numpy.allclose(gradient, expected_gradient, rtol=0, atol=1e-4))
+        expected = self.dem - expected_gradient + numpy.min(self.heights) + 0.5
+        self.assertTrue(numpy.allclose(adjusted_dem, expected, rtol=0, atol=1e-4, equal_nan=True))
+        self.assertTrue(numpy.array_equal(numpy.isnan(adjusted_dem), numpy.isnan(self.dem)))
+
+        # a window of the DEM is adjusted as that part of the whole
+        (window_dem, _) = slope_adjustment.adjust_window(self.dem[20:40, 15:45], 20, 15)
+        self.assertTrue(numpy.array_equal(window_dem, adjusted_dem[20:40, 15:45]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,30 +9,38 @@ from rasterio.vrt import WarpedVRT
 import scipy
 import scipy.ndimage
 from hydrological_connectivity.datatypes.tvd_outputs import TvdOutputs
+from hydrological_connectivity.processing.block_streaming import BlockStreamer, StreamingLabelStatistics
+from hydrological_connectivity.processing.label_statistics import LabelStatistics
+from hydrological_connectivity.processing.slope_adjustment import SlopeAdjustment
 import time
 import rasterio.mask
 import rasterio.warp
 from rasterio.windows import from_bounds
 import rasterio
 from scipy import ndimage
-import itertools
 from functools import reduce
 import scipy.spatial.distance
-from sklearn import linear_model
 from pyproj import Transformer
 
 
 class TvdTask():
     """Caculate flood depth using Teng-Vaze-Dutta (TVD) method"""
 
-    def __init__(self, tvd_outputs: TvdOutputs):
+    def __init__(self, tvd_outputs: TvdOutputs, streaming=False):
         self.WOfS_nodata_value = 0
         self.WOfS_dry_value = 2
         self.WOfS_wet_value = 3
 
         self.tvd_outputs = tvd_outputs
+        self.streaming = streaming
+        """Process the zone a DEM block window at a time (bounded memory) instead of reading it whole"""
+        self.streaming_window_size = 512
+        """Minimum height and width (in pixels) of the windows read when streaming"""
 
     def execute(self):
+        if self.streaming:
+            self.execute_streaming()
+            return
 
         self.read_dem()
         self.adjust_slope()
@@ -57,22 +65,25 @@ class TvdTask():
 
         self.dem = self.dem_masked.data
         self.dem[self.dem_masked.mask] = numpy.nan
+        self.project_coords()
+
+    def project_coords(self):
         self.coords = [Transformer.from_crs("epsg:4326", self.dem_crs).transform(coord[1], coord[0])
                        for coord in self.tvd_outputs.coords]
         logging.info(
             f"Sample points {str(self.tvd_outputs.coords)} translated to {str(self.coords)}")
 
     def interpolate_gradient(points, heights, cols, rows):
-        clf = linear_model.LinearRegression()
-        clf.fit(points, heights)
-
-        # All the possible points in the grid
-        c = numpy.zeros((len(rows)*len(cols), 2), dtype=int)
-        c[:, 0] = numpy.repeat(rows, len(cols))
-        c[:, 1] = numpy.tile(cols, len(rows))
+        return SlopeAdjustment.fit_plane(points, heights)(cols, rows)
 
-        output = clf.predict(c).reshape((len(rows), len(cols)))
-        return output
+    def slope_adjustment(points, heights, final_height_adjustment=0, interpolation_fn=interpolate_gradient):
+        """SlopeAdjustment for the fitted slope - the default (planar) gradient is fitted just once"""
+        if interpolation_fn is TvdTask.interpolate_gradient:
+            gradient_fn = SlopeAdjustment.fit_plane(points, heights)
+        else:
+            gradient_fn = SlopeAdjustment.from_interpolation_fn(
+                points, heights, interpolation_fn)
+        return SlopeAdjustment(gradient_fn, numpy.min(heights), final_height_adjustment)
 
     def adjust_slope(self, final_height_adjustment=0, angle_adjustment=0., interpolation_fn=interpolate_gradient):
         """ Adjust the DEM to account for slope of the river
@@ -87,6 +98,39 @@ class TvdTask():
             angle_adjustment (float, optional): [description]. Defaults to 0.
             interpolation_fn (function, optional): [description]. Defaults to interpolate_gradient.
         """
+        (points, heights) = self.fit_slope(
+            lambda rows, cols: self.dem[rows, cols], angle_adjustment, interpolation_fn)
+
+        (self.adjusted_dem, self.gradient_dest) = TvdTask.slope_adjustment(
+            points, heights, final_height_adjustment, interpolation_fn).adjust_window(self.dem)
+        min_adjustment = numpy.min(self.gradient_dest)
+        max_adjustment = numpy.max(self.gradient_dest)
+
+        final_heights = numpy.array(
+            [self.adjusted_dem[points[0][0], points[0][1]], self.adjusted_dem[points[1][0], points[1][1]]])
+
+        logging.info("Slope adjusted heights %s" % final_heights)
+        point_dist = scipy.spatial.distance.euclidean(points[0], points[1])
+        height_difference = final_heights[0] - final_heights[1]
+        if height_difference == 0:
+            theta = numpy.pi / 2
+        else:
+            theta = numpy.arctan(point_dist / height_difference)
+        logging.info("Gradient angle A -> B %.2f" % numpy.degrees(theta))
+        max_adjustment -= numpy.min(heights)
+        min_adjustment -= numpy.min(heights)
+        logging.info("Maximum adjustment %s, minimum adjustment %s" %
+                     (max_adjustment, min_adjustment))
+
+    def fit_slope(self, sample_dem, angle_adjustment=0., interpolation_fn=interpolate_gradient):
+        """Fit the slope of the river between the sample points. Returns the (zone) grid positions of
+        the sample points and the heights of the slope at them
+
+        Args:
+            sample_dem (function): the DEM at (zone) rows and columns - sample_dem(rows, cols)
+            angle_adjustment (float, optional): [description]. Defaults to 0.
+            interpolation_fn (function, optional): [description]. Defaults to interpolate_gradient.
+        """
 
         # 1) Extract points as close to the coordinates (a) and (b) as possible
         # 2) Get the index of the src_dem that is closest to the coordinates
@@ -112,11 +156,9 @@ class TvdTask():
         line_points = numpy.round(numpy.column_stack([
             numpy.linspace(points[0, 0], points[1, 0], line_count),
             numpy.linspace(points[0, 1], points[1, 1], line_count)
-        ])).astype(numpy.int)
-        line_heights = []
-        for pnt in line_points:
-            line_heights.append(self.dem[pnt[0], pnt[1]])
-        line_heights = numpy.array(line_heights)
+        ])).astype(int)
+        line_heights = numpy.asarray(
+            sample_dem(line_points[:, 0], line_points[:, 1]))
 
         if numpy.any(numpy.isnan(line_heights)):
             line_points = line_points[~numpy.isnan(line_heights)]
@@ -136,60 +178,7 @@ class TvdTask():
                     numpy.radians(angle_adjustment)
                 adjacent = height_difference / numpy.tan(theta)
             heights[1] += height_difference - adjacent
-
-        step_size = 20
-        min_adjustment = numpy.inf
-        max_adjustment = -numpy.inf
-        self.adjusted_dem = numpy.empty_like(self.dem)
-        self.gradient_dest = numpy.empty_like(self.dem)
-        for row_start, column_start in itertools.product(numpy.arange(0, self.dem.shape[0], step_size),
-                                                         numpy.arange(0, self.dem.shape[1], step_size)):
-            window = (
-                (row_start, min(row_start + step_size, self.dem.shape[0])),
-                (column_start, min(column_start +
-                                   step_size, self.dem.shape[1]))
-            )
-
-            rows = numpy.arange(row_start, min(
-                row_start + step_size, self.dem.shape[0]))
-            cols = numpy.arange(column_start, min(
-                column_start + step_size, self.dem.shape[1]))
-
-            src_dem_data = self.dem[slice(*window[0]), slice(*window[1])]
-
-            gradient = interpolation_fn(points, heights, cols, rows)[
-                :src_dem_data.shape[0], :src_dem_data.shape[1]]
-            min_adjustment = numpy.min([min_adjustment, numpy.min(gradient)])
-            max_adjustment = numpy.max([max_adjustment, numpy.max(gradient)])
-            interp = (src_dem_data - gradient +
-                      numpy.min(heights) + final_height_adjustment)
-            write_window = (
-                (row_start, row_start + src_dem_data.shape[0]),
-                (column_start, column_start + src_dem_data.shape[1])
-            )
-            # re-nodata incoming nodata
-            #interp[reduce(numpy.logical_or, [src_dem_data == f for f in src.nodatavals])] = src.nodatavals[0]
-            self.adjusted_dem[slice(*write_window[0]),
-                              slice(*write_window[1])] = interp
-            self.gradient_dest[slice(*write_window[0]),
-                               slice(*write_window[1])] = gradient
-        self.adjusted_dem[(numpy.isnan(self.dem))] = numpy.nan
-
-        final_heights = numpy.array(
-            [self.adjusted_dem[points[0][0], points[0][1]], self.adjusted_dem[points[1][0], points[1][1]]])
-
-        logging.info("Slope adjusted heights %s" % final_heights)
-        point_dist = scipy.spatial.distance.euclidean(points[0], points[1])
-        height_difference = final_heights[0] - final_heights[1]
-        if height_difference == 0:
-            theta = numpy.pi / 2
-        else:
-            theta = numpy.arctan(point_dist / height_difference)
-        logging.info("Gradient angle A -> B %.2f" % numpy.degrees(theta))
-        max_adjustment -= numpy.min(heights)
-        min_adjustment -= numpy.min(heights)
-        logging.info("Maximum adjustment %s, minimum adjustment %s" %
-                     (max_adjustment, min_adjustment))
+        return (points, heights)
 
     def read_flood_extent(self):
         start_time = time.time()
@@ -243,16 +232,13 @@ class TvdTask():
         wet_non_nan = numpy.where(
             (self.flood_extent == self.WOfS_wet_value) & (~numpy.isnan(dem)), 1, 0)
         groups, num_ids = scipy.ndimage.label(wet_non_nan, structure=structure)
-        group_ids = numpy.arange(0, num_ids + 1)
 
         # Individual
-        groups_mean = scipy.ndimage.mean(dem, groups, group_ids)
-        groups_std = scipy.ndimage.standard_deviation(
-            dem, groups, group_ids)
-        # groups_max = scipy.ndimage.maximum(dem, groups, group_ids)
+        (_, groups_mean, groups_std) = LabelStatistics.per_label(
+            dem, groups, num_ids + 1)
         groups_max = groups_mean+2*groups_std
-        self.water_depth_i = numpy.array(
-            [groups_max[x] for x in groups]) - dem
+        self.water_depth_i = LabelStatistics.depth_by_label(
+            groups_max, groups, dem)
         self.water_depth_i[self.water_depth_i < 0] = 0
         self.water_depth_i[self.out_mask | numpy.isnan(dem)] = numpy.nan
 
@@ -346,3 +332,74 @@ class TvdTask():
                 resampling='average',
                 overview_resampling='average') as dst:
             dst.write(self.water_depth_i, indexes=1)
+
+    def execute_streaming(self):
+        """Streaming equivalent of execute - the slope is fitted from samples of the DEM, then the zone is
+        read twice, a window at a time. The first pass accumulates the statistics of the wet areas of the
+        adjusted DEM, the second writes the adjusted DEM and the water depths"""
+        start_time = time.time()
+        with BlockStreamer(self.tvd_outputs.dem_path, self.tvd_outputs.flood_extent_path,
+                           self.tvd_outputs.region_of_interest_albers,
+                           min_window_size=self.streaming_window_size) as streamer:
+            self.dem_transform = streamer.transform
+            self.dem_crs = streamer.crs
+            self.window_positions = (
+                streamer.zone_window.row_off, streamer.zone_window.col_off)
+            self.project_coords()
+            (points, heights) = self.fit_slope(streamer.sample_dem)
+            slope_adjustment = TvdTask.slope_adjustment(points, heights)
+
+            statistics = StreamingLabelStatistics()
+            min_adjustment = numpy.inf
+            max_adjustment = -numpy.inf
+            for (block_index, window) in streamer.windows():
+                (adjusted_dem, gradient) = slope_adjustment.adjust_window(
+                    streamer.read_dem(window), window.row_off, window.col_off)
+                min_adjustment = numpy.min([min_adjustment, numpy.min(gradient)])
+                max_adjustment = numpy.max([max_adjustment, numpy.max(gradient)])
+                wet = (streamer.read_flood_extent(window) ==
+                       self.WOfS_wet_value) & (~numpy.isnan(adjusted_dem))
+                statistics.add_block(block_index, adjusted_dem, wet)
+            statistics.finish()
+
+            final_heights = (streamer.sample_dem(points[:, 0], points[:, 1]) -
+                             slope_adjustment.gradient_fn(points[:, 1], points[:, 0])[[0, 1], [0, 1]] +
+                             slope_adjustment.base_height)
+            logging.info("Slope adjusted heights %s" % final_heights)
+            logging.info("Maximum adjustment %s, minimum adjustment %s" %
+                         (max_adjustment - numpy.min(heights), min_adjustment - numpy.min(heights)))
+            logging.info("--- %s seconds ---" % (time.time() - start_time))
+
+            (_, mean, std, min, max2) = statistics.totals()
+            max = mean + 2 * std
+            logging.info(
+                f"The estimated maximum water height is {max}m from mean {mean} + 2 * stdev of {std} (min was {min})")
+            if (max2 < max):
+                logging.info(
+                    f"The maximum water height is {max2}m - using that instead")
+                max = max2
+            groups_max = statistics.region_means + 2 * statistics.region_stds
+
+            dem_dtype = streamer.src_dem.dtypes[0]
+            with streamer.writer(self.tvd_outputs.output_path.replace('.tif', f'_adj.tif'), dem_dtype, nodata=-9999) as adjusted_writer, \
+                    streamer.writer(self.tvd_outputs.output_path.replace('.tif', f'_all.tif'), dem_dtype) as all_writer, \
+                    streamer.writer(self.tvd_outputs.output_path.replace('.tif', f'_ind.tif'), numpy.float32) as ind_writer:
+                for (block_index, window) in streamer.windows():
+                    (adjusted_dem, _) = slope_adjustment.adjust_window(
+                        streamer.read_dem(window), window.row_off, window.col_off)
+                    adjusted_writer.write(adjusted_dem, window)
+                    flood_extent = streamer.read_flood_extent(window)
+                    out_mask = (flood_extent != self.WOfS_wet_value) | numpy.isnan(
+                        adjusted_dem)
+
+                    water_depth_a = (max - adjusted_dem).astype(dem_dtype)
+                    water_depth_a[water_depth_a < 0] = 0
+                    water_depth_a[out_mask] = numpy.nan
+                    all_writer.write(water_depth_a, window)
+
+                    regions = statistics.block_regions(block_index, ~out_mask)
+                    water_depth_i = LabelStatistics.depth_by_label(
+                        groups_max, regions, adjusted_dem)
+                    water_depth_i[water_depth_i < 0] = 0
+                    water_depth_i[out_mask] = numpy.nan
+                    ind_writer.write(water_depth_i, window)
@@ -0,0 +1,195 @@
+import os
+import tempfile
+from itertools import islice
+
+import boto3
+import dask.array as da
+import numpy as np
+import rasterio
+import rasterio.shutil
+from dask.distributed import as_completed
+from rasterio.windows import Window
+from xarray import DataArray
+
+
+class CogWriter():
+    """Write a raster to a cloud optimised geotiff (a local path or s3://bucket/key) without holding the whole
+    file in memory. Blocks are written to a tiled geotiff as they are computed, along with each overview level,
+    then the file is laid out as a COG (reusing the overviews already built) and uploaded to s3 in parts.
+
+    Usage:
+        CogWriter('s3://bucket/prefix/depth.tif').write(raster, client)
+    """
+
+    def __init__(self, destination: str, nodata=65535, blocksize=512, overview_levels=(2, 4, 8, 16, 32),
+                 compress='deflate', max_blocks_in_flight=16, part_size=64 * 1024 * 1024, working_directory=None,
+                 acl="bucket-owner-full-control"):
+        self.destination = destination
+        """Local path or s3://bucket/key of the COG"""
+        self.nodata = nodata
+        self.blocksize = blocksize
+        """Size of the (square) tiles of the COG"""
+        self.overview_levels = overview_levels
+        """Decimation factors of the overviews (nearest neighbour)"""
+        self.compress = compress
+        self.max_blocks_in_flight = max_blocks_in_flight
+        """Number of blocks of a dask backed raster computed ahead of the writer"""
+        self.part_size = part_size
+        """Size of each part of the multipart upload (at least 5MB except for the last part)"""
+        self.working_directory = working_directory
+        """Where the intermediate files are written (default is the system temporary directory)"""
+        self.acl = acl
+        """Canned ACL of the uploaded object"""
+
+    def is_s3(self):
+        return self.destination.startswith('s3://')
+
+    def write(self, raster: DataArray, client=None):
+        """Write the raster (numpy or dask backed, georeferenced with rioxarray). Blocks of a dask backed raster
+        are computed with the client (or in this process if there isn't one)"""
+        with tempfile.TemporaryDirectory(dir=self.working_directory) as working_directory:
+            vrt_path = self.write_tiles(raster, working_directory, client)
+            cog_path = os.path.join(working_directory, 'cog.tif') if self.is_s3() else self.destination
+            predictor = 2 if np.issubdtype(raster.dtype, np.integer) else 3
+            rasterio.shutil.copy(vrt_path, cog_path, driver='COG', overviews='FORCE_USE_EXISTING',
+                                 blocksize=self.blocksize, compress=self.compress, predictor=predictor,
+                                 bigtiff='IF_SAFER')
+            if self.is_s3():
+                self.upload(cog_path)
+        return self.destination
+
+    def write_tiles(self, raster: DataArray, working_directory: str, client=None) -> str:
+        """Write the blocks and overviews to tiled geotiffs. Returns the path of a VRT of the raster that
+        refers to the overviews"""
+        (height, width) = raster.shape
+        profile = {'driver': 'GTiff', 'count': 1, 'dtype': raster.dtype, 'nodata': self.nodata, 'tiled': True,
+                   'blockxsize': self.blocksize, 'blockysize': self.blocksize, 'compress': self.compress,
+                   'bigtiff': 'IF_SAFER'}
+        overview_sizes = [(-(-height // factor), -(-width // factor))
+                          for factor in self.overview_levels]
+        base = rasterio.open(os.path.join(working_directory, 'base.tif'), 'w', height=height, width=width,
+                             crs=raster.rio.crs, transform=raster.rio.transform(), **profile)
+        overviews = [rasterio.open(os.path.join(working_directory, f'overview_{factor}.tif'), 'w',
+                                   height=overview_height, width=overview_width, **profile)
+                     for (factor, (overview_height, overview_width)) in zip(self.overview_levels, overview_sizes)]
+        try:
+            for (bounds, block) in self.blocks(raster, client):
+                self.write_block(base, overviews, bounds, block)
+        finally:
+            base.close()
+            for overview in overviews:
+                overview.close()
+        return self.write_vrt(raster, working_directory)
+
+    def blocks(self, raster: DataArray, client=None):
+        """Yield ((row0, row1, col0, col1), block) - in the order they are computed for a dask backed raster"""
+        data = raster.data
+        if not isinstance(data, da.Array):
+            step = self.blocksize * 8
+            for row0 in range(0, data.shape[0], step):
+                for col0 in range(0, data.shape[1], step):
+                    row1 = min(row0 + step, data.shape[0])
+                    col1 = min(col0 + step, data.shape[1])
+                    yield ((row0, row1, col0, col1), np.asarray(data[row0:row1, col0:col1]))
+            return
+
+        row_edges = np.cumsum((0,) + data.chunks[0])
+        col_edges = np.cumsum((0,) + data.chunks[1])
+        delayed_blocks = data.to_delayed()
+
+        def bounds(index):
+            return (row_edges[index[0]], row_edges[index[0] + 1], col_edges[index[1]], col_edges[index[1] + 1])
+
+        indices = np.ndindex(delayed_blocks.shape)
+        if client is None:
+            for index in indices:
+                yield (bounds(index), np.asarray(delayed_blocks[index].compute()))
+            return
+
+        # keep a bounded number of blocks computed ahead of the writer
+        index_of_future = {}
+        futures = as_completed()
+        for index in islice(indices, self.max_blocks_in_flight):
+            future = client.compute(delayed_blocks[index])
+            index_of_future[future.key] = index
+            futures.add(future)
+        for future in futures:
+            index = index_of_future.pop(future.key)
+            block = np.asarray(future.result())
+            future.release()
+            for next_index in islice(indices, 1):
+                next_future = client.compute(delayed_blocks[next_index])
+                index_of_future[next_future.key] = next_index
+                futures.add(next_future)
+            yield (bounds(index), block)
+
+    def write_block(self, base, overviews, bounds: tuple, block: np.ndarray):
+        """Write a block and its pixels of each overview level"""
+        (row0, row1, col0, col1) = bounds
+        base.write(block, 1, window=Window(
+            col0, row0, col1 - col0, row1 - row0))
+        for (factor, overview) in zip(self.overview_levels, overviews):
+            (overview_row0, rows) = CogWriter.decimate(row0, row1, factor)
+            (overview_col0, cols) = CogWriter.decimate(col0, col1, factor)
+            if len(rows) == 0 or len(cols) == 0:
+                continue
+            overview.write(block[np.ix_(rows, cols)], 1,
+                           window=Window(overview_col0, overview_row0, len(cols), len(rows)))
+
+    def decimate(start: int, stop: int, factor: int):
+        """The overview pixels sampled from source rows (or columns) start..stop-1 - each overview pixel takes
+        the top left source pixel of its factor x factor cell (as GDAL's nearest when the size divides).
+        Returns (first overview index, source indices relative to start)"""
+        first = -(-start // factor)
+        last = -(-stop // factor)
+        return (first, np.arange(first, last) * factor - start)
+
+    def write_vrt(self, raster: DataArray, working_directory: str) -> str:
+        (height, width) = raster.shape
+        with rasterio.open(os.path.join(working_directory, 'base.tif')) as base:
+            crs = base.crs.to_wkt() if base.crs is not None else ''
+            geo_transform = ', '.join(str(value)
+                                      for value in base.transform.to_gdal())
+            data_type = base.profile['dtype']
+        data_type = {'uint8': 'Byte', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32', 'int32': 'Int32',
+                     'float32': 'Float32', 'float64': 'Float64'}[data_type]
+        overview_elements = ''.join(
+            f'<Overview><SourceFilename relativeToVRT="1">overview_{factor}.tif</SourceFilename>'
+            f'<SourceBand>1</SourceBand></Overview>' for factor in self.overview_levels)
+        crs = crs.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        vrt = (f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}"><SRS>{crs}</SRS>'
+               f'<GeoTransform>{geo_transform}</GeoTransform>'
+               f'<VRTRasterBand dataType="{data_type}" band="1"><NoDataValue>{self.nodata}</NoDataValue>'
+               f'<SimpleSource><SourceFilename relativeToVRT="1">base.tif</SourceFilename>'
+               f'<SourceBand>1</SourceBand></SimpleSource>{overview_elements}</VRTRasterBand></VRTDataset>')
+        vrt_path = os.path.join(working_directory, 'raster.vrt')
+        with open(vrt_path, 'w') as vrt_file:
+            vrt_file.write(vrt)
+        return vrt_path
+
+    def upload(self, path: str):
+        """Upload the file to the s3 destination with a multipart upload (aborted on failure)"""
+        (bucket, key) = self.destination[len('s3://'):].split('/', 1)
+        s3 = boto3.client('s3')
+        upload_id = s3.create_multipart_upload(
+            Bucket=bucket, Key=key, ACL=self.acl)['UploadId']
+        try:
+            parts = []
+            with open(path, 'rb') as cog:
+                while True:
+                    data = cog.read(self.part_size)
+                    if len(data) == 0 and len(parts) > 0:
+                        break
+                    part_number = len(parts) + 1
+                    response = s3.upload_part(Body=data, Bucket=bucket, Key=key, UploadId=upload_id,
+                                              PartNumber=part_number)
+                    parts.append(
+                        {'ETag': response['ETag'], 'PartNumber': part_number})
+                    if len(data) < self.part_size:
+                        break
+            s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={'Parts': parts})
+        except Exception:
+            s3.abort_multipart_upload(
+                Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
@@ -14,11 +14,13 @@ class Configuration():
     # channel_raster_location = f'/vsis3/{bucket}/FWDET/SpatialInputs/MDB_channel_depth_SA_SetZero_COG.tif'
     channel_raster_location = f'/vsis3/{bucket}/FWDET/SpatialInputs/MDB_permanent_water_correction.tif'
 
-    input_cache_location = f's3://{bucket}/FWDET/SpatialInputs/FwDET_inputs_v3_4.zarr'
+    input_cache_location = f's3://{bucket}/FWDET/SpatialInputs/FwDET_inputs_v4.zarr'
 
     reporting_time_zone = "Australia/Canberra"
 
     save_file_format_string = r'FwDET_v3_TPS_{image_date}.tif'
     image_date_format_string = f"s3://{bucket}/FWDET/MIM_V3/MIM_WOFS_SnowMasked2_LS9/MIM_WOFS_V3_{{image_date}}_WATER.tif"
+    # MIM rasters converted to zarr chunked to suit the regions (optional - the raster is read if there isn't one)
+    mim_store_format_string = f"s3://{bucket}/FWDET/MIM_V3/zarr/MIM_WOFS_V3_{{image_date}}_WATER.zarr"
 
     output_time_zone = "Australia/Canberra"
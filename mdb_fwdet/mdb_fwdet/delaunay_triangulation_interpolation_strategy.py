@@ -1,17 +1,37 @@
 import numpy as np
-import xarray
+from scipy.interpolate import LinearNDInterpolator
+
+from mdb_fwdet.perimeter_points import PerimeterPoints
 
 
 class DelaunayTriangulationInterpolationStrategy():
     """Interpolate the depth of inundation using delaunay triangulation of perimeter pixels"""
 
-    def __init__(self):
-        pass
+    def __init__(self, rows_per_strip=1024, dtype=np.float64):
+        self.rows_per_strip = rows_per_strip
+        """Number of rows evaluated at a time (limits the size of the coordinate grids)"""
+        self.dtype = dtype
+        """Data type of the interpolated surface (evaluated in float64 a strip at a time) - float32 halves its
+        memory"""
+
+    def interpolate(self, perimeter_points):
+        """Interpolate across the perimeter points (a dense raster of border elevations is also accepted)"""
+        if not isinstance(perimeter_points, PerimeterPoints):
+            perimeter_points = PerimeterPoints.from_dem_extract(
+                perimeter_points)
+        nrow, ncol = perimeter_points.shape
+        # Triangulate in the coordinate space of the raster where it is known
+        x = perimeter_points.x if perimeter_points.x is not None else np.arange(0, ncol)
+        y = perimeter_points.y if perimeter_points.y is not None else np.arange(0, nrow)
+
+        filled = np.full((nrow, ncol), np.nan, dtype=self.dtype)
+        if len(perimeter_points) < 3:
+            return filled
 
-    def interpolate(self, dem_extract):
-        dem_extract = xarray.where(
-            dem_extract == 0, np.nan, dem_extract)
-        dem_extract.rio.write_nodata(np.nan, encoded=True, inplace=True)
-        dem_extract.rio.write_crs(4326, inplace=True)
-        filled = dem_extract.rio.interpolate_na(method='linear')
+        interpolator = LinearNDInterpolator(
+            (x[perimeter_points.cols], y[perimeter_points.rows]), perimeter_points.elevations.astype(np.float64))
+        for row_start in range(0, nrow, self.rows_per_strip):
+            row_end = min(row_start + self.rows_per_strip, nrow)
+            xx, yy = np.meshgrid(x, y[row_start:row_end])
+            filled[row_start:row_end, :] = interpolator(xx, yy)
         return filled
@@ -0,0 +1,114 @@
+import numpy as np
+from scipy import ndimage
+from scipy.spatial import cKDTree
+
+from mdb_fwdet.perimeter_points import PerimeterPoints
+
+
+class EuclideanAllocationInterpolationStrategy():
+    """Cohen's FwDET water surface - each pixel takes the elevation of its nearest perimeter cell (Euclidean
+    allocation by a distance transform) and the allocation is smoothed with a focal filter. The region is
+    processed in blocks with a halo. A pixel whose nearest perimeter cell in its block's window could be beaten by
+    one outside the window is allocated from a KD-tree of every perimeter cell, so the result is the same as
+    transforming the whole region at once (up to the choice between equidistant perimeter cells)"""
+
+    def __init__(self, smoothing='gaussian', sigma=1.0, focal_size=3, block_size=2048, halo=256, dtype=np.float64):
+        if smoothing not in ('gaussian', 'mean', None):
+            raise ValueError(f"Unknown smoothing {smoothing}")
+        self.smoothing = smoothing
+        """Focal filter applied to the allocation - 'gaussian' (as FwdetTask's SMOOTHING mode), 'mean' (Cohen's
+        focal mean) or None"""
+        self.sigma = sigma
+        """Standard deviation (pixels) of the gaussian filter"""
+        self.focal_size = focal_size
+        """Width (pixels) of the window of the mean filter"""
+        self.block_size = block_size
+        """Size of the blocks the region is allocated and smoothed in"""
+        self.halo = halo
+        """Pixels each block's window extends beyond the block (and its smoothing reach) to find perimeter cells"""
+        self.dtype = dtype
+        """Data type of the interpolated surface"""
+
+    def smoothing_reach(self) -> int:
+        """Pixels beyond a block the focal filter reads"""
+        if self.smoothing == 'gaussian':
+            # gaussian_filter is truncated at 4 standard deviations
+            return int(4 * self.sigma + 0.5)
+        if self.smoothing == 'mean':
+            return self.focal_size // 2
+        return 0
+
+    def interpolate(self, perimeter_points):
+        """Interpolate across the perimeter points (a dense raster of border elevations is also accepted)"""
+        if not isinstance(perimeter_points, PerimeterPoints):
+            perimeter_points = PerimeterPoints.from_dem_extract(
+                perimeter_points)
+        (nrow, ncol) = perimeter_points.shape
+        filled = np.full((nrow, ncol), np.nan, dtype=self.dtype)
+        if len(perimeter_points) == 0:
+            return filled
+
+        # the perimeter cells as a raster - the distance transform allocates from it
+        elevations = np.full((nrow, ncol), np.nan, dtype=np.float32)
+        elevations[perimeter_points.rows, perimeter_points.cols] = perimeter_points.elevations
+        tree = None
+        reach = self.smoothing_reach()
+        for row_start in range(0, nrow, self.block_size):
+            for col_start in range(0, ncol, self.block_size):
+                block = (row_start, min(row_start + self.block_size, nrow),
+                         col_start, min(col_start + self.block_size, ncol))
+                # the pixels the filter reads are allocated, from a window extending a halo beyond them
+                smoothed = EuclideanAllocationInterpolationStrategy.extend(block, reach, (nrow, ncol))
+                window = EuclideanAllocationInterpolationStrategy.extend(smoothed, self.halo, (nrow, ncol))
+                (allocated, unresolved) = EuclideanAllocationInterpolationStrategy.allocate(
+                    elevations, window, smoothed, (nrow, ncol))
+                if unresolved.any():
+                    if tree is None:
+                        tree = cKDTree(np.column_stack([perimeter_points.rows, perimeter_points.cols]))
+                    (rows, cols) = np.nonzero(unresolved)
+                    (_, nearest) = tree.query(np.column_stack([rows + smoothed[0], cols + smoothed[2]]))
+                    allocated[rows, cols] = perimeter_points.elevations[nearest]
+                surface = self.smooth(allocated)
+                filled[block[0]:block[1], block[2]:block[3]] = surface[
+                    block[0] - smoothed[0]:block[1] - smoothed[0], block[2] - smoothed[2]:block[3] - smoothed[2]]
+        return filled
+
+    def extend(box: tuple, pixels: int, shape: tuple) -> tuple:
+        """(row0, row1, col0, col1) extended by pixels on every side, within shape"""
+        return (max(box[0] - pixels, 0), min(box[1] + pixels, shape[0]),
+                max(box[2] - pixels, 0), min(box[3] + pixels, shape[1]))
+
+    def allocate(elevations: np.ndarray, window: tuple, target: tuple, shape: tuple):
+        """Elevation of the nearest perimeter cell in the window of each pixel of target (within the window),
+        and which pixels could have a nearer perimeter cell outside the window. Sides of the window at the edge
+        of the region have nothing beyond them"""
+        window_elevations = elevations[window[0]:window[1], window[2]:window[3]]
+        (distances, indices) = ndimage.distance_transform_edt(np.isnan(window_elevations), return_indices=True)
+        target_rows = slice(target[0] - window[0], target[1] - window[0])
+        target_cols = slice(target[2] - window[2], target[3] - window[2])
+        allocated = window_elevations[indices[0][target_rows, target_cols], indices[1][target_rows, target_cols]]
+        distances = distances[target_rows, target_cols]
+        del indices
+
+        # distance from each pixel to the nearest pixel beyond the window (on the sides that aren't the region's)
+        rows = np.arange(target[0], target[1])[:, None]
+        cols = np.arange(target[2], target[3])[None, :]
+        outside = np.full(distances.shape, np.inf)
+        if window[0] > 0:
+            outside = np.minimum(outside, rows - window[0] + 1)
+        if window[1] < shape[0]:
+            outside = np.minimum(outside, window[1] - rows)
+        if window[2] > 0:
+            outside = np.minimum(outside, cols - window[2] + 1)
+        if window[3] < shape[1]:
+            outside = np.minimum(outside, window[3] - cols)
+        # a window without perimeter cells leaves its pixels unallocated (infinitely far)
+        unresolved = (distances > outside) | np.isnan(allocated)
+        return (allocated, unresolved)
+
+    def smooth(self, allocated: np.ndarray) -> np.ndarray:
+        if self.smoothing == 'gaussian':
+            return ndimage.gaussian_filter(allocated, sigma=self.sigma)
+        if self.smoothing == 'mean':
+            return ndimage.uniform_filter(allocated, size=self.focal_size)
+        return allocated
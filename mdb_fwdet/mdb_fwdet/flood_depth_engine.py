@@ -1,24 +1,31 @@
 from xarray import DataArray
-import xarray
 from typing import Dict, List
 from mdb_fwdet.configuration import Configuration
 from mdb_fwdet.fwdet_estimator import FwdetEstimator
 from mdb_fwdet.region import Region
 from mdb_fwdet.region_definition import RegionDefinition
+from mdb_fwdet.region_depth_cache import RegionDepthCache
 from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
 from mdb_fwdet.tps_interpolation_strategy import TpsInterpolationStrategy
 from mdb_fwdet.spatial_input_helper import SpatialInputHelper
+from mdb_fwdet.stage_profiler import StageProfiler
+from mdb_fwdet.static_input_cache import StaticInputCache
 from dask.distributed import wait
+import dask
+import dask.array as da
 import numpy as np
 import logging
 
 class FloodDepthEngine():
     """Calculate flood depths"""
 
-    def __init__(self, spatial_inputs: SpatialFloodExtentInputs, region_definition: RegionDefinition, estimator):
+    def __init__(self, spatial_inputs: SpatialFloodExtentInputs, region_definition: RegionDefinition, estimator,
+                 profiler: StageProfiler = None):
         self.spatial_inputs = spatial_inputs
         self.region_definition = region_definition
         self.estimator = estimator
+        self.profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        """Records the time and memory of the merge (the estimator has its own profiler for the regions)"""
 
     def output_name(image_date):
         save_file_name = Configuration.save_file_format_string.format(
@@ -45,71 +52,166 @@ class FloodDepthEngine():
         return depth_by_region
 
     def merge_results_into_one_raster(self, depth_by_region: Dict[Region, DataArray]):
-        region_template = self.region_definition.region_grid.copy().astype(np.uint16)
-        whole_of_region_depth = region_template.copy()
-        for (region, fwdet) in depth_by_region.items():
-            whole_of_region_depth = FloodDepthEngine.update_in_place(
-                region, fwdet, whole_of_region_depth)
+        with self.profiler.span('merge') as span:
+            region_template = self.region_definition.region_grid.copy().astype(np.uint16)
+            whole_of_region_depth = region_template.copy()
+            for (region, fwdet) in depth_by_region.items():
+                whole_of_region_depth = FloodDepthEngine.update_in_place(
+                    region, fwdet, whole_of_region_depth, region_template)
+            span['array_bytes'] = StageProfiler.array_bytes(whole_of_region_depth)
         return whole_of_region_depth
 
-    def update_in_place(region: Region, fwdet: DataArray, whole_of_region_depth: DataArray):
-        mask_bounds = region.bounding_box
-        whole_of_region_depth[mask_bounds[0]:mask_bounds[1],
-                              mask_bounds[2]:mask_bounds[3]] = fwdet.values
+    def update_in_place(region: Region, fwdet: DataArray, whole_of_region_depth: DataArray, region_template: DataArray = None):
+        """Write the core of the region's depth (where the region grid is the region's label)"""
+        core = region.core_box
+        core_depth = FloodDepthEngine.crop_window(fwdet, region.bounding_box, core)
+        if region_template is not None:
+            in_region = region_template.values[core[0]:core[1], core[2]:core[3]] == region.label
+            core_depth = np.where(in_region, core_depth,
+                                  whole_of_region_depth.values[core[0]:core[1], core[2]:core[3]])
+        whole_of_region_depth[core[0]:core[1], core[2]:core[3]] = core_depth
 
         return whole_of_region_depth
 
-    def calculate_dask(self, client) -> Dict[Region, DataArray]:
+    def calculate_dask(self, client, wait_for_results=True, priority=0, static_input_cache: StaticInputCache = None,
+                       region_depth_cache: RegionDepthCache = None) -> Dict[Region, DataArray]:
+        """Calculate the depth of each region on the cluster. The DEM and channel of each region are held on a worker
+        by the static_input_cache (shared across dates) and the flood extent (usually lazy) is read a window at a
+        time on the worker holding the rest of the region's inputs. Regions found in the region_depth_cache are
+        loaded rather than calculated"""
+        if static_input_cache is None:
+            static_input_cache = StaticInputCache(
+                self.spatial_inputs.dem, self.spatial_inputs.channel)
         depth_by_region: Dict[Region, DataArray] = {}
         for region in self.region_definition.region_bounds:
-            cropped_spatial_inputs = self.spatial_inputs.crop(
-                region)
-            # logging.info(f"dem shape: {cropped_spatial_inputs.dem.shape}")
-            # logging.info(f"mim_array shape: {cropped_spatial_inputs.mim_array.shape}")
-            # logging.info(f"channel shape: {cropped_spatial_inputs.channel.shape}")
-
-            dem = client.scatter(cropped_spatial_inputs.dem)
-            mim_array = client.scatter(cropped_spatial_inputs.mim_array)
-            channel = client.scatter(cropped_spatial_inputs.channel)
-
-            cropped_spatial_inputs = client.scatter(cropped_spatial_inputs)
-
-            region_depth_task = client.submit(self.estimator.calculate,cropped_spatial_inputs, region)
+            (static_inputs, worker) = static_input_cache.get(client, region)
+            mask_bounds = region.bounding_box
+            cropped_mim_array = self.spatial_inputs.mim_array[mask_bounds[0]:mask_bounds[1],
+                                                              mask_bounds[2]:mask_bounds[3]]
+            # the window is read on the worker (the flood extent is lazy), not sent from here
+            mim_array = client.submit(SpatialFloodExtentInputs.read_window, cropped_mim_array, workers=[worker],
+                                      allow_other_workers=True, priority=priority, pure=False)
+
+            if region_depth_cache is None:
+                region_depth_task = client.submit(FloodDepthEngine.calculate_region, self.estimator, static_inputs,
+                                                  mim_array, region, workers=[worker], allow_other_workers=True,
+                                                  priority=priority)
+            else:
+                region_depth_task = client.submit(FloodDepthEngine.calculate_region_cached, self.estimator,
+                                                  static_inputs, mim_array, region, region_depth_cache,
+                                                  region_depth_cache.fingerprint(self.estimator, region),
+                                                  workers=[worker], allow_other_workers=True, priority=priority)
             depth_by_region[region] = region_depth_task
 
-        # Can wait on list (can not wait on generic enumerable such as dictionary.values())
-        wait_results = wait(list(depth_by_region.values()))
+        if wait_for_results:
+            # Can wait on list (can not wait on generic enumerable such as dictionary.values())
+            wait_results = wait(list(depth_by_region.values()))
 
         return depth_by_region
 
-    def merge_results_into_one_raster_dask(self, client, depth_by_region: Dict[Region, DataArray]):
-        region_template = self.region_definition.region_grid.copy().astype(np.uint16)
-        client.scatter(region_template, hash=False)
-        whole_of_region_depth = client.submit(
-            xarray.core.dataarray.DataArray.copy, region_template)
-
-        # logging.info(f'region_template shape = {region_template.shape}')
-        for (region, fwdet) in depth_by_region.items():
-            
-            # logging.info(f'fwdet shape = {client.submit(lambda a: a.shape, fwdet).result()}')
-            
-            whole_of_region_depth = client.submit(FloodDepthEngine.update_in_place_dask,
-                                                  region, fwdet, region_template, whole_of_region_depth)
-            
+    def calculate_region(estimator, static_inputs: tuple, mim_array: DataArray, region: Region) -> DataArray:
+        """Calculate the depth of one region from its cached (dem, channel) and the date's flood extent"""
+        (dem, channel) = static_inputs
+        return estimator.calculate(SpatialFloodExtentInputs(mim_array, dem, channel), region)
+
+    def calculate_region_cached(estimator, static_inputs: tuple, mim_array: DataArray, region: Region,
+                                region_depth_cache: RegionDepthCache, fingerprint: str) -> DataArray:
+        """Load the depth of the region if it is cached for this flood extent, otherwise calculate and cache it"""
+        region_hash = RegionDepthCache.region_hash(mim_array, fingerprint)
+        cached = region_depth_cache.load(region_hash)
+        if cached is not None:
+            (dem, _) = static_inputs
+            (cached_depth, cached_attrs) = cached
+            region_depth = DataArray(cached_depth, coords=dem.coords, dims=dem.dims, attrs=cached_attrs)
+            region_depth.attrs['region'] = region
+        else:
+            region_depth = FloodDepthEngine.calculate_region(
+                estimator, static_inputs, mim_array, region)
+            # the region is restored as it is loaded
+            region_depth_cache.store(region_hash, region_depth.values,
+                                     {name: value for (name, value) in region_depth.attrs.items() if name != 'region'})
+        region_depth.attrs['region_hash'] = region_hash
+        region_depth.attrs['from_cache'] = cached is not None
+        return region_depth
+
+    def merge_results_into_one_raster_dask(self, client, depth_by_region: Dict[Region, DataArray], chunks=4944):
+        """Mosaic the region depths into the region grid. Each block of the output is built independently from
+        the windows of the regions overlapping it (cropped on the workers holding the region depths), so the
+        merge runs in parallel and never copies the whole basin per region. Returns a future of the mosaic"""
+        whole_of_region_depth = client.compute(
+            self.mosaic_dask(client, depth_by_region, chunks))
+
         wait(whole_of_region_depth)
         logging.info(f"Merge status was: {whole_of_region_depth.status}")
         if (whole_of_region_depth.status == 'error'):
             logging.error(whole_of_region_depth.exception())
         return whole_of_region_depth
 
-    def update_in_place_dask(region: Region, fwdet: DataArray, region_template: DataArray, whole_of_region_depth: DataArray):
-        basis = region_template.copy().astype(np.uint16)
-
-        mask_bounds = region.bounding_box
-        basis[mask_bounds[0]:mask_bounds[1],
-                              mask_bounds[2]:mask_bounds[3]] = fwdet.values
-
-        revised_whole_of_region_depth = xarray.where(region_template==region.region_number+1, basis, whole_of_region_depth)
-
-        return revised_whole_of_region_depth
-
+    def mosaic_dask(self, client, depth_by_region: Dict[Region, DataArray], chunks=4944, priority=0) -> DataArray:
+        """Lazy (dask backed) mosaic of the region depths, in blocks of the region grid (chunks is used when
+        the region grid is not already a dask array)"""
+        region_template = self.region_definition.region_grid
+        template = region_template.data
+        if not isinstance(template, da.Array):
+            template = da.from_array(np.asarray(template), chunks=chunks)
+        template = template.astype(np.uint16)
+
+        row_edges = np.cumsum((0,) + template.chunks[0])
+        col_edges = np.cumsum((0,) + template.chunks[1])
+        template_blocks = template.to_delayed()
+        block_rows = []
+        for block_row in range(len(row_edges) - 1):
+            block_row_list = []
+            for block_col in range(len(col_edges) - 1):
+                block_bounds = (row_edges[block_row], row_edges[block_row + 1],
+                                col_edges[block_col], col_edges[block_col + 1])
+                labels = []
+                windows = []
+                window_futures = []
+                for (region, fwdet) in depth_by_region.items():
+                    window = FloodDepthEngine.intersect(
+                        region.core_box, block_bounds)
+                    if window is None:
+                        continue
+                    labels.append(region.label)
+                    windows.append(window)
+                    window_futures.append(client.submit(
+                        FloodDepthEngine.crop_window, fwdet, region.bounding_box, window, priority=priority))
+                block = dask.delayed(FloodDepthEngine.mosaic_block)(
+                    template_blocks[block_row, block_col], block_bounds, labels, windows, *window_futures,
+                    profiler=self.profiler)
+                block_row_list.append(da.from_delayed(
+                    block, shape=(block_bounds[1] - block_bounds[0], block_bounds[3] - block_bounds[2]),
+                    dtype=np.uint16))
+            block_rows.append(block_row_list)
+
+        return DataArray(da.block(block_rows), coords=region_template.coords,
+                         dims=region_template.dims, attrs=region_template.attrs)
+
+    def intersect(bounding_box: tuple, block_bounds: tuple):
+        """The (row0, row1, col0, col1) intersection of two boxes or None if they don't overlap"""
+        window = (max(bounding_box[0], block_bounds[0]), min(bounding_box[1], block_bounds[1]),
+                  max(bounding_box[2], block_bounds[2]), min(bounding_box[3], block_bounds[3]))
+        if window[0] >= window[1] or window[2] >= window[3]:
+            return None
+        return tuple(int(bound) for bound in window)
+
+    def crop_window(fwdet: DataArray, bounding_box: tuple, window: tuple) -> np.ndarray:
+        """The part of a region's depth within a window of the whole grid"""
+        return np.asarray(fwdet.values[window[0] - bounding_box[0]:window[1] - bounding_box[0],
+                                       window[2] - bounding_box[2]:window[3] - bounding_box[2]])
+
+    def mosaic_block(template_block: np.ndarray, block_bounds: tuple, labels: List[int], windows: List[tuple],
+                     *region_windows, profiler: StageProfiler = None) -> np.ndarray:
+        """Write each region's depth (within its core) where the region grid is that region's label. Elsewhere the
+        block keeps the region grid's value"""
+        profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        with profiler.span('merge', block=[int(bound) for bound in block_bounds], regions=len(labels)) as span:
+            block = np.array(template_block, dtype=np.uint16)
+            for (label, window, depth) in zip(labels, windows, region_windows):
+                block_window = (slice(window[0] - block_bounds[0], window[1] - block_bounds[0]),
+                                slice(window[2] - block_bounds[2], window[3] - block_bounds[2]))
+                in_region = template_block[block_window] == label
+                block[block_window][in_region] = depth[in_region]
+            span['array_bytes'] = StageProfiler.array_bytes(block, *region_windows)
+        return block
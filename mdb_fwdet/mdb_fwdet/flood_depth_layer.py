@@ -12,6 +12,7 @@ from mdb_fwdet.fwdet_estimator import FwdetEstimator
 from mdb_fwdet.geotiff_utils import GeotiffUtils
 from mdb_fwdet.region_definition import RegionDefinition
 from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+from mdb_fwdet.stage_profiler import StageProfiler
 
 from dask.distributed import wait
 
@@ -19,13 +20,20 @@ from dask.distributed import wait
 class FloodDepthLayer():
     """A flood depth layer"""
 
-    def __init__(self, image_date: str, spatial_raster_inputs, mdb_region_bounds_list):
+    def __init__(self, image_date: str, spatial_raster_inputs, mdb_region_bounds_list, region_depth_cache=None,
+                 profiler: StageProfiler = None):
         self.image_date = image_date
         self.spatial_raster_inputs = spatial_raster_inputs
         self.mdb_region_bounds_list = mdb_region_bounds_list
+        self.region_depth_cache = region_depth_cache
+        """Reuse the depth of regions whose flood extent is unchanged (None to always recalculate)"""
+        self.profiler = (profiler if profiler is not None else StageProfiler(enabled=False)).with_context(
+            image_date=image_date)
+        """Records the stages of the date - on the workers for the regions, merge and save (see StageProfiler)"""
 
-    def generate(self, client):
-        """Generate a flood depth layer using the dask client"""
+    def generate(self, client, wait_for_regions=True, priority=0):
+        """Generate a flood depth layer using the dask client (without waiting for the regions to be calculated
+        when wait_for_regions is False, e.g. when several dates are in flight)"""
         start_time = time.time()
         logging.info(
             f'1 - starting query for: {self.image_date} - {datetime.now().astimezone(pytz.timezone(Configuration.output_time_zone))}')
@@ -37,36 +45,49 @@ class FloodDepthLayer():
         
         interpolation_strategy = TpsInterpolationStrategy()
         fwdet_estimator = FwdetEstimator(interpolation_strategy)
+        fwdet_estimator.profiler = self.profiler
 
-        mim_input = SpatialFloodExtentInputs.load_mim_input(self.image_date)
-        spatial_inputs = self.spatial_raster_inputs.get_spatial_flood_extents(
-            mim_input)
+        with self.profiler.span('load_inputs'):
+            mim_input = SpatialFloodExtentInputs.load_mim_input(self.image_date)
+            spatial_inputs = self.spatial_raster_inputs.get_spatial_flood_extents(
+                mim_input)
 
         flood_depth_engine = FloodDepthEngine(
             spatial_inputs,
             regions,
-            fwdet_estimator)
+            fwdet_estimator,
+            self.profiler)
 
-        result_list = flood_depth_engine.calculate_dask(client)
+        with self.profiler.span('submit_regions', regions=len(self.mdb_region_bounds_list),
+                                wait_for_regions=wait_for_regions):
+            result_list = flood_depth_engine.calculate_dask(
+                client, wait_for_results=wait_for_regions, priority=priority,
+                static_input_cache=self.spatial_raster_inputs.static_input_cache,
+                region_depth_cache=self.region_depth_cache)
 
         elapsed_time = time.time() - start_time
         new_start_time = time.time()
         logging.info(
             f'2 - running calculate_dask for: {self.image_date} -  {time.strftime("%H:%M:%S", gmtime(elapsed_time))}')
 
-        self.whole_of_region_depth_future = flood_depth_engine.merge_results_into_one_raster_dask(client,
-                                                                                                  result_list)
+        # lazy - the blocks of the mosaic are computed as they are written by save
+        self.whole_of_region_depth = flood_depth_engine.mosaic_dask(
+            client, result_list, priority=priority)
 
         elapsed_time = time.time() - new_start_time
         logging.info(
-            f'3 - running merge_results_into_one_raster for: {self.image_date} -  {time.strftime("%H:%M:%S", gmtime(elapsed_time))}')
+            f'3 - running mosaic_dask for: {self.image_date} -  {time.strftime("%H:%M:%S", gmtime(elapsed_time))}')
 
-    def save(self, client, bucket: str, prefix: str, save_file_format_string: str):
-        """Save the flood depth layer to the selected location on s3 based on bucket/prefix & format strings"""
+    def save(self, client, bucket: str, prefix: str, save_file_format_string: str, wait_for_save=True, priority=0):
+        """Save the flood depth layer to the selected location on s3 based on bucket/prefix & format strings.
+        Returns the future of the save"""
         start_time = time.time()
         result = GeotiffUtils.save_geotiff(
-            client, self.whole_of_region_depth_future, bucket, prefix, save_file_format_string.format(image_date = self.image_date))
-        wait(result)
-        elapsed_time = time.time() - start_time
-        logging.info(
-            f'4 - running save for: {self.image_date} -  {time.strftime("%H:%M:%S", gmtime(elapsed_time))}')
+            client, self.whole_of_region_depth, bucket, prefix, save_file_format_string.format(image_date = self.image_date), priority,
+            self.profiler)
+        if wait_for_save:
+            wait(result)
+            elapsed_time = time.time() - start_time
+            logging.info(
+                f'4 - running save for: {self.image_date} -  {time.strftime("%H:%M:%S", gmtime(elapsed_time))}')
+        return result
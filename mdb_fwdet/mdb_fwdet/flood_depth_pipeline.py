@@ -0,0 +1,102 @@
+import logging
+import time
+from time import gmtime
+from typing import Dict, List
+
+from dask.distributed import wait
+
+from mdb_fwdet.flood_depth_engine import FloodDepthEngine
+from mdb_fwdet.flood_depth_layer import FloodDepthLayer
+from mdb_fwdet.region import Region
+from mdb_fwdet.region_depth_cache import RegionDepthCache
+from mdb_fwdet.spatial_input_helper import SpatialInputHelper
+from mdb_fwdet.stage_profiler import StageProfiler
+
+
+class FloodDepthPipeline():
+    """Generate and save the flood depth layers of many dates, keeping several dates in flight so loading,
+    region estimation, merging and saving overlap across dates. The static inputs (DEM, channel and regions)
+    are shared by every date. Earlier dates have a higher priority so they finish (and release their memory)
+    first, and no more than max_dates_in_flight dates are submitted at once.
+
+    Usage:
+        pipeline = FloodDepthPipeline(spatial_raster_inputs, mdb_region_bounds_list, Configuration.bucket,
+                                      Configuration.prefix, Configuration.save_file_format_string)
+        pipeline.run(client, BimonthTimeRange(start, end).full_date_range, s3)
+    """
+
+    def __init__(self, spatial_raster_inputs: SpatialInputHelper, mdb_region_bounds_list: List[Region],
+                 bucket: str, prefix: str, save_file_format_string: str, max_dates_in_flight=3,
+                 region_depth_cache: RegionDepthCache = None, profiler: StageProfiler = None):
+        self.spatial_raster_inputs = spatial_raster_inputs
+        self.mdb_region_bounds_list = mdb_region_bounds_list
+        self.bucket = bucket
+        self.prefix = prefix
+        self.save_file_format_string = save_file_format_string
+        self.max_dates_in_flight = max_dates_in_flight
+        """Upper bound on the number of dates submitted to the cluster at once (caps memory in flight)"""
+        self.region_depth_cache = region_depth_cache
+        """Reuse the depth of regions whose flood extent is unchanged (None to always recalculate)"""
+        self.profiler = profiler
+        """Records the stages of every region and date (None to not record them)"""
+
+    def submit(self, client, image_date: str, priority: int):
+        """Submit the generation and save of one date. Returns the layer and the future of its save (the layer
+        holds the futures of the regions so it must be kept until the save is done)"""
+        flood_depth_layer = FloodDepthLayer(
+            image_date, self.spatial_raster_inputs, self.mdb_region_bounds_list, self.region_depth_cache,
+            self.profiler)
+        flood_depth_layer.generate(
+            client, wait_for_regions=False, priority=priority)
+        save_future = flood_depth_layer.save(client, self.bucket, self.prefix, self.save_file_format_string,
+                                             wait_for_save=False, priority=priority)
+        return (flood_depth_layer, save_future)
+
+    def run(self, client, image_dates: List[str], s3=None) -> Dict[str, str]:
+        """Generate and save the layer of every date (skipping those already saved when s3 is given). Returns the
+        status of each date - 'finished', 'error' or 'skipped'"""
+        very_start_time = time.time()
+        status_by_date: Dict[str, str] = {}
+        in_flight = {}
+        for (index, image_date) in enumerate(image_dates):
+            if s3 is not None and FloodDepthEngine.output_exists(s3, image_date):
+                logging.info(f"Exists already - skipping: {image_date}")
+                status_by_date[image_date] = 'skipped'
+                continue
+
+            while len(in_flight) >= self.max_dates_in_flight:
+                self.wait_for_any(in_flight, status_by_date)
+
+            try:
+                (flood_depth_layer, future) = self.submit(
+                    client, image_date, priority=-index)
+            except Exception:
+                logging.exception(f"Failed to submit: {image_date}")
+                status_by_date[image_date] = 'error'
+                continue
+            in_flight[future] = (image_date, time.time(), flood_depth_layer)
+            logging.info(
+                f"Submitted: {image_date} ({len(in_flight)} dates in flight)")
+
+        while len(in_flight) > 0:
+            self.wait_for_any(in_flight, status_by_date)
+
+        elapsed_time = time.time() - very_start_time
+        logging.info(
+            f'Total time for pipeline of {len(image_dates)} dates -  {time.strftime("%H:%M:%S", gmtime(elapsed_time))}')
+        return {image_date: status_by_date[image_date] for image_date in image_dates if image_date in status_by_date}
+
+    def wait_for_any(self, in_flight: dict, status_by_date: Dict[str, str]):
+        """Wait until at least one of the dates in flight is done and record it"""
+        (done, _) = wait(list(in_flight.keys()), return_when="FIRST_COMPLETED")
+        for future in done:
+            (image_date, start_time, _) = in_flight.pop(future)
+            status_by_date[image_date] = future.status
+            elapsed_time = time.time() - start_time
+            if future.status == 'error':
+                logging.error(
+                    f"Failed to produce: {image_date} - {future.exception()}")
+            else:
+                logging.info(
+                    f'Total time for: {image_date} -  {time.strftime("%H:%M:%S", gmtime(elapsed_time))}')
+            future.release()
@@ -1,25 +1,43 @@
+from mdb_fwdet.lattice_upsampler import LatticeUpsampler
+from mdb_fwdet.perimeter_points import PerimeterPoints
 from mdb_fwdet.region import Region
 from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+from mdb_fwdet.stage_profiler import StageProfiler
 import numpy as np
+import logging
 import time
 import rioxarray
 import dask.array as da
-from dask_image import ndmorph
 import xarray
 
 
 class FwdetEstimator():
     """Estimate the flood depth across a floodplain using Cohen's FwDET"""
 
-    def __init__(self, interpolation_strategy):
+    def __init__(self, interpolation_strategy, chunked=False, chunks=2048, dtype=np.float64, pack_masks=False):
         self.interpolation_strategy = interpolation_strategy
         """Method for interpolating between points on the perimeter of flooded areas"""
         self.verbose = False
         """Print debugging information"""
-
+        self.chunked = chunked
+        """Run border extraction, masking, channel addition and encoding as one blockwise dask graph"""
+        self.chunks = chunks
+        """Chunk size applied to numpy backed inputs when running chunked (and rows encoded at a time otherwise)"""
+        self.dtype = dtype
+        """Data type the water surface, DEM and channel are held in across the region. float64 encodes exactly as
+        the original. float32 (with a float32 surface from the interpolation strategy) halves their memory - the
+        depth is still encoded a block at a time in float64, but a float32 surface can round a depth to the next mm
+        where it is within float32 rounding (about 0.01mm at 150m) of half a mm"""
+        self.pack_masks = pack_masks
+        """Hold the wet and dry masks of the region as packed bits (1 bit per pixel each) instead of the flood extent"""
+        self.profiler = StageProfiler(enabled=False)
+        """Records the time and memory of each stage of each region (see StageProfiler)"""
 
     def calculate(self, spatial_flood_extent_inputs: SpatialFloodExtentInputs, region: Region) -> xarray.DataArray:
         """Calculate flood depth"""
+        if self.chunked:
+            return self.calculate_chunked(spatial_flood_extent_inputs, region)
+
         self.spatial_flood_extent_inputs = spatial_flood_extent_inputs
         """Spatial inputs to fwdet - flood extent, dem, etc."""
 
@@ -28,86 +46,176 @@ class FwdetEstimator():
         if self.verbose:
             print("Calculating FwDET...")
 
-        wet = da.where(spatial_flood_extent_inputs.mim_array ==
-                       SpatialFloodExtentInputs.WOFS_WET_VALUE, 1, 0)
-        nodata = da.where(
-            spatial_flood_extent_inputs.mim_array == SpatialFloodExtentInputs.WOFS_NODATA_VALUE, 1, 0)
-
-        # ## Extract raster boundaries (code from Jin)
+        # ## Extract raster boundaries and the DEM values along them (code from Jin)
         if self.verbose:
-            print("Extracting mim extent boundaries...")
-        structure1 = np.ones((3, 3))
-
-        bufferred = ndmorph.binary_dilation(
-            wet, structure=structure1).astype(np.int8)
-        border = bufferred - wet - nodata
-        #border = da.where(border == 1, 1, 0).astype(np.int8)
-        border = da.where(border == 1, 1, 0)
-        # clean memory for next steps
-        del bufferred, nodata, wet
+            print("Extracting perimeter points...")
+        region_number = FwdetEstimator.region_number(region)
+        with self.profiler.span('border_extraction', region=region_number) as span:
+            perimeter_points = PerimeterPoints.from_flood_extent(
+                spatial_flood_extent_inputs.mim_array, spatial_flood_extent_inputs.dem, self.chunks)
+            span['array_bytes'] = StageProfiler.array_bytes(
+                spatial_flood_extent_inputs.mim_array, spatial_flood_extent_inputs.dem)
+            span['perimeter_points'] = len(perimeter_points)
         if self.verbose:
+            print(f"{len(perimeter_points)} perimeter points")
             print("--- %s seconds ---" % round(time.time() - start_time))
             start_time = time.time()
 
-        # # ## Extract DEM values using the outline (code from Jin)
+        # Intetpolation using linear interpolation
         if self.verbose:
-            print("Extracting dem values for boundary outline...")
+            print("Interpolating...")
 
-        dem_extract = border * \
-            spatial_flood_extent_inputs.dem
+        with self.profiler.span('interpolation', region=region_number,
+                                strategy=type(self.interpolation_strategy).__name__) as span:
+            span['perimeter_points'] = len(perimeter_points)
+            filled = np.asarray(self.interpolation_strategy.interpolate(perimeter_points), dtype=self.dtype)
+            span['array_bytes'] = filled.nbytes
+            interpolation_parameters = self.interpolation_parameters()
+            span.update(interpolation_parameters or {})
+        del perimeter_points
 
-        # clean memory for next steps
-        del border,  # dem
         if self.verbose:
             print("--- %s seconds ---" % round(time.time() - start_time))
             start_time = time.time()
 
-        # Intetpolation using linear interpolation
+        # Subtract the ground elevation from the interpolated water surface, add the channel depth and encode
+        # as mm - a block of rows at a time so only the uint16 result is the size of the region
         if self.verbose:
-            print("Interpolating...")
-
-        filled = self.interpolation_strategy.interpolate(dem_extract)
-        del dem_extract
+            print("Subtracting dem, adding channel depth and encoding...")
+        template = spatial_flood_extent_inputs.dem
+        # the subtraction, channel addition and encoding are fused block by block so are timed together
+        with self.profiler.span('encode', region=region_number) as span:
+            dem = np.asarray(template, dtype=self.dtype)
+            channel = np.asarray(spatial_flood_extent_inputs.channel, dtype=self.dtype)
+            masks = FwdetEstimator.flood_masks(spatial_flood_extent_inputs.mim_array, self.chunks, self.pack_masks)
+            (nrow, ncol) = filled.shape
+            water_depth = np.empty((nrow, ncol), dtype=np.uint16)
+            for row_start in range(0, nrow, self.chunks):
+                rows = slice(row_start, min(row_start + self.chunks, nrow))
+                (wet, dry) = FwdetEstimator.mask_rows(masks, rows, ncol)
+                water_depth[rows] = FwdetEstimator.encode_masked(filled[rows], dem[rows], wet, dry, channel[rows])
+            span['array_bytes'] = StageProfiler.array_bytes(filled, dem, channel, water_depth)
+        del filled, dem, channel, masks
 
         if self.verbose:
             print("--- %s seconds ---" % round(time.time() - start_time))
-            start_time = time.time()
+            print("Completed.")
 
-        # Subtracting ground elevation from interpolated flood water surface elevation
-        # Interpolated floodwater elevation minus DEM
-        if self.verbose:
-            print("Subtracting dem...")
-        water_depth = filled - spatial_flood_extent_inputs.dem
-        wet = da.where(spatial_flood_extent_inputs.mim_array ==
-                       SpatialFloodExtentInputs.WOFS_WET_VALUE, 1, 0)
-        dry = da.where(spatial_flood_extent_inputs.mim_array ==
-                       SpatialFloodExtentInputs.WOFS_DRY_VALUE, 1, 0)
-        water_depth = xarray.where(wet == 1, water_depth, np.nan)
-        del filled, spatial_flood_extent_inputs.dem, wet
+        water_depth = xarray.DataArray(water_depth, coords=template.coords, dims=template.dims)
+        water_depth.attrs['region'] = region
+        if interpolation_parameters is not None:
+            water_depth.attrs['interpolation_parameters'] = interpolation_parameters
+        return water_depth
+
+    def interpolation_parameters(self) -> dict:
+        """The lumping etc. the strategy used for the region just interpolated (None if it doesn't record them)"""
+        parameters = getattr(self.interpolation_strategy, 'last_interpolation_parameters', None)
+        return dict(parameters) if parameters is not None else None
+
+    def region_number(region):
+        """The region's number for the profiler (None if calculate was given something other than a Region)"""
+        return region.region_number if isinstance(region, Region) else None
+
+    def flood_masks(mim_array, rows_per_block=2048, pack_masks=False):
+        """The flood extent as is - or, when pack_masks is set, its wet and dry masks bit-packed along the rows.
+        mask_rows gets the boolean masks of a block of rows from either"""
+        mim = np.asarray(mim_array)
+        if not pack_masks:
+            return (mim, None)
+        wet = np.empty((mim.shape[0], -(-mim.shape[1] // 8)), dtype=np.uint8)
+        dry = np.empty_like(wet)
+        for row_start in range(0, mim.shape[0], rows_per_block):
+            rows = slice(row_start, min(row_start + rows_per_block, mim.shape[0]))
+            wet[rows] = np.packbits(mim[rows] == SpatialFloodExtentInputs.WOFS_WET_VALUE, axis=1)
+            dry[rows] = np.packbits(mim[rows] == SpatialFloodExtentInputs.WOFS_DRY_VALUE, axis=1)
+        return (wet, dry)
+
+    def mask_rows(masks, rows: slice, ncol: int):
+        """The (wet, dry) boolean masks of a block of rows from flood_masks"""
+        (wet, dry) = masks
+        if dry is None:
+            mim = wet[rows]
+            return (mim == SpatialFloodExtentInputs.WOFS_WET_VALUE, mim == SpatialFloodExtentInputs.WOFS_DRY_VALUE)
+        return (np.unpackbits(wet[rows], axis=1, count=ncol).view(bool),
+                np.unpackbits(dry[rows], axis=1, count=ncol).view(bool))
+
+    def calculate_chunked(self, spatial_flood_extent_inputs: SpatialFloodExtentInputs, region: Region) -> xarray.DataArray:
+        """Calculate flood depth with a blockwise dask graph - only the perimeter points are gathered
+        into one place (for the interpolation), everything else is evaluated chunk by chunk. Strategies without
+        interpolate_lattice (e.g. Delaunay) still build the whole surface in one place (a warning is logged)"""
+        start_time = time.time()
+
+        mim = PerimeterPoints.as_dask_array(
+            spatial_flood_extent_inputs.mim_array, self.chunks)
+        # the border elevations are taken from the DEM as it is (as when not chunked), with the coordinates
+        source_dem = spatial_flood_extent_inputs.dem.copy(
+            data=PerimeterPoints.as_dask_array(spatial_flood_extent_inputs.dem, mim.chunks))
+        dem = source_dem.data.astype(self.dtype)
+        channel = PerimeterPoints.as_dask_array(
+            spatial_flood_extent_inputs.channel, mim.chunks).astype(self.dtype)
 
         if self.verbose:
+            print("Extracting perimeter points...")
+        region_number = FwdetEstimator.region_number(region)
+        with self.profiler.span('border_extraction', region=region_number) as span:
+            perimeter_points = PerimeterPoints.from_flood_extent(
+                mim, source_dem, chunks=mim.chunks)
+            span['array_bytes'] = StageProfiler.array_bytes(mim, dem)
+            span['perimeter_points'] = len(perimeter_points)
+        if self.verbose:
+            print(f"{len(perimeter_points)} perimeter points")
             print("--- %s seconds ---" % round(time.time() - start_time))
             start_time = time.time()
 
         if self.verbose:
-            print("Adding channel depth...")
-        spatial_flood_extent_inputs.channel = xarray.where(
-            np.isnan(spatial_flood_extent_inputs.channel), 0, spatial_flood_extent_inputs.channel)
-        water_depth = xarray.where(
-            ~np.isnan(water_depth), water_depth + spatial_flood_extent_inputs.channel, np.nan)
-        del spatial_flood_extent_inputs.channel
-        water_depth = xarray.where(
-            water_depth <= 0, 0.001, water_depth)  # minimum depth = 1
-        water_depth = xarray.where(
-            water_depth > 65.534, 65.534, water_depth)  # maximum depth = 65534
-        water_depth = xarray.where(
-            np.isnan(water_depth), 65.535, water_depth)  # nodata = 65535
-        water_depth = xarray.where(dry == 1, 0, water_depth)  # dry = 0
-        water_depth = np.rint(water_depth*1000).astype(np.uint16)
-
+            print("Interpolating...")
+        with self.profiler.span('interpolation', region=region_number,
+                                strategy=type(self.interpolation_strategy).__name__) as span:
+            span['perimeter_points'] = len(perimeter_points)
+            if hasattr(self.interpolation_strategy, 'interpolate_lattice'):
+                # upsample chunk by chunk, only the lattice is held in memory
+                (lattice, lattice_values) = self.interpolation_strategy.interpolate_lattice(
+                    perimeter_points)
+                filled = LatticeUpsampler(lattice, self.interpolation_strategy.upsampling_method,
+                                          dtype=self.dtype).upsample_dask(
+                    lattice_values, mim.chunks)
+                span['array_bytes'] = StageProfiler.array_bytes(lattice_values)
+            else:
+                logging.warning(f"{type(self.interpolation_strategy).__name__} interpolates the whole region in "
+                                f"one place - only strategies with interpolate_lattice are evaluated chunk by chunk")
+                filled = da.from_array(np.asarray(
+                    self.interpolation_strategy.interpolate(perimeter_points), dtype=self.dtype), chunks=mim.chunks)
+                span['array_bytes'] = StageProfiler.array_bytes(filled)
+            interpolation_parameters = self.interpolation_parameters()
+            span.update(interpolation_parameters or {})
+        del perimeter_points
         if self.verbose:
             print("--- %s seconds ---" % round(time.time() - start_time))
-            print("Completed.")
 
+        water_depth = da.map_blocks(FwdetEstimator.encode_block, filled, dem, mim, channel,
+                                    dtype=np.uint16)
+
+        template = spatial_flood_extent_inputs.dem
+        water_depth = xarray.DataArray(
+            water_depth, coords=template.coords, dims=template.dims)
         water_depth.attrs['region'] = region
+        if interpolation_parameters is not None:
+            water_depth.attrs['interpolation_parameters'] = interpolation_parameters
         return water_depth
+
+    def encode_block(filled, dem, mim, channel):
+        """Convert the interpolated water surface of a block to depth in mm (uint16).
+        0 is dry, 65535 is nodata, wet cells are clamped to 1..65534"""
+        return FwdetEstimator.encode_masked(filled, dem, mim == SpatialFloodExtentInputs.WOFS_WET_VALUE,
+                                            mim == SpatialFloodExtentInputs.WOFS_DRY_VALUE, channel)
+
+    def encode_masked(filled, dem, wet, dry, channel):
+        """encode_block with the flood extent as boolean wet and dry masks"""
+        water_depth = filled.astype(np.float64) - dem
+        water_depth[~wet] = np.nan
+        water_depth += np.where(np.isnan(channel), 0, channel)
+        water_depth[water_depth <= 0] = 0.001  # minimum depth = 1
+        water_depth[water_depth > 65.534] = 65.534  # maximum depth = 65534
+        water_depth[np.isnan(water_depth)] = 65.535  # nodata = 65535
+        water_depth[dry] = 0  # dry = 0
+        return np.rint(water_depth*1000).astype(np.uint16)
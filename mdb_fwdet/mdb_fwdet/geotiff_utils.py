@@ -1,13 +1,15 @@
 from typing import Union
-from dask import delayed
 from boto3 import client
 from datacube.utils.aws import configure_s3_access
+import dask.array as da
 import rioxarray
-from datacube.utils.cog import to_cog
 from xarray import DataArray
-from dask.distributed import Client
+from dask.distributed import Client, worker_client
 from distributed.client import Future
 
+from mdb_fwdet.cog_writer import CogWriter
+from mdb_fwdet.stage_profiler import StageProfiler
+
 
 class GeotiffUtils():
     """GeotiffUtils provides extensions/helpers for exporting DaskArrays to s3"""
@@ -25,12 +27,28 @@ class GeotiffUtils():
         geoboxed_raster = assign_crs(bandless)
         return geoboxed_raster
 
-    def save_geotiff(client: Client, floodwater_depth_array: Union[DataArray, Future], bucket_name: str, key_prefix: str, save_file_name: str):
-        s3write_delayed = delayed(GeotiffUtils.s3write)
-        add_georef_delayed = delayed(GeotiffUtils.add_georef)
+    def save_geotiff(client: Client, floodwater_depth_array: Union[DataArray, Future], bucket_name: str, key_prefix: str, save_file_name: str, priority=0,
+                     profiler: StageProfiler = None):
+        return GeotiffUtils.save_cog(client, floodwater_depth_array, f"s3://{bucket_name}/{key_prefix}/{save_file_name}", priority,
+                                     profiler)
+
+    def save_cog(client: Client, raster: Union[DataArray, Future], destination: str, priority=0,
+                 profiler: StageProfiler = None):
+        """Write the raster to a COG at destination (a local path or s3://bucket/key) on a worker. The blocks of a
+        dask backed raster are streamed to the file as they are computed. Returns a future of the destination"""
+        return client.submit(GeotiffUtils.write_cog, raster, destination, pure=False, priority=priority,
+                             profiler=profiler)
 
-        georef_result = add_georef_delayed(floodwater_depth_array)
-        dl = s3write_delayed(to_cog(georef_result, nodata=65535),
-                                          bucket_name, key_prefix + "/" + save_file_name)
-        result = client.compute(dl, fifo_timeout=0)
-        return result
+    def write_cog(raster: DataArray, destination: str, nodata=65535, profiler: StageProfiler = None):
+        profiler = profiler if profiler is not None else StageProfiler(enabled=False)
+        # a lazy raster's blocks (the merge) are computed as they are written so are included
+        with profiler.span('save', destination=destination) as span:
+            if destination.startswith('s3://'):
+                configure_s3_access()
+            georef_raster = GeotiffUtils.add_georef(raster)
+            cog_writer = CogWriter(destination, nodata=nodata)
+            span['array_bytes'] = StageProfiler.array_bytes(georef_raster)
+            if isinstance(georef_raster.data, da.Array):
+                with worker_client() as dask_client:
+                    return cog_writer.write(georef_raster, dask_client)
+            return cog_writer.write(georef_raster)
@@ -0,0 +1,103 @@
+import logging
+
+from mdb_fwdet.lumped_lattice import LumpedLattice
+from mdb_fwdet.perimeter_points import PerimeterPoints
+
+
+class InterpolationBudget():
+    """Choose the lumping (averaging_constant) and RBF neighbors of a region from its size and perimeter points
+    so the interpolation fits a time and memory budget. The configured averaging_constant is the finest lumping
+    and the configured neighbors the most neighbors used - fewer neighbors are tried first (they cost less
+    accuracy, see benchmarks/accuracy_sweep.py), then coarser lumping, until the estimated cost fits.
+
+    The costs are estimates from a simple model of each strategy (the constants are rough timings and can be
+    recalibrated from the benchmark suite on the cluster's workers).
+
+    Usage:
+        budget = InterpolationBudget(max_seconds=120, max_memory_bytes=4 * 1024 ** 3)
+        interpolation_strategy = TpsInterpolationStrategy(averaging_constant=60, neighbors=100, budget=budget)
+    """
+
+    def __init__(self, max_seconds=300, max_memory_bytes=4 * 1024 ** 3, max_averaging_constant=960,
+                 min_neighbors=50, step=2 ** 0.5, seconds_per_tps_operation=3e-8, seconds_per_flop=1e-9):
+        self.max_seconds = max_seconds
+        """Estimated interpolation time allowed per region"""
+        self.max_memory_bytes = max_memory_bytes
+        """Estimated interpolation memory allowed per region (beyond the region's inputs and output)"""
+        self.max_averaging_constant = max_averaging_constant
+        """Coarsest lumping tried"""
+        self.min_neighbors = min_neighbors
+        """Fewest RBF neighbors tried (the neighborhoods of fewer lumped points along a narrow channel can be
+        collinear, which the thin plate spline can't be fitted to)"""
+        self.step = step
+        """Factor between the lumping sizes tried (the neighbors are halved)"""
+        self.seconds_per_tps_operation = seconds_per_tps_operation
+        """Time per lattice node per neighbor squared of the neighborhood TPS (scipy RBFInterpolator)"""
+        self.seconds_per_flop = seconds_per_flop
+        """Time per floating point operation of the dense linear algebra (kriging and the global TPS)"""
+
+    def averaging_constants(self, averaging_constant: int) -> list:
+        """Lumping sizes tried - from the configured one up to max_averaging_constant"""
+        sizes = [averaging_constant]
+        while sizes[-1] < self.max_averaging_constant:
+            sizes.append(min(max(int(round(sizes[-1] * self.step)), sizes[-1] + 1), self.max_averaging_constant))
+        return sizes
+
+    def neighbor_counts(self, neighbors, lumped_points: int) -> list:
+        """Neighbors tried - halved from the configured number (None, all the points, is tried first as is)"""
+        if neighbors is None:
+            return [None] + self.neighbor_counts(lumped_points, lumped_points)
+        counts = [min(neighbors, lumped_points)]
+        while counts[-1] // 2 >= self.min_neighbors:
+            counts.append(counts[-1] // 2)
+        return counts
+
+    def choose(self, perimeter_points: PerimeterPoints, averaging_constant: int, neighbors, cost,
+               adapt_neighbors=True) -> dict:
+        """The finest lumping (with the most neighbors) whose estimated cost fits the budget - or the cheapest
+        tried if none does. cost(budget, lattice_nodes, lumped_points, neighbors) is (seconds, bytes). Returns
+        the choice and the estimates it was made with (only the lumping is chosen without adapt_neighbors)"""
+        choice = None
+        for size in self.averaging_constants(averaging_constant):
+            lattice = LumpedLattice(perimeter_points.shape, size)
+            lumped_points = lattice.occupied_count(perimeter_points)
+            counts = self.neighbor_counts(neighbors, lumped_points) if adapt_neighbors else [neighbors]
+            for count in counts:
+                (seconds, memory_bytes) = cost(self, lattice.node_count(), lumped_points, count)
+                choice = {'averaging_constant': size, 'perimeter_points': len(perimeter_points),
+                          'lumped_points': lumped_points, 'lattice_nodes': lattice.node_count(),
+                          'estimated_seconds': float(seconds), 'estimated_bytes': int(memory_bytes),
+                          'within_budget': bool(seconds <= self.max_seconds and memory_bytes <= self.max_memory_bytes)}
+                if adapt_neighbors:
+                    choice['neighbors'] = count
+                if choice['within_budget']:
+                    return choice
+        logging.warning(f"No lumping fits the budget - using {choice}")
+        return choice
+
+    def tps_cost(self, lattice_nodes: int, lumped_points: int, neighbors) -> tuple:
+        """TPS with scipy's RBFInterpolator. With neighbors each lattice node solves (or shares) a system of its
+        neighbors, and the neighbors of every node are queried at once (8 byte index and distance each).
+        Without, the whole system is solved once and the lattice evaluated against every point"""
+        if neighbors is None:
+            return (self.seconds_per_flop * (lumped_points ** 3 / 3 + 2 * lattice_nodes * lumped_points),
+                    8 * (lumped_points ** 2 + lattice_nodes * min(lumped_points, 1000) + 3 * lattice_nodes))
+        return (self.seconds_per_tps_operation * lattice_nodes * neighbors ** 2,
+                8 * (2 * lattice_nodes * neighbors + neighbors ** 2 + 3 * lattice_nodes))
+
+    def exact_kriging_cost(self, lattice_nodes: int, lumped_points: int, neighbors=None) -> tuple:
+        """GaussianProcessRegressor - the covariance matrix is factorised for each step of the hyper-parameter
+        fit (about 20), and the covariance of the lattice with every point is held for the prediction"""
+        return (self.seconds_per_flop * (20 * lumped_points ** 3 / 3 + 2 * lattice_nodes * lumped_points),
+                8 * (3 * lumped_points ** 2 + lattice_nodes * lumped_points + 3 * lattice_nodes))
+
+    def local_kriging_cost(self, lattice_nodes: int, lumped_points: int, neighbors=None, tile_size=32,
+                           max_points_per_tile=1500, max_fit_points=1000) -> tuple:
+        """LocalKrigingEngine - a fit on a subsample, then each tile of the lattice kriged from (at most)
+        max_points_per_tile points"""
+        points_per_tile = min(lumped_points, max_points_per_tile)
+        fit_points = min(lumped_points, max_fit_points)
+        tiles = -(-lattice_nodes // (tile_size * tile_size))
+        return (self.seconds_per_flop * (20 * fit_points ** 3 / 3 +
+                                         tiles * (points_per_tile ** 3 / 3 + 2 * tile_size ** 2 * points_per_tile)),
+                8 * (3 * max(fit_points, points_per_tile) ** 2 + tile_size ** 2 * points_per_tile + 3 * lattice_nodes))
@@ -1,49 +1,66 @@
-import numpy
-import pandas
-from scipy import interpolate
 from sklearn.gaussian_process.kernels import RBF
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.linear_model import LinearRegression
 
+from mdb_fwdet.interpolation_budget import InterpolationBudget
+from mdb_fwdet.lattice_upsampler import LatticeUpsampler
+from mdb_fwdet.local_kriging_engine import LocalKrigingEngine
+from mdb_fwdet.lumped_lattice import LumpedLattice
+from mdb_fwdet.perimeter_points import PerimeterPoints
+
 
 class KrigingInterpolationStrategy():
     """Strategy for interpolating across perimeter of wet polygons using ordinary kriging"""
 
-    def __init__(self, averaging_constant=60) -> None:
+    def __init__(self, averaging_constant=60, engine='exact', budget: InterpolationBudget = None, **engine_options) -> None:
         self.averaging_constant = averaging_constant
         """averaging constant is the area to assume low surface water elevation difference. For
         example 60 for 25m resolution product or 300 for 5m resolution product"""
+        if engine not in ('exact', 'local'):
+            raise ValueError(f"Unknown kriging engine {engine}")
+        self.engine = engine
+        """'exact' fits a GaussianProcessRegressor to all the residuals (cubic in the number of lumped
+        perimeter points). 'local' kriges tiles of the lattice from their KD-tree neighbourhood (see
+        LocalKrigingEngine) which scales to regions with many perimeter points"""
+        self.engine_options = engine_options
+        """Keyword arguments for LocalKrigingEngine (tile_size, search_radius, max_points_per_tile...)"""
+        self.upsampling_method = 'nearest'
+        """How the lattice is upsampled to the pixels of the region (see LatticeUpsampler)"""
+        self.budget = budget
+        """Chooses a coarser lumping for regions that would exceed it (None always uses averaging_constant)"""
+        self.last_interpolation_parameters = None
+        """The lumping used for the last region interpolated"""
 
-    def interpolate(self, dem_extract):
-        """Interpolate - 
-        note: for memory reasons this has the side-effect of deleting dem_extract """
-        nrow, ncol = dem_extract.shape
-        x = numpy.arange(0, ncol)
-        y = numpy.arange(0, nrow)
-        dem_extract = numpy.ma.masked_where(
-            dem_extract == 0.0, dem_extract)
-
-        xx, yy = numpy.meshgrid(x, y)
-        # get only the valid values
-        x1 = xx[~dem_extract.mask].ravel()
-        y1 = yy[~dem_extract.mask].ravel()
-
-        newarr = dem_extract[~dem_extract.mask].ravel()
-        del dem_extract
+    def interpolate(self, perimeter_points):
+        """Interpolate across the perimeter points (a dense raster of border elevations is also accepted)"""
+        (lattice, lattice_values) = self.interpolate_lattice(perimeter_points)
+        return LatticeUpsampler(lattice, self.upsampling_method).upsample(lattice_values)
 
-        lumped = numpy.array(
-            [(x1+self.averaging_constant//2)//self.averaging_constant,
-             (y1+self.averaging_constant//2)//self.averaging_constant, newarr])
+    def cost(self, budget: InterpolationBudget, lattice_nodes: int, lumped_points: int, neighbors=None) -> tuple:
+        """Estimated (seconds, bytes) of kriging a lattice with the engine"""
+        if self.engine == 'local':
+            options = {name: value for (name, value) in self.engine_options.items()
+                       if name in ('tile_size', 'max_points_per_tile', 'max_fit_points')}
+            return budget.local_kriging_cost(lattice_nodes, lumped_points, **options)
+        return budget.exact_kriging_cost(lattice_nodes, lumped_points)
 
-        lumped_df = pandas.DataFrame(lumped.T, columns=["X", "Y", "Z"])
-        XY_fn_nan = lumped_df.groupby(
-            ['X', 'Y']).mean().reset_index().to_numpy()
+    def interpolate_lattice(self, perimeter_points):
+        """Interpolate the water surface on the nodes of the lumped lattice"""
+        if not isinstance(perimeter_points, PerimeterPoints):
+            perimeter_points = PerimeterPoints.from_dem_extract(
+                perimeter_points)
+        if self.budget is not None:
+            parameters = self.budget.choose(perimeter_points, self.averaging_constant, None, self.cost,
+                                            adapt_neighbors=False)
+        else:
+            parameters = {'averaging_constant': self.averaging_constant,
+                          'perimeter_points': len(perimeter_points)}
+        lattice = LumpedLattice(
+            perimeter_points.shape, parameters['averaging_constant'])
+        (coords, actual) = lattice.lump(perimeter_points)
+        del perimeter_points
+        self.last_interpolation_parameters = parameters
 
-        # TODO - I suspect there is a problem with treatments of nulls
-        XY_fn = XY_fn_nan[~numpy.isnan(XY_fn_nan[:, 2])]
-
-        coords = XY_fn[:, [0, 1]]
-        actual = XY_fn[:, [2]]
         reg = LinearRegression().fit(coords, actual)
         # logging.info(
         #    f"Fitted linear regression (score = {reg.score(coords, actual)}) with coefficients: {reg.coef_} and intercept: {reg.intercept_}")
@@ -51,24 +68,18 @@ class KrigingInterpolationStrategy():
         residual = actual - linear_estimates
         # 72x90m = 6480m which is an average radial basis range from rimfim
         radial_basis_function = RBF(72/4)
-        gp = GaussianProcessRegressor(kernel=radial_basis_function)
+        if self.engine == 'local':
+            gp = LocalKrigingEngine(
+                radial_basis_function, **self.engine_options)
+        else:
+            gp = GaussianProcessRegressor(kernel=radial_basis_function)
         gp.fit(coords, residual)
 
-        entire_region_lumped_coords = numpy.array(
-            [(xx.reshape(-1)+self.averaging_constant//2)//self.averaging_constant,
-             (yy.reshape(-1)+self.averaging_constant//2)//self.averaging_constant])
-        entire_region_lumped_df = pandas.DataFrame(
-            entire_region_lumped_coords.T, columns=["X", "Y"])
-        entire_region_XY = entire_region_lumped_df.groupby(
-            ['X', 'Y']).size().reset_index().to_numpy()[:, 0:2]
+        entire_region_XY = lattice.coordinates()
         linear_prediction = reg.predict(entire_region_XY)
         residual_prediction = gp.predict(entire_region_XY)
 
         prediction = linear_prediction.ravel() + residual_prediction.ravel()
 
-        del linear_prediction, residual_prediction
-
-        filled = interpolate.griddata(entire_region_XY*self.averaging_constant, prediction.ravel(),
-                                      (xx, yy), method='nearest', fill_value=numpy.nan)
-        del xx, yy, reg, gp, entire_region_XY, prediction
-        return filled
+        del linear_prediction, residual_prediction, reg, gp, entire_region_XY
+        return (lattice, prediction)
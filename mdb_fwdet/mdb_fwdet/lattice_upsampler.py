@@ -0,0 +1,79 @@
+import numpy as np
+import dask.array as da
+
+from mdb_fwdet.lumped_lattice import LumpedLattice
+
+
+class LatticeUpsampler():
+    """Upsample values known on the nodes of a LumpedLattice to every pixel of the region. The lattice is
+    regular, so interpolation is separable (columns then rows) and is done a block of pixels at a time"""
+
+    def __init__(self, lattice: LumpedLattice, method='linear', dtype=np.float64, rows_per_block=1024):
+        self.lattice = lattice
+        """The lattice the values are defined on"""
+        self.method = method
+        """'linear' (bilinear - nan beyond the last lattice node, as griddata) or 'nearest'"""
+        self.dtype = dtype
+        """Data type of the upsampled surface"""
+        self.rows_per_block = rows_per_block
+        """Number of rows upsampled at a time by upsample"""
+
+    def as_grid(self, lattice_values) -> np.ndarray:
+        """Reshape values ordered as LumpedLattice.coordinates (X-major) to a (Y, X) grid"""
+        (nrow_lumped, ncol_lumped) = self.lattice.lattice_shape
+        return np.asarray(lattice_values, dtype=np.float64).reshape((ncol_lumped, nrow_lumped)).T
+
+    def upsample(self, lattice_values) -> np.ndarray:
+        """Upsample to the whole region, written into a single preallocated array"""
+        grid = self.as_grid(lattice_values)
+        (nrow, ncol) = self.lattice.shape
+        filled = np.empty((nrow, ncol), dtype=self.dtype)
+        for row_start in range(0, nrow, self.rows_per_block):
+            row_end = min(row_start + self.rows_per_block, nrow)
+            filled[row_start:row_end, :] = self.upsample_block(
+                grid, (row_start, row_end), (0, ncol))
+        return filled
+
+    def upsample_dask(self, lattice_values, chunks) -> da.Array:
+        """Upsample lazily - each chunk is evaluated independently from the (small) lattice grid"""
+        grid = self.as_grid(lattice_values)
+        chunks = da.core.normalize_chunks(
+            chunks, self.lattice.shape, dtype=self.dtype)
+
+        def upsample_chunk(block_info=None):
+            ((row_start, row_end), (col_start, col_end)) = block_info[None]['array-location']
+            return self.upsample_block(grid, (row_start, row_end), (col_start, col_end))
+
+        return da.map_blocks(upsample_chunk, dtype=self.dtype, chunks=chunks, meta=np.array((), dtype=self.dtype))
+
+    def upsample_block(self, grid: np.ndarray, rows: tuple, cols: tuple) -> np.ndarray:
+        """Upsample the pixels rows[0]:rows[1], cols[0]:cols[1]"""
+        (row_index, row_weight) = self.axis_weights(
+            np.arange(*rows), grid.shape[0])
+        (col_index, col_weight) = self.axis_weights(
+            np.arange(*cols), grid.shape[1])
+
+        # interpolate along the columns of the lattice rows that are needed, then along the rows
+        needed_rows = np.unique(row_index)
+        partial = (grid[needed_rows][:, col_index[0]] * col_weight[0] +
+                   grid[needed_rows][:, col_index[1]] * col_weight[1])
+        lookup = np.searchsorted(needed_rows, row_index)
+        block = (partial[lookup[0]] * row_weight[0][:, None] +
+                 partial[lookup[1]] * row_weight[1][:, None])
+        return block.astype(self.dtype, copy=False)
+
+    def axis_weights(self, pixels: np.ndarray, node_count: int):
+        """The two lattice nodes either side of each pixel and their weights (nan beyond the lattice)"""
+        position = pixels / self.lattice.averaging_constant
+        if self.method == 'nearest':
+            nearest = np.minimum(np.floor(position + 0.5),
+                                 node_count - 1).astype(np.int64)
+            return ((nearest, nearest), (np.ones(len(pixels)), np.zeros(len(pixels))))
+
+        lower = np.minimum(np.floor(position), node_count - 1).astype(np.int64)
+        upper = np.minimum(lower + 1, node_count - 1)
+        fraction = position - lower
+        lower_weight = 1 - fraction
+        # outside the lattice (beyond the last node) there is nothing to interpolate between
+        lower_weight[position > node_count - 1] = np.nan
+        return ((lower, upper), (lower_weight, fraction))
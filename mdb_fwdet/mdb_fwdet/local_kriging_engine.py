@@ -0,0 +1,87 @@
+import numpy
+from scipy.linalg import cho_factor, cho_solve
+from scipy.spatial import cKDTree
+from sklearn.gaussian_process import GaussianProcessRegressor
+
+
+class LocalKrigingEngine():
+    """Approximate (simple) kriging of residuals using local neighbourhoods. The covariance hyper-parameters
+    are fitted on a subsample, then the prediction nodes are grouped into tiles and each tile is kriged from
+    the points within search_radius of it (found with a KD-tree). Cost grows with the number of tiles rather
+    than the cube of the number of points"""
+
+    def __init__(self, kernel, tile_size=32, search_radius=None, max_points_per_tile=1500,
+                 max_fit_points=1000, alpha=1e-10, random_state=0):
+        self.kernel = kernel
+        """Covariance function (sklearn kernel) - the hyper-parameters are used as the starting point of the fit"""
+        self.tile_size = tile_size
+        """Prediction nodes are kriged together in tiles of tile_size x tile_size lattice nodes"""
+        self.search_radius = search_radius
+        """Points within this distance of a tile are used to krige it (default is 8 fitted length scales)"""
+        self.max_points_per_tile = max_points_per_tile
+        """Upper bound on the neighbourhood of a tile - the nearest points to the tile centre are kept"""
+        self.max_fit_points = max_fit_points
+        """Number of points (randomly sampled) used to fit the covariance hyper-parameters"""
+        self.alpha = alpha
+        """Value added to the diagonal of the covariance matrix (as GaussianProcessRegressor)"""
+        self.random_state = random_state
+        """Seed for the subsample used in fitting"""
+
+    def fit(self, coords: numpy.ndarray, residual: numpy.ndarray):
+        """Fit the covariance hyper-parameters and index the points"""
+        residual = numpy.asarray(residual).reshape(-1)
+        sample = numpy.arange(len(coords))
+        if len(sample) > self.max_fit_points:
+            sample = numpy.random.default_rng(self.random_state).choice(
+                sample, self.max_fit_points, replace=False)
+        gp = GaussianProcessRegressor(kernel=self.kernel, alpha=self.alpha)
+        gp.fit(coords[sample], residual[sample])
+        self.kernel_ = gp.kernel_
+        """The fitted covariance function"""
+
+        self.coords = coords
+        self.residual = residual
+        self.tree = cKDTree(coords)
+        if self.search_radius is None:
+            length_scale = numpy.max(
+                numpy.atleast_1d(self.kernel_.get_params().get('length_scale', 1.0)))
+            self.search_radius_ = max(8 * length_scale, 1.0)
+        else:
+            self.search_radius_ = self.search_radius
+        return self
+
+    def predict(self, nodes: numpy.ndarray) -> numpy.ndarray:
+        """Kriged residual at each node (zero - the prior mean - where there are no points nearby)"""
+        prediction = numpy.zeros(len(nodes))
+        tile_keys = numpy.floor(nodes / self.tile_size).astype(numpy.int64)
+        (_, tile_of_node) = numpy.unique(
+            tile_keys, axis=0, return_inverse=True)
+        tile_of_node = tile_of_node.reshape(-1)
+        order = numpy.argsort(tile_of_node, kind='stable')
+        boundaries = numpy.flatnonzero(numpy.diff(tile_of_node[order])) + 1
+        for tile_nodes in numpy.split(order, boundaries):
+            prediction[tile_nodes] = self.predict_tile(nodes[tile_nodes])
+        return prediction
+
+    def predict_tile(self, tile_nodes: numpy.ndarray) -> numpy.ndarray:
+        """Krige the nodes of one tile from the points in its neighbourhood"""
+        lower = tile_nodes.min(axis=0)
+        upper = tile_nodes.max(axis=0)
+        centre = (lower + upper) / 2
+        half_size = numpy.max(upper - lower) / 2 + self.search_radius_
+        neighbours = numpy.array(self.tree.query_ball_point(
+            centre, half_size, p=numpy.inf), dtype=numpy.int64)
+        if len(neighbours) == 0:
+            return numpy.zeros(len(tile_nodes))
+        if len(neighbours) > self.max_points_per_tile:
+            distance = numpy.max(
+                numpy.abs(self.coords[neighbours] - centre), axis=1)
+            neighbours = neighbours[numpy.argsort(
+                distance, kind='stable')[:self.max_points_per_tile]]
+
+        points = self.coords[neighbours]
+        covariance = self.kernel_(points)
+        covariance[numpy.diag_indices_from(covariance)] += self.alpha
+        weights = cho_solve(cho_factor(covariance, lower=True),
+                            self.residual[neighbours])
+        return self.kernel_(tile_nodes, points) @ weights
@@ -0,0 +1,137 @@
+import json
+import os
+import shutil
+
+import dask.array as da
+import numpy as np
+import xarray
+
+
+class MemmapArray():
+    """A .npy file mapped into memory on first use. Only the path is pickled, so dask tasks sent to other
+    processes map the file themselves - every process on the node shares its pages through the OS cache"""
+
+    def __init__(self, path: str, shape: tuple, dtype):
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self._array = None
+
+    def array(self) -> np.memmap:
+        if self._array is None:
+            self._array = np.load(self.path, mmap_mode='r')
+        return self._array
+
+    def __getitem__(self, key):
+        return self.array()[key]
+
+    def __dask_tokenize__(self):
+        # changes if the store is materialised again
+        return (self.path, self.shape, self.dtype.str, os.path.getmtime(self.path))
+
+    def __getstate__(self):
+        return {'path': self.path, 'shape': self.shape, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['shape'], state['dtype'])
+
+
+class LocalStaticInputStore():
+    """The static inputs (regions, DEM and channel) materialised once on local disk as uncompressed arrays
+    that are memory mapped rather than read. Nothing is decoded per process or per date, and crops of the
+    inputs are views of the maps (the OS only pages in the rows a region touches).
+
+    Usage:
+        local_store = LocalStaticInputStore('/scratch/fwdet_static_inputs')
+        if not local_store.is_valid(input_dataset):
+            local_store.materialise(input_dataset)
+        input_dataset = local_store.open()              # numpy memmaps - crops are views
+        input_dataset = local_store.open(chunks=2560)   # dask over the maps - for a (local) cluster
+    """
+
+    VERSION = 1
+    """Version of the layout of the store - a store with another version is rebuilt"""
+
+    VARIABLES = ('regions', 'dem', 'channel')
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        """Local directory holding a .npy file per variable, the coordinates and the metadata"""
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def metadata(self, input_dataset: xarray.Dataset) -> dict:
+        """What the store is built from - the store version and the attributes of the input cache"""
+        source = {name: value for (name, value) in input_dataset.attrs.items() if name != 'complete'}
+        return {'version': LocalStaticInputStore.VERSION,
+                'source': json.loads(json.dumps(source, default=LocalStaticInputStore.json_value))}
+
+    def json_value(value):
+        return value.item() if hasattr(value, 'item') else str(value)
+
+    def read_metadata(self) -> dict:
+        if not os.path.exists(self.path('metadata.json')):
+            return None
+        with open(self.path('metadata.json')) as metadata_file:
+            return json.load(metadata_file)
+
+    def is_valid(self, input_dataset: xarray.Dataset) -> bool:
+        """The store is complete (the metadata is written last) and built from these inputs"""
+        stored = self.read_metadata()
+        if stored is None:
+            return False
+        expected = self.metadata(input_dataset)
+        return stored['version'] == expected['version'] and stored['source'] == expected['source']
+
+    def dtype(variable: xarray.DataArray) -> np.dtype:
+        # float32 is enough for the surfaces (and halves the pages touched)
+        return np.dtype(np.float32) if variable.dtype == np.float64 else variable.dtype
+
+    def materialise(self, input_dataset: xarray.Dataset):
+        """Write the inputs (usually lazy, e.g. the zarr cache) to the store a chunk at a time"""
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        variables = {}
+        for name in LocalStaticInputStore.VARIABLES:
+            variable = input_dataset[name]
+            data = variable.data if isinstance(variable.data, da.Array) else \
+                da.from_array(variable.data, chunks=4096)
+            target = np.lib.format.open_memmap(self.path(f'{name}.npy'), mode='w+',
+                                               dtype=LocalStaticInputStore.dtype(variable), shape=variable.shape)
+            da.store(data.astype(target.dtype), target, lock=False)
+            target.flush()
+            del target
+            variables[name] = {'dims': list(variable.dims),
+                               'attrs': json.loads(json.dumps(variable.attrs, default=LocalStaticInputStore.json_value))}
+        np.savez(self.path('coords.npz'), latitude=input_dataset.latitude.to_numpy(),
+                 longitude=input_dataset.longitude.to_numpy())
+        # scalar coordinates (e.g. spatial_ref holding the CRS)
+        scalar_coords = {name: {'value': coord.item(), 'attrs': coord.attrs}
+                         for (name, coord) in input_dataset.coords.items() if coord.ndim == 0}
+        metadata = dict(self.metadata(input_dataset), variables=variables,
+                        scalar_coords=json.loads(json.dumps(scalar_coords, default=LocalStaticInputStore.json_value)))
+        with open(self.path('metadata.json.partial'), 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.replace(self.path('metadata.json.partial'), self.path('metadata.json'))
+
+    def open(self, chunks: int = None) -> xarray.Dataset:
+        """The inputs backed by the memory maps. With chunks they are dask arrays of the maps (each task maps
+        the file in its own process), otherwise numpy memmaps"""
+        metadata = self.read_metadata()
+        coords = np.load(self.path('coords.npz'))
+        data_vars = {}
+        for name in LocalStaticInputStore.VARIABLES:
+            array = np.load(self.path(f'{name}.npy'), mmap_mode='r')
+            if chunks is not None:
+                array = da.from_array(MemmapArray(self.path(f'{name}.npy'), array.shape, array.dtype),
+                                      chunks=(chunks, chunks), asarray=False)
+            variable = metadata['variables'][name]
+            data_vars[name] = xarray.DataArray(array, dims=variable['dims'], attrs=variable['attrs'])
+        dataset = xarray.Dataset(data_vars, coords={'latitude': coords['latitude'], 'longitude': coords['longitude']},
+                                 attrs=metadata['source'])
+        for (name, coord) in metadata['scalar_coords'].items():
+            dataset.coords[name] = xarray.DataArray(coord['value'], attrs=coord['attrs'])
+        return dataset
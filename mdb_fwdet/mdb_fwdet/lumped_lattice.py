@@ -0,0 +1,58 @@
+import numpy as np
+
+from mdb_fwdet.perimeter_points import PerimeterPoints
+
+
+class LumpedLattice():
+    """Coarse lattice of a region where each node lumps together averaging_constant x averaging_constant
+    pixels. Node (X, Y) covers the pixels whose (column + averaging_constant//2)//averaging_constant == X
+    and (row + averaging_constant//2)//averaging_constant == Y. Nodes are ordered X-major (by X, then Y)."""
+
+    def __init__(self, shape: tuple, averaging_constant: int):
+        self.shape = tuple(shape)
+        """Shape (rows, columns) of the region in pixels"""
+        self.averaging_constant = averaging_constant
+        """Number of pixels lumped together (in each direction) by a lattice node"""
+        (nrow, ncol) = self.shape
+        self.lattice_shape = (LumpedLattice.lumped_index(nrow - 1, averaging_constant) + 1,
+                              LumpedLattice.lumped_index(ncol - 1, averaging_constant) + 1)
+        """Shape (Y, X) of the lattice"""
+
+    def lumped_index(pixel_index, averaging_constant):
+        """The lattice index of a pixel row or column"""
+        return (pixel_index + averaging_constant//2)//averaging_constant
+
+    def node_count(self) -> int:
+        return self.lattice_shape[0] * self.lattice_shape[1]
+
+    def lump(self, perimeter_points: PerimeterPoints):
+        """Mean elevation of the perimeter points falling in each lattice node. Returns the (X, Y)
+        coordinates of the occupied nodes (n x 2) and their mean elevation (n x 1)"""
+        (nrow_lumped, _) = self.lattice_shape
+        node = self.node_of(perimeter_points)
+
+        sums = np.bincount(node, weights=perimeter_points.elevations.astype(np.float64),
+                           minlength=self.node_count())
+        counts = np.bincount(node, minlength=self.node_count())
+        occupied = np.flatnonzero(counts)
+
+        coords = np.column_stack(
+            [occupied // nrow_lumped, occupied % nrow_lumped]).astype(np.float64)
+        means = (sums[occupied] / counts[occupied]).reshape(-1, 1)
+        return (coords, means)
+
+    def node_of(self, perimeter_points: PerimeterPoints) -> np.ndarray:
+        """The lattice node (X-major index) of each perimeter point"""
+        (nrow_lumped, _) = self.lattice_shape
+        return (LumpedLattice.lumped_index(perimeter_points.cols.astype(np.int64), self.averaging_constant) * nrow_lumped +
+                LumpedLattice.lumped_index(perimeter_points.rows.astype(np.int64), self.averaging_constant))
+
+    def occupied_count(self, perimeter_points: PerimeterPoints) -> int:
+        """Number of lattice nodes with perimeter points (the points lump returns)"""
+        return int(np.count_nonzero(np.bincount(self.node_of(perimeter_points), minlength=self.node_count())))
+
+    def coordinates(self):
+        """(X, Y) coordinates of every node in the lattice (X-major)"""
+        (nrow_lumped, ncol_lumped) = self.lattice_shape
+        return np.column_stack([np.repeat(np.arange(ncol_lumped), nrow_lumped),
+                                np.tile(np.arange(nrow_lumped), ncol_lumped)]).astype(np.float64)
@@ -0,0 +1,99 @@
+import numpy as np
+import dask
+import dask.array as da
+import xarray
+from scipy import ndimage
+
+from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+
+
+class PerimeterPoints():
+    """Sparse list of the cells on the perimeter of flooded areas (the dry cells touching wet cells)
+    with their elevation - used as the input to the interpolation strategies"""
+
+    def __init__(self, rows: np.ndarray, cols: np.ndarray, elevations: np.ndarray, shape: tuple, x=None, y=None):
+        self.rows = rows.astype(np.int32, copy=False)
+        """Row (y index) of each perimeter cell (int32)"""
+        self.cols = cols.astype(np.int32, copy=False)
+        """Column (x index) of each perimeter cell (int32)"""
+        self.elevations = elevations.astype(np.float32, copy=False)
+        """Elevation of each perimeter cell (float32)"""
+        self.shape = tuple(shape)
+        """Shape (rows, columns) of the region the points were extracted from"""
+        self.x = x
+        """Optional x coordinate of each column of the region"""
+        self.y = y
+        """Optional y coordinate of each row of the region"""
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __str__(self) -> str:
+        return f"{len(self)} perimeter points in {self.shape}"
+
+    def __repr__(self) -> str:
+        return self.__str__()
+
+    def from_flood_extent(mim_array, dem, chunks=2048):
+        """Stream through the flood extent block by block (with a 1 pixel halo) and extract the
+        perimeter cells and their elevation. Only the sparse points are brought together."""
+        mim = PerimeterPoints.as_dask_array(mim_array, chunks)
+        dem_data = PerimeterPoints.as_dask_array(dem, mim.chunks)
+
+        border = da.map_overlap(PerimeterPoints.border_block, mim, depth=1,
+                                boundary=SpatialFloodExtentInputs.WOFS_NODATA_VALUE, dtype=bool)
+
+        row_offsets = np.cumsum((0,) + border.chunks[0])
+        col_offsets = np.cumsum((0,) + border.chunks[1])
+        border_blocks = border.to_delayed()
+        dem_blocks = dem_data.to_delayed()
+        block_points = [dask.delayed(PerimeterPoints.block_points)(
+            border_blocks[i, j], dem_blocks[i, j], row_offsets[i], col_offsets[j])
+            for (i, j) in np.ndindex(*border.numblocks)]
+        block_points = dask.compute(*block_points)
+
+        (x, y) = PerimeterPoints.grid_coordinates(dem)
+        return PerimeterPoints(
+            np.concatenate([points[0] for points in block_points]),
+            np.concatenate([points[1] for points in block_points]),
+            np.concatenate([points[2] for points in block_points]),
+            mim.shape, x, y)
+
+    def from_dem_extract(dem_extract):
+        """Convert a dense raster of border elevations (zero away from the border) to perimeter points"""
+        values = np.asarray(dem_extract)
+        rows, cols = np.nonzero(values)
+        elevations = values[rows, cols]
+        valid = ~np.isnan(elevations)
+        (x, y) = PerimeterPoints.grid_coordinates(dem_extract)
+        return PerimeterPoints(rows[valid], cols[valid], elevations[valid], values.shape, x, y)
+
+    def as_dask_array(array, chunks) -> da.Array:
+        """Get the dask array behind a (possibly numpy backed) DataArray, chunked as requested"""
+        data = array.data if isinstance(array, xarray.DataArray) else array
+        if isinstance(data, da.Array):
+            return data.rechunk(chunks)
+        return da.from_array(data, chunks=chunks)
+
+    def grid_coordinates(array):
+        """The x and y coordinates of a DataArray (None when they are not available)"""
+        if isinstance(array, xarray.DataArray) and array.ndim == 2:
+            (y_dim, x_dim) = array.dims
+            if x_dim in array.coords and y_dim in array.coords:
+                return (array.coords[x_dim].values, array.coords[y_dim].values)
+        return (None, None)
+
+    def border_block(mim_block):
+        """Cells that are not wet (and not nodata) but touch a wet cell - expects a 1 pixel halo"""
+        wet = mim_block == SpatialFloodExtentInputs.WOFS_WET_VALUE
+        nodata = mim_block == SpatialFloodExtentInputs.WOFS_NODATA_VALUE
+        bufferred = ndimage.binary_dilation(wet, structure=np.ones((3, 3)))
+        return bufferred & ~wet & ~nodata
+
+    def block_points(border_block, dem_block, row_offset, col_offset):
+        """Row, column and elevation of the border cells in a block (cells without elevation, or at an elevation
+        of 0.0 - which from_dem_extract can't tell from away from the border - are dropped)"""
+        block_rows, block_cols = np.nonzero(border_block)
+        elevations = np.asarray(dem_block)[block_rows, block_cols]
+        valid = ~np.isnan(elevations) & (elevations != 0.0)
+        return (block_rows[valid] + row_offset, block_cols[valid] + col_offset, elevations[valid])
@@ -2,11 +2,18 @@
 class Region():
     """Region"""
 
-    def __init__(self, region_number: int, bounding_box: tuple):
+    def __init__(self, region_number: int, bounding_box: tuple, core_box: tuple = None, label: int = None):
         self.region_number = region_number
         self.bounding_box = bounding_box
+        """(row0, row1, col0, col1) of the inputs of the region - including any halo"""
+        self.core_box = core_box if core_box is not None else bounding_box
+        """(row0, row1, col0, col1) of the part of the region's result used in the mosaic (without the halo)"""
+        self.label = label if label is not None else region_number + 1
+        """Value of the region in the regions raster"""
 
     def __str__(self) -> str:
+        if self.core_box != self.bounding_box:
+            return f"{self.region_number}: {str(self.bounding_box)} core {str(self.core_box)} label {self.label}"
         return f"{self.region_number}: {str(self.bounding_box)}"
 
     def __repr__(self) -> str:
@@ -16,7 +16,7 @@ class RegionDefinition():
         for region in regions:
             mask_bounds = region.bounding_box
             region_template[mask_bounds[0]:mask_bounds[1],
-                            mask_bounds[2]:mask_bounds[3]] = region.region_number
+                            mask_bounds[2]:mask_bounds[3]] = region.region_number + 1
         return region_template
 
     def dict_to_regions(region_bounds: Dict[int, tuple]) -> List[Region]:
@@ -0,0 +1,92 @@
+import hashlib
+import io
+import json
+
+import fsspec
+import numpy as np
+from xarray import DataArray
+
+from mdb_fwdet.region import Region
+
+
+class RegionDepthCache():
+    """Depth of each region stored under a hash of everything it is calculated from - the region's flood
+    extent, its bounding box, the estimator's parameters and the version of the static inputs. A region
+    whose hash is already stored is loaded rather than recalculated, so rerunning a date only recalculates the
+    regions whose flood extent changed.
+
+    Usage:
+        region_depth_cache = RegionDepthCache(f"s3://{bucket}/{prefix}/region_depth_cache",
+                                              spatial_raster_inputs.static_input_version)
+        flood_depth_engine.calculate_dask(client, region_depth_cache=region_depth_cache)
+    """
+
+    VERSION = 2
+    """Changed when the calculation (or what is stored) changes in a way the parameters don't capture"""
+
+    def __init__(self, location: str, static_input_version: str):
+        self.location = location.rstrip('/')
+        """Directory (local path or s3://bucket/prefix) holding a file per hash"""
+        self.static_input_version = static_input_version
+        """Identifies the contents of the DEM/channel the depths were calculated with (see
+        SpatialInputHelper.static_input_version)"""
+
+    def fingerprint(self, estimator, region: Region) -> str:
+        """Everything but the flood extent that the region's depth depends on"""
+        return json.dumps({'version': RegionDepthCache.VERSION, 'bounding_box': [int(bound) for bound in region.bounding_box],
+                           'estimator': RegionDepthCache.parameters(estimator),
+                           'static_inputs': self.static_input_version}, sort_keys=True, default=str)
+
+    def parameters(settings, depth=0) -> dict:
+        """The class and settings (scalar attributes, recursing into the strategies) of an estimator"""
+        parameters = {'class': type(settings).__name__}
+        for (name, value) in sorted(vars(settings).items()):
+            if name.startswith('_') or name.startswith('last_') or name in ('verbose', 'profiler', 'spatial_flood_extent_inputs'):
+                continue
+            if value is None or isinstance(value, (bool, int, float, str)):
+                parameters[name] = value
+            elif isinstance(value, (tuple, list)):
+                parameters[name] = repr(value)
+            elif isinstance(value, dict):
+                parameters[name] = repr(sorted(value.items()))
+            elif type(value).__module__.startswith('sklearn'):
+                parameters[name] = repr(value)
+            elif type(value).__module__.startswith('mdb_fwdet') and depth < 3:
+                parameters[name] = RegionDepthCache.parameters(value, depth + 1)
+        return parameters
+
+    def region_hash(mim_array: DataArray, fingerprint: str) -> str:
+        values = np.ascontiguousarray(np.asarray(mim_array))
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(fingerprint.encode())
+        digest.update(f"{values.shape}{values.dtype}".encode())
+        digest.update(values.data)
+        return digest.hexdigest()
+
+    def path(self, region_hash: str) -> str:
+        return f"{self.location}/{region_hash[:2]}/{region_hash}.npz"
+
+    def load(self, region_hash: str):
+        """The stored depth (uint16 mm) and attributes (e.g. interpolation_parameters) for the hash, None if there
+        isn't one"""
+        (fs, path) = fsspec.core.url_to_fs(self.path(region_hash))
+        if not fs.exists(path):
+            return None
+        with fs.open(path, 'rb') as cached:
+            stored = np.load(io.BytesIO(cached.read()))
+            return (stored['depth'], json.loads(str(stored['attrs'])))
+
+    def json_value(value):
+        """numpy scalars as their python values (e.g. the parameters chosen by an InterpolationBudget)"""
+        return value.item() if isinstance(value, np.generic) else str(value)
+
+    def store(self, region_hash: str, depth: np.ndarray, attrs: dict = None):
+        (fs, path) = fsspec.core.url_to_fs(self.path(region_hash))
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, depth=depth, attrs=np.array(
+            json.dumps(attrs or {}, sort_keys=True, default=RegionDepthCache.json_value)))
+        fs.makedirs(path.rsplit('/', 1)[0], exist_ok=True)
+        # written under another name first so a partial file is never loaded
+        with fs.open(path + '.partial', 'wb') as cached:
+            cached.write(buffer.getvalue())
+        fs.mv(path + '.partial', path)
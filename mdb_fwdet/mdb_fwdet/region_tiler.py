@@ -0,0 +1,154 @@
+import heapq
+from typing import Dict, List
+
+import dask.array as da
+import numpy as np
+from xarray import DataArray
+
+from mdb_fwdet.region import Region
+from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+
+
+class RegionTiler():
+    """Derive the regions from the regions raster and split them into tiles of similar estimated cost (pixel area
+    plus weighted flood perimeter). Each tile's bounding box is its core plus a halo of neighbouring pixels, so
+    tiles see across their edges; only the core is written to the mosaic.
+
+    Usage:
+        mdb_region_bounds_list = RegionTiler(target_tiles=48, halo=256).tile(
+            spatial_raster_inputs.input_dataset['regions'], representative_mim)
+    """
+
+    def __init__(self, target_tiles=48, halo=256, cell_size=64, min_tile_size=2048, perimeter_weight=64.0,
+                 nodata=65535):
+        self.target_tiles = target_tiles
+        """Number of tiles to split the regions into (fewer if the regions can't be split further)"""
+        self.halo = halo
+        """Pixels added around each tile's core for its bounding box"""
+        self.cell_size = cell_size
+        """Tiles are made of cells of cell_size x cell_size pixels (costs are counted per cell)"""
+        self.min_tile_size = min_tile_size
+        """Tiles aren't split along an axis shorter than twice this (pixels)"""
+        self.perimeter_weight = perimeter_weight
+        """Cost of a pixel on the flood perimeter relative to the cost of any pixel (interpolation vs raster work)"""
+        self.nodata = nodata
+        """Value of the regions raster outside the regions (0 is also outside)"""
+
+    def tile(self, region_grid: DataArray, flood_extent: DataArray = None) -> List[Region]:
+        """Tiles of every region in the grid. The flood extent (e.g. a typical date) weights the cost towards
+        tiles with long flood perimeters"""
+        (label_counts, cost) = self.cell_statistics(region_grid, flood_extent)
+        min_cells = -(-self.min_tile_size // self.cell_size)
+
+        heap = []
+        final = []
+        for (label, counts) in sorted(label_counts.items()):
+            box = RegionTiler.shrink(counts, (0, cost.shape[0], 0, cost.shape[1]))
+            heapq.heappush(heap, (-RegionTiler.box_cost(cost, box), label, box))
+
+        while len(heap) > 0 and len(heap) + len(final) < self.target_tiles:
+            (_, label, box) = heapq.heappop(heap)
+            children = RegionTiler.split(cost, label_counts[label], box, min_cells)
+            if children is None:
+                final.append((label, box))
+                continue
+            for child in children:
+                heapq.heappush(heap, (-RegionTiler.box_cost(cost, child), label, child))
+
+        tiles = sorted(final + [(label, box) for (_, label, box) in heap])
+        (height, width) = region_grid.shape
+        regions = []
+        for (region_number, (label, box)) in enumerate(tiles):
+            core_box = (box[0] * self.cell_size, min(box[1] * self.cell_size, height),
+                        box[2] * self.cell_size, min(box[3] * self.cell_size, width))
+            bounding_box = (max(core_box[0] - self.halo, 0), min(core_box[1] + self.halo, height),
+                            max(core_box[2] - self.halo, 0), min(core_box[3] + self.halo, width))
+            regions.append(Region(region_number, bounding_box, core_box, int(label)))
+        return regions
+
+    def cell_statistics(self, region_grid: DataArray, flood_extent: DataArray = None):
+        """Number of pixels of each label in each cell and the estimated cost of each cell"""
+        (height, width) = region_grid.shape
+        cell_shape = (-(-height // self.cell_size), -(-width // self.cell_size))
+        label_counts: Dict[int, np.ndarray] = {}
+        cost = np.zeros(cell_shape)
+        for (bounds, block) in RegionTiler.blocks(region_grid):
+            (row0, row1, col0, col1) = bounds
+            row_starts = RegionTiler.cell_starts(row0, row1, self.cell_size)
+            col_starts = RegionTiler.cell_starts(col0, col1, self.cell_size)
+            cells = (slice(row0 // self.cell_size, -(-row1 // self.cell_size)),
+                     slice(col0 // self.cell_size, -(-col1 // self.cell_size)))
+            valid = (block != self.nodata) & (block != 0)
+            cost[cells] += RegionTiler.cell_sums(valid, row_starts, col_starts)
+            for label in np.unique(block[valid]):
+                if label not in label_counts:
+                    label_counts[label] = np.zeros(cell_shape, dtype=np.int64)
+                label_counts[label][cells] += RegionTiler.cell_sums(
+                    block == label, row_starts, col_starts)
+            if flood_extent is not None:
+                wet = np.asarray(flood_extent[row0:row1, col0:col1]) == SpatialFloodExtentInputs.WOFS_WET_VALUE
+                cost[cells] += self.perimeter_weight * RegionTiler.cell_sums(
+                    RegionTiler.perimeter(wet) & valid, row_starts, col_starts)
+        return (label_counts, cost)
+
+    def blocks(region_grid: DataArray, block_size=4096):
+        """Yield ((row0, row1, col0, col1), block) over the grid - a chunk at a time if it is dask backed"""
+        data = region_grid.data
+        if isinstance(data, da.Array):
+            row_edges = np.cumsum((0,) + data.chunks[0])
+            col_edges = np.cumsum((0,) + data.chunks[1])
+        else:
+            row_edges = list(range(0, data.shape[0], block_size)) + [data.shape[0]]
+            col_edges = list(range(0, data.shape[1], block_size)) + [data.shape[1]]
+        for (row0, row1) in zip(row_edges[:-1], row_edges[1:]):
+            for (col0, col1) in zip(col_edges[:-1], col_edges[1:]):
+                yield ((int(row0), int(row1), int(col0), int(col1)), np.asarray(data[row0:row1, col0:col1]))
+
+    def cell_starts(start: int, stop: int, cell_size: int) -> np.ndarray:
+        """Offsets (from start) of the first pixel of each cell overlapping start..stop-1"""
+        first_cell = start // cell_size
+        last_cell = -(-stop // cell_size)
+        return np.maximum(np.arange(first_cell, last_cell) * cell_size - start, 0)
+
+    def cell_sums(mask: np.ndarray, row_starts: np.ndarray, col_starts: np.ndarray) -> np.ndarray:
+        rows = np.add.reduceat(mask.astype(np.int64), row_starts, axis=0)
+        return np.add.reduceat(rows, col_starts, axis=1)
+
+    def perimeter(wet: np.ndarray) -> np.ndarray:
+        """Wet pixels with a neighbour (4-connected) that isn't wet"""
+        padded = np.pad(wet, 1, mode='edge')
+        inner = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+        return wet & ~inner
+
+    def box_cost(cost: np.ndarray, box: tuple) -> float:
+        return float(cost[box[0]:box[1], box[2]:box[3]].sum())
+
+    def shrink(counts: np.ndarray, box: tuple):
+        """The smallest box (in cells) within box holding all of the label's pixels, None if there are none"""
+        occupied = counts[box[0]:box[1], box[2]:box[3]] > 0
+        rows = np.flatnonzero(occupied.any(axis=1))
+        cols = np.flatnonzero(occupied.any(axis=0))
+        if len(rows) == 0:
+            return None
+        return (box[0] + int(rows[0]), box[0] + int(rows[-1]) + 1, box[2] + int(cols[0]), box[2] + int(cols[-1]) + 1)
+
+    def split(cost: np.ndarray, counts: np.ndarray, box: tuple, min_cells: int):
+        """Split a tile in two (of about equal cost) across its longer axis. Each half is shrunk to the label's
+        pixels. None if it is too small to split"""
+        extents = (box[1] - box[0], box[3] - box[2])
+        for axis in sorted((0, 1), key=lambda axis: -extents[axis]):
+            if extents[axis] < 2 * min_cells:
+                continue
+            profile = cost[box[0]:box[1], box[2]:box[3]].sum(axis=1 - axis)
+            cumulative = np.cumsum(profile)
+            at = int(np.argmin(np.abs(cumulative - cumulative[-1] / 2))) + 1
+            at = min(max(at, min_cells), extents[axis] - min_cells)
+            if axis == 0:
+                halves = [(box[0], box[0] + at, box[2], box[3]),
+                          (box[0] + at, box[1], box[2], box[3])]
+            else:
+                halves = [(box[0], box[1], box[2], box[2] + at),
+                          (box[0], box[1], box[2] + at, box[3])]
+            children = [RegionTiler.shrink(counts, half) for half in halves]
+            return [child for child in children if child is not None]
+        return None
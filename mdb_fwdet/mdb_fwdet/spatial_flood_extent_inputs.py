@@ -1,5 +1,11 @@
+import dask
+import numpy
+import xarray
+import zarr
+from numcodecs import Blosc
 from mdb_fwdet.configuration import Configuration
 from mdb_fwdet.region import Region
+from mdb_fwdet.zarr_format import ZarrFormat
 from xarray import DataArray
 import rioxarray
 
@@ -19,19 +25,67 @@ class SpatialFloodExtentInputs():
         return Configuration.image_date_format_string.format(
             image_date= image_date_label)
 
-    def load_mim_input(image_date_label) -> DataArray:
-        image_date_file_location = SpatialFloodExtentInputs.mim_input_location(
-            image_date_label)
-        xds = rioxarray.open_rasterio(image_date_file_location)
-        xds.attrs['image_date'] = image_date_label
-        return xds[0]
+    def mim_store_location(image_date_label) -> str:
+        return Configuration.mim_store_format_string.format(
+            image_date=image_date_label)
+
+    def load_mim_input(image_date_label, chunks=None, use_store=True) -> DataArray:
+        """Open the flood extent lazily - nothing is read until a region's window is loaded (on the worker
+        calculating the region). Read from the region aligned zarr store if the date has been ingested, otherwise
+        the raster (in chunks if given)"""
+        mim_store_location = SpatialFloodExtentInputs.mim_store_location(image_date_label)
+        if use_store and SpatialFloodExtentInputs.is_ingested(mim_store_location):
+            mim_array = xarray.open_zarr(mim_store_location)['mim']
+        else:
+            image_date_file_location = SpatialFloodExtentInputs.mim_input_location(
+                image_date_label)
+            xds = rioxarray.open_rasterio(image_date_file_location, chunks=None if chunks is None else (1, chunks, chunks))
+            mim_array = xds[0]
+        mim_array.attrs['image_date'] = image_date_label
+        return mim_array
+
+    def is_ingested(mim_store_location: str) -> bool:
+        """Whether the date has been ingested to a store that is complete (with either version of zarr)"""
+        try:
+            mim_dataset = xarray.open_zarr(mim_store_location)
+        except (FileNotFoundError, KeyError, ValueError):
+            return False
+        return mim_dataset.attrs.get('complete') == 1
+
+    def ingest_mim_input(image_date_label, chunk_size: int, mim_store_location: str = None) -> str:
+        """Convert the date's flood extent raster to a zarr store with chunks of chunk_size (e.g. the chunk size of
+        the spatial input cache) so each region reads only the chunks it overlaps. Returns the store's location"""
+        if mim_store_location is None:
+            mim_store_location = SpatialFloodExtentInputs.mim_store_location(image_date_label)
+        mim_array = SpatialFloodExtentInputs.load_mim_input(image_date_label, chunks=chunk_size, use_store=False)
+        mim_dataset = mim_array.astype(numpy.uint8).to_dataset(name='mim')
+        # stored as the raw codes (the raster's encoding would override the chunks or decode them as floats)
+        mim_dataset.mim.encoding = {}
+        for name in ('_FillValue', 'scale_factor', 'add_offset'):
+            mim_dataset.mim.attrs.pop(name, None)
+        mim_dataset = ZarrFormat.without_scalar_coords(mim_dataset)
+        mim_dataset.attrs['complete'] = 0
+        with ZarrFormat.writing():
+            mim_dataset.to_zarr(mim_store_location, mode='w', consolidated=True, encoding=ZarrFormat.full_encoding(
+                mim_dataset, {'mim': dict(ZarrFormat.compressor_encoding(Blosc.BITSHUFFLE),
+                                           chunks=(chunk_size, chunk_size))}))
+            # marked complete only once all of the data is written
+            zarr.open_group(mim_store_location, mode='r+').attrs['complete'] = 1
+            zarr.consolidate_metadata(mim_store_location)
+        return mim_store_location
+
+    def read_window(mim_array: DataArray) -> DataArray:
+        """Read a (lazy) crop of the flood extent into memory - on the worker, straight from its source"""
+        with dask.config.set(scheduler='synchronous'):
+            return mim_array.load()
 
     WOFS_NODATA_VALUE = 0
     WOFS_DRY_VALUE = 2
     WOFS_WET_VALUE = 3
 
     def crop(self, region: Region):
-        """ Crop spatial flood extent inputs to a specific region"""
+        """ Crop spatial flood extent inputs to a specific region (views of numpy backed inputs, e.g. the memory
+        maps of a LocalStaticInputStore - nothing is copied)"""
         mask_bounds = region.bounding_box
         cropped_mim_array = self.mim_array[mask_bounds[0]:mask_bounds[1], mask_bounds[2]:mask_bounds[3]]
         cropped_dem = self.dem[mask_bounds[0]:mask_bounds[1], mask_bounds[2]:mask_bounds[3]]
@@ -3,9 +3,19 @@ from xarray import DataArray
 import rioxarray
 import numpy
 import xarray
+import os
+import json
+import uuid
 import s3fs
+import zarr
+from typing import List
 from mdb_fwdet.configuration import Configuration
+from mdb_fwdet.local_static_input_store import LocalStaticInputStore
+from mdb_fwdet.region import Region
+from mdb_fwdet.region_definition import RegionDefinition
 from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+from mdb_fwdet.static_input_cache import StaticInputCache
+from mdb_fwdet.zarr_format import ZarrFormat
 import logging
 import boto3
 from botocore.errorfactory import ClientError
@@ -14,18 +24,91 @@ import pickle
 class SpatialInputHelper():
     """Load and cache the spatial inputs"""
 
-    def __init__(self, cache_location):
+    CACHE_FORMAT_VERSION = 2
+    """Version of the layout and encoding of the cache - a cache with another version (or that is incomplete or
+    built from other rasters) is rebuilt"""
+
+    def __init__(self, cache_location, regions: List[Region] = None, channel_encoding='float32',
+                 local_store_location: str = None):
         self.s3 = s3fs.S3FileSystem(anon=False, s3_additional_kwargs={
             "ACL": "bucket-owner-full-control"})
-        
-        if self.s3.exists(cache_location):
+        self.chunk_size = SpatialInputHelper.aligned_chunk_size(
+            regions if regions is not None else RegionDefinition.dict_to_regions(RegionDefinition.MDB_REGIONS))
+        """Size of the (square) chunks of a new cache - chosen to suit the regions' bounding boxes"""
+        self.channel_encoding = channel_encoding
+        """How the channel is stored in a new cache - 'float32' or 'scaled' (int32 mm)"""
+
+        if self._exists(cache_location) and self._is_valid(xarray.open_zarr(self._store(cache_location))):
             logging.info(f"Using cached inputs")
-            self.input_dataset: xarray.Dataset = xarray.open_zarr(
-                cache_location)
         else:
             logging.info(f"Loading new inputs")
-            self.input_dataset: xarray.Dataset = self._load_from_rasters()
-            self._save_rasters(self.input_dataset, cache_location)
+            self._save_rasters(self._load_from_rasters(), cache_location)
+        # the cache rather than the rasters so a new cache reads the same values as an existing one
+        self.input_dataset: xarray.Dataset = xarray.open_zarr(
+            self._store(cache_location))
+        self.static_input_version = SpatialInputHelper.static_input_version_of(self.input_dataset)
+        """Identifies the contents of the cache (e.g. for the RegionDepthCache) - changes when it is rebuilt"""
+
+        self.local_store = None
+        """Memory mapped copy of the inputs on local disk (None to read the cache lazily)"""
+        if local_store_location is not None:
+            self.local_store = LocalStaticInputStore(local_store_location)
+            if not self.local_store.is_valid(self.input_dataset):
+                logging.info(f"Materialising inputs in {local_store_location}")
+                self.local_store.materialise(self.input_dataset)
+            self.input_dataset = self.local_store.open(chunks=self.chunk_size)
+
+        self.static_input_cache = StaticInputCache(
+            self.input_dataset.dem, self.input_dataset.channel)
+        """DEM and channel of each region held on the workers (shared by every date)"""
+
+    def _exists(self, location: str) -> bool:
+        if location.startswith('s3://'):
+            return self.s3.exists(location)
+        return os.path.exists(location)
+
+    def _store(self, location: str):
+        if location.startswith('s3://'):
+            return s3fs.S3Map(root=location, s3=self.s3, check=False)
+        return location
+
+    def aligned_chunk_size(regions: List[Region], candidates=tuple(range(1024, 4097, 512)),
+                           overhead_pixels=1000000) -> int:
+        """The chunk size that is cheapest to crop every region from - the pixels of every chunk a region touches
+        plus a fixed overhead per chunk (the request and decode)"""
+        def cost(chunk_size):
+            total = 0
+            for region in regions:
+                (row0, row1, col0, col1) = region.bounding_box
+                chunks = (((row1 - 1) // chunk_size - row0 // chunk_size + 1) *
+                          ((col1 - 1) // chunk_size - col0 // chunk_size + 1))
+                total += chunks * (chunk_size * chunk_size + overhead_pixels)
+            return total
+        return min(candidates, key=cost)
+
+    def cache_metadata(self) -> dict:
+        """Attributes of the cache used to check it is complete and matches the rasters and format"""
+        return {'cache_format_version': SpatialInputHelper.CACHE_FORMAT_VERSION,
+                'region_raster_location': Configuration.region_raster_location,
+                'dem_raster_location': Configuration.dem_raster_location,
+                'channel_raster_location': Configuration.channel_raster_location,
+                'channel_encoding': self.channel_encoding,
+                'complete': 0}
+
+    def static_input_version_of(cached_dataset: xarray.Dataset) -> str:
+        """The metadata of the cache - its format version, source rasters, encoding, completeness and the id of
+        the build (a cache rebuilt in place gets a new one)"""
+        return json.dumps(dict(cached_dataset.attrs), sort_keys=True, default=str)
+
+    def _is_valid(self, cached_dataset: xarray.Dataset) -> bool:
+        expected = self.cache_metadata()
+        expected['complete'] = 1
+        for (name, value) in expected.items():
+            if cached_dataset.attrs.get(name) != value:
+                logging.warning(
+                    f"Rebuilding cached inputs - {name} is {cached_dataset.attrs.get(name)}, expected {value}")
+                return False
+        return True
 
     def _load_from_rasters(self) -> xarray.Dataset:
 
@@ -56,11 +139,46 @@ class SpatialInputHelper():
 
         return my_dataset
 
+    def encoding(self) -> dict:
+        """zarr encoding of each variable - zstd with byte shuffling, chunks of chunk_size"""
+        chunks = (self.chunk_size, self.chunk_size)
+        compressor = ZarrFormat.compressor_encoding()
+        if self.channel_encoding == 'scaled':
+            # mm is the precision of the output
+            channel_encoding = {"dtype": "int32", "scale_factor": 0.001,
+                                "_FillValue": numpy.iinfo(numpy.int32).min}
+        else:
+            channel_encoding = {"dtype": "float32"}
+        return {"regions": dict(compressor, dtype="uint16", chunks=chunks),
+                "dem": dict(compressor, dtype="float32", chunks=chunks),
+                "channel": dict(channel_encoding, chunks=chunks, **compressor)}
+
     def _save_rasters(self, my_dataset: xarray.Dataset, filename: str):
         self.s3.invalidate_cache()
-        s3_store = s3fs.S3Map(root=filename, s3=self.s3, check=False)
-        z = my_dataset.chunk({"longitude": 4944, "latitude": 4944}).to_zarr(s3_store, mode="w", compute=True, encoding={
-            "regions": {"dtype": "uint16"}, "dem": {"dtype": "float32"}, "channel": {"dtype": "float64"}})
+        store = self._store(filename)
+        my_dataset = my_dataset.chunk(
+            {"longitude": self.chunk_size, "latitude": self.chunk_size})
+        if self.channel_encoding == 'scaled' and '_FillValue' in my_dataset.channel.attrs:
+            # the raster's nodata is stored as the scaled fill value (and read back as NaN as before)
+            channel_attrs = dict(my_dataset.channel.attrs)
+            fill_value = channel_attrs.pop('_FillValue')
+            my_dataset['channel'] = my_dataset.channel.where(my_dataset.channel != fill_value)
+            my_dataset.channel.attrs = channel_attrs
+        for variable in my_dataset.variables.values():
+            # encodings of the source rasters (e.g. their chunks or scale) would override or clash with ours
+            variable.encoding = {}
+            for name in ('scale_factor', 'add_offset'):
+                variable.attrs.pop(name, None)
+        my_dataset = ZarrFormat.without_scalar_coords(my_dataset)
+        my_dataset.attrs.update(self.cache_metadata())
+        my_dataset.attrs['build_id'] = uuid.uuid4().hex
+        with ZarrFormat.writing():
+            my_dataset.to_zarr(store, mode="w", compute=True, consolidated=True,
+                              encoding=ZarrFormat.full_encoding(my_dataset, self.encoding()))
+            # marked complete only once all of the data is written
+            cache_group = zarr.open_group(store, mode='r+')
+            cache_group.attrs['complete'] = 1
+            zarr.consolidate_metadata(store)
 
     def get_spatial_flood_extents(self, mim_array: DataArray):
         return SpatialFloodExtentInputs(mim_array, self.input_dataset.dem, self.input_dataset.channel)
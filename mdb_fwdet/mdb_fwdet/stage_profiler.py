@@ -0,0 +1,157 @@
+import glob
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas
+import psutil
+
+
+class StageProfiler():
+    """Time the stages of the pipeline (wall and CPU time, memory and the size of the arrays handled) per region
+    and per date. Each span is written as a JSON line to a file per process in directory (so workers can record
+    their regions' spans), and the spans of a run are aggregated by summary. A disabled profiler records nothing.
+
+    cpu_seconds is the CPU time of the thread running the span (dask workers run several regions at once in
+    threads) - it misses the threads the span's own work fans out to (e.g. BLAS), which are in
+    process_cpu_seconds along with everything else the process did meanwhile.
+
+    Usage:
+        profiler = StageProfiler('/scratch/fwdet_profile')
+        with profiler.span('interpolation', region=3) as span:
+            surface = interpolation_strategy.interpolate(perimeter_points)
+            span['array_bytes'] = surface.nbytes
+        StageProfiler.summary(StageProfiler.load('/scratch/fwdet_profile'))
+    """
+
+    def __init__(self, directory: str = None, enabled=True, trace_memory=False, context: dict = None):
+        self.directory = directory
+        """Local (or shared) directory the JSON lines are appended to (None keeps the spans in memory only)"""
+        self.enabled = enabled
+        self.trace_memory = trace_memory
+        """Also record the peak of the memory allocated by python (tracemalloc - slows the run down)"""
+        self.context = dict(context) if context is not None else {}
+        """Fields added to every span (e.g. the image date)"""
+        self.spans = []
+        """Spans recorded by this instance in this process"""
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # the spans stay with the process that recorded them (they are in the files)
+        return {'directory': self.directory, 'enabled': self.enabled, 'trace_memory': self.trace_memory,
+                'context': self.context}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def with_context(self, **context):
+        """A profiler writing to the same place with more fields added to every span"""
+        return StageProfiler(self.directory, self.enabled, self.trace_memory, dict(self.context, **context))
+
+    @contextmanager
+    def span(self, stage: str, **context):
+        """Record the stage run in the with block. The span (a dict) is yielded so fields such as array_bytes can be
+        added to it"""
+        if not self.enabled:
+            yield {}
+            return
+        record = dict(self.context, **context)
+        record['stage'] = stage
+        process = psutil.Process()
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.trace_memory:
+            tracemalloc.reset_peak()
+        start_rss = process.memory_info().rss
+        start = time.time()
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        start_process_cpu = time.process_time()
+        try:
+            yield record
+        finally:
+            record['start'] = start
+            record['wall_seconds'] = time.perf_counter() - start_wall
+            record['cpu_seconds'] = time.thread_time() - start_cpu
+            record['process_cpu_seconds'] = time.process_time() - start_process_cpu
+            record['rss_bytes'] = process.memory_info().rss
+            record['rss_change_bytes'] = record['rss_bytes'] - start_rss
+            record['peak_rss_bytes'] = StageProfiler.peak_rss_bytes()
+            if self.trace_memory:
+                record['traced_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                if tracing:
+                    tracemalloc.stop()
+            record['host'] = socket.gethostname()
+            record['pid'] = os.getpid()
+            self.emit(record)
+
+    def peak_rss_bytes() -> int:
+        """High water mark of the process's resident memory (the peak working set on windows)"""
+        try:
+            import resource
+        except ImportError:
+            # resource is unix only
+            memory_info = psutil.Process().memory_info()
+            return getattr(memory_info, 'peak_wset', memory_info.rss)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on mac
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def array_bytes(*arrays) -> int:
+        """Total size of the arrays (numpy, dask or xarray - None is skipped)"""
+        return int(sum(np.prod(array.shape) * np.dtype(array.dtype).itemsize
+                       for array in arrays if array is not None))
+
+    def emit(self, record: dict):
+        line = json.dumps(record, default=StageProfiler.json_value)
+        with self._lock:
+            self.spans.append(record)
+            if self.directory is not None:
+                os.makedirs(self.directory, exist_ok=True)
+                # one write per line so the lines of concurrent threads aren't interleaved
+                with open(self.path(), 'a') as spans_file:
+                    spans_file.write(line + '\n')
+
+    def path(self) -> str:
+        return os.path.join(self.directory, f"spans-{socket.gethostname()}-{os.getpid()}.jsonl")
+
+    def json_value(value):
+        return value.item() if hasattr(value, 'item') else str(value)
+
+    def load(directory: str) -> pandas.DataFrame:
+        """The spans written to directory by every process"""
+        records = []
+        for path in sorted(glob.glob(os.path.join(directory, 'spans-*.jsonl'))):
+            with open(path) as spans_file:
+                records.extend(json.loads(line) for line in spans_file if line.strip())
+        return pandas.DataFrame.from_records(records)
+
+    def summary(spans, by=('stage',)) -> pandas.DataFrame:
+        """Aggregate spans (a DataFrame or list of dicts) by stage (or by=('stage', 'region') etc.) - the count,
+        total, mean and max wall time, total CPU time, peak memory and array bytes, sorted by total wall time"""
+        spans = pandas.DataFrame.from_records(spans) if not isinstance(spans, pandas.DataFrame) else spans
+        if len(spans) == 0:
+            return pandas.DataFrame()
+        for column in ('array_bytes', 'traced_peak_bytes'):
+            if column not in spans:
+                spans[column] = np.nan
+        summary = spans.groupby(list(by), dropna=False).agg(
+            count=('wall_seconds', 'size'), total_wall_seconds=('wall_seconds', 'sum'),
+            mean_wall_seconds=('wall_seconds', 'mean'), max_wall_seconds=('wall_seconds', 'max'),
+            total_cpu_seconds=('cpu_seconds', 'sum'), peak_rss_bytes=('peak_rss_bytes', 'max'),
+            max_rss_change_bytes=('rss_change_bytes', 'max'), traced_peak_bytes=('traced_peak_bytes', 'max'),
+            max_array_bytes=('array_bytes', 'max'))
+        summary['share_of_wall_time'] = summary['total_wall_seconds'] / summary['total_wall_seconds'].sum()
+        return summary.sort_values('total_wall_seconds', ascending=False)
+
+    def slowest(spans, stage: str, n=5) -> pandas.DataFrame:
+        """The n slowest spans of a stage (e.g. which regions dominate interpolation)"""
+        spans = pandas.DataFrame.from_records(spans) if not isinstance(spans, pandas.DataFrame) else spans
+        return spans[spans['stage'] == stage].nlargest(n, 'wall_seconds')
@@ -0,0 +1,93 @@
+from typing import Dict, Tuple
+
+import dask
+from dask.base import tokenize
+from distributed.client import Future
+from xarray import DataArray
+
+from mdb_fwdet.region import Region
+
+
+class StaticInputCache():
+    """The DEM and channel crops of each region, loaded once onto a worker and kept there for every date.
+    Only the (small) flood extent crop needs to be sent each date, and the region's tasks are routed to the
+    worker that holds its static inputs.
+
+    Usage:
+        static_input_cache = StaticInputCache(dem, channel)
+        (static_inputs, worker) = static_input_cache.get(client, region)
+        client.submit(fn, static_inputs, ..., workers=[worker])
+    """
+
+    def __init__(self, dem: DataArray, channel: DataArray, prefix='fwdet-static-inputs'):
+        self.dem = dem
+        """DEM of the whole grid (usually lazy)"""
+        self.channel = channel
+        """Channel depth of the whole grid (usually lazy)"""
+        self.prefix = prefix
+        """Prefix of the names of the cached data on the workers"""
+        self.futures: Dict[tuple, Future] = {}
+        """Future of the (dem, channel) of each region (see entry) - held so the data stays on the workers"""
+        self.workers: Dict[tuple, str] = {}
+        """Worker holding the static inputs of each region"""
+        self.sizes: Dict[tuple, int] = {}
+        """Number of pixels of the static inputs of each region"""
+        self.pixels: Dict[str, int] = {}
+        """Number of pixels cached on each worker"""
+
+    def entry(region: Region) -> tuple:
+        """What the static inputs of a region are cached under - its number and bounding box, as the regions
+        can be tiled differently from date to date (see RegionTiler) and the numbers reused for other boxes"""
+        return (region.region_number, tuple(region.bounding_box))
+
+    def key(self, region: Region, dem: DataArray, channel: DataArray) -> str:
+        """Name of a region's static inputs on the workers (changes if the inputs do)"""
+        return f"{self.prefix}-{region.region_number}-{tokenize(dem, channel)}"
+
+    def load(dem: DataArray, channel: DataArray) -> Tuple[DataArray, DataArray]:
+        """Read the crops into memory (on the worker, straight from their source)"""
+        with dask.config.set(scheduler='synchronous'):
+            return (dem.load(), channel.load())
+
+    def choose_worker(self, client, region: Region) -> str:
+        """The worker with the fewest cached pixels"""
+        workers = sorted(client.scheduler_info()['workers'].keys())
+        return min(workers, key=lambda worker: self.pixels.get(worker, 0))
+
+    def is_available(self, client, region: Region) -> bool:
+        entry = StaticInputCache.entry(region)
+        if entry not in self.futures:
+            return False
+        if self.futures[entry].status in ('error', 'cancelled', 'lost'):
+            return False
+        return self.workers[entry] in client.scheduler_info()['workers']
+
+    def get(self, client, region: Region) -> Tuple[Future, str]:
+        """Future of the region's (dem, channel) and the worker holding it - loaded on first use (or if the
+        worker has gone)"""
+        entry = StaticInputCache.entry(region)
+        if not self.is_available(client, region):
+            self.release(region)
+            mask_bounds = region.bounding_box
+            dem = self.dem[mask_bounds[0]:mask_bounds[1],
+                           mask_bounds[2]:mask_bounds[3]]
+            channel = self.channel[mask_bounds[0]:mask_bounds[1],
+                                   mask_bounds[2]:mask_bounds[3]]
+            worker = self.choose_worker(client, region)
+            self.futures[entry] = client.submit(StaticInputCache.load, dem, channel,
+                                                key=self.key(region, dem, channel), workers=[worker])
+            self.workers[entry] = worker
+            self.sizes[entry] = dem.size
+            self.pixels[worker] = self.pixels.get(worker, 0) + dem.size
+        return (self.futures[entry], self.workers[entry])
+
+    def release(self, region: Region):
+        """Drop a region's static inputs (the workers free them once no tasks need them)"""
+        entry = StaticInputCache.entry(region)
+        future = self.futures.pop(entry, None)
+        worker = self.workers.pop(entry, None)
+        size = self.sizes.pop(entry, 0)
+        if future is None:
+            return
+        self.pixels[worker] -= size
+        future.release()
@@ -0,0 +1,193 @@
+import os
+from typing import Dict, List
+
+import numpy as np
+import rasterio
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from xarray import DataArray
+
+from mdb_fwdet.region import Region
+from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+
+
+class SyntheticScene():
+    """A deterministic flood scene for benchmarks - a DEM sloping gently across the scene and cut by meandering
+    valleys, each partly flooded to a water surface parallel to the slope, a channel raster along the valley
+    floors and patches of nodata (cloud) in the flood extent. The depth below the water surface is the true
+    depth of the wet cells. The same shape and seed always give the same scene.
+
+    Usage:
+        scene = SyntheticScene((5000, 5000))
+        spatial_inputs = scene.spatial_inputs()
+        error = estimated_depth - scene.truth
+    """
+
+    def __init__(self, shape: tuple, seed=0, valleys=4, cell_size=30.0, slope=0.0002, valley_depth=6.0,
+                 flood_height=(1.0, 4.0), noise=0.05, nodata_fraction=0.02, channel_depth=1.5,
+                 rows_per_strip=1024):
+        self.shape = tuple(shape)
+        """(rows, columns) of the scene"""
+        self.seed = seed
+        self.valleys = valleys
+        """Number of meandering valleys (running top to bottom)"""
+        self.cell_size = cell_size
+        """Size of a pixel (metres)"""
+        self.slope = slope
+        """Fall of the land (and the water surface) per metre, down the scene and across it"""
+        self.valley_depth = valley_depth
+        """Depth (metres) of the valleys below the surrounding land"""
+        self.flood_height = flood_height
+        """Range of the height (metres) of each valley's water surface above its floor"""
+        self.noise = noise
+        """Standard deviation (metres) of the noise added to the DEM"""
+        self.nodata_fraction = nodata_fraction
+        """Approximate fraction of the flood extent that is nodata (cloud)"""
+        self.channel_depth = channel_depth
+        """Depth (metres) of the channel along the valley floors (NaN elsewhere)"""
+        self.rows_per_strip = rows_per_strip
+        """Rows generated at a time (limits the temporaries) - doesn't change the scene"""
+        self._arrays = None
+
+    def valley_parameters(self) -> List[dict]:
+        """Centre line (a sinusoid down the rows), width and flood height of each valley"""
+        rng = np.random.default_rng([self.seed, 0])
+        (rows, cols) = self.shape
+        spacing = cols / self.valleys
+        return [{'centre': spacing * (valley + 0.5) + rng.uniform(-0.1, 0.1) * spacing,
+                 'amplitude': rng.uniform(0.05, 0.2) * spacing,
+                 'wavelength': rng.uniform(0.3, 1.0) * rows,
+                 'phase': rng.uniform(0, 2 * np.pi),
+                 'width': rng.uniform(0.04, 0.1) * spacing,
+                 'flood_height': rng.uniform(*self.flood_height)}
+                for valley in range(self.valleys)]
+
+    def clouds(self) -> np.ndarray:
+        """(row, column, radius) of the circular patches of nodata"""
+        rng = np.random.default_rng([self.seed, 1])
+        (rows, cols) = self.shape
+        radius = max(min(rows, cols) / 40, 2)
+        count = int(round(self.nodata_fraction * rows * cols / (np.pi * radius * radius)))
+        return np.column_stack([rng.uniform(0, rows, count), rng.uniform(0, cols, count),
+                                rng.uniform(0.5, 1.5, count) * radius])
+
+    def generate(self) -> Dict[str, np.ndarray]:
+        """dem (float32), mim (uint8 flood extent codes), channel (float32, NaN off the channel) and truth (the
+        float32 depth of the flooded cells - including those under cloud - NaN elsewhere)"""
+        if self._arrays is not None:
+            return self._arrays
+        (rows, cols) = self.shape
+        arrays = {'dem': np.empty(self.shape, dtype=np.float32),
+                  'mim': np.empty(self.shape, dtype=np.uint8),
+                  'channel': np.empty(self.shape, dtype=np.float32),
+                  'truth': np.empty(self.shape, dtype=np.float32)}
+        valleys = self.valley_parameters()
+        clouds = self.clouds()
+        col_index = np.arange(cols, dtype=np.float64)[None, :]
+        for row_start in range(0, rows, self.rows_per_strip):
+            row_end = min(row_start + self.rows_per_strip, rows)
+            row_index = np.arange(row_start, row_end, dtype=np.float64)[:, None]
+            land = 100.0 - self.slope * self.cell_size * (row_index + col_index)
+            dem = land.copy()
+            surface = np.full(dem.shape, -np.inf)
+            channel = np.zeros(dem.shape, dtype=bool)
+            for valley in valleys:
+                centre = valley['centre'] + valley['amplitude'] * np.sin(
+                    2 * np.pi * row_index / valley['wavelength'] + valley['phase'])
+                distance = np.abs(col_index - centre)
+                dem -= self.valley_depth * np.exp(-(distance / valley['width']) ** 2)
+                # the water surface is level across the valley and falls with the land along it
+                floor = 100.0 - self.slope * self.cell_size * (row_index + centre) - self.valley_depth
+                in_valley = distance < 3 * valley['width']
+                surface = np.where(in_valley, np.maximum(surface, floor + valley['flood_height']), surface)
+                channel |= distance < 2
+            # noise is drawn in fixed strips of 256 rows (seeded by the strip) so the scene doesn't depend on
+            # rows_per_strip
+            for strip_start in range(row_start - row_start % 256, row_end, 256):
+                strip_noise = np.random.default_rng([self.seed, 2, strip_start]).normal(
+                    0, self.noise, (256, cols))
+                (start, end) = (max(strip_start, row_start), min(strip_start + 256, row_end))
+                dem[start - row_start:end - row_start] += strip_noise[start - strip_start:end - strip_start]
+
+            wet = dem < surface
+            mim = np.where(wet, SpatialFloodExtentInputs.WOFS_WET_VALUE, SpatialFloodExtentInputs.WOFS_DRY_VALUE)
+            nearby = clouds[(clouds[:, 0] + clouds[:, 2] >= row_start) & (clouds[:, 0] - clouds[:, 2] < row_end)]
+            for (cloud_row, cloud_col, radius) in nearby:
+                mim[(row_index - cloud_row) ** 2 + (col_index - cloud_col) ** 2 < radius ** 2] = \
+                    SpatialFloodExtentInputs.WOFS_NODATA_VALUE
+
+            arrays['dem'][row_start:row_end] = dem
+            arrays['mim'][row_start:row_end] = mim
+            arrays['channel'][row_start:row_end] = np.where(channel, self.channel_depth, np.nan)
+            truth = np.where(wet, surface - dem, np.nan)
+            arrays['truth'][row_start:row_end] = np.where(channel & wet, truth + self.channel_depth, truth)
+        self._arrays = arrays
+        return arrays
+
+    @property
+    def truth(self) -> np.ndarray:
+        return self.generate()['truth']
+
+    def coords(self) -> dict:
+        """Latitude/longitude (1 arc second pixels) of the centres of the pixels, as the spatial inputs"""
+        (rows, cols) = self.shape
+        resolution = 1 / 3600
+        return {'y': -30.0 - (np.arange(rows) + 0.5) * resolution, 'x': 145.0 + (np.arange(cols) + 0.5) * resolution}
+
+    def spatial_inputs(self) -> SpatialFloodExtentInputs:
+        arrays = self.generate()
+        coords = self.coords()
+        return SpatialFloodExtentInputs(*[DataArray(arrays[name], coords=coords, dims=['y', 'x'])
+                                          for name in ('mim', 'dem', 'channel')])
+
+    def regions(self, per_side=2, halo=0) -> List[Region]:
+        """Split the scene into per_side x per_side regions (bounding boxes extended by halo pixels)"""
+        (rows, cols) = self.shape
+        row_edges = np.linspace(0, rows, per_side + 1).astype(int)
+        col_edges = np.linspace(0, cols, per_side + 1).astype(int)
+        regions = []
+        for (i, j) in np.ndindex(per_side, per_side):
+            core = (int(row_edges[i]), int(row_edges[i + 1]), int(col_edges[j]), int(col_edges[j + 1]))
+            bounding_box = (max(core[0] - halo, 0), min(core[1] + halo, rows),
+                            max(core[2] - halo, 0), min(core[3] + halo, cols))
+            regions.append(Region(len(regions), bounding_box, core))
+        return regions
+
+    def region_grid(self, regions: List[Region]) -> DataArray:
+        """The regions raster of the regions (each core labelled with its region's label)"""
+        grid = np.zeros(self.shape, dtype=np.uint16)
+        for region in regions:
+            (row0, row1, col0, col1) = region.core_box
+            grid[row0:row1, col0:col1] = region.label
+        return DataArray(grid, coords=self.coords(), dims=['y', 'x'])
+
+    def write_rasters(self, directory: str, crs='EPSG:3577', origin=(1000000.0, -3500000.0)) -> Dict[str, str]:
+        """Write the dem, flood extent (mim), channel and truth as geotiffs (in a projected crs with pixels of
+        cell_size metres, top left at origin). Returns the path of each"""
+        arrays = self.generate()
+        (rows, cols) = self.shape
+        transform = from_origin(origin[0], origin[1], self.cell_size, self.cell_size)
+        paths = {}
+        for (name, nodata) in (('dem', np.nan), ('mim', None), ('channel', np.nan), ('truth', np.nan)):
+            paths[name] = os.path.join(directory, f'{name}.tif')
+            with rasterio.open(paths[name], 'w', driver='GTiff', height=rows, width=cols, count=1,
+                               dtype=arrays[name].dtype, crs=crs, transform=transform, nodata=nodata,
+                               tiled=True, blockxsize=512, blockysize=512) as raster:
+                raster.write(arrays[name], 1)
+        return paths
+
+    def bounds(self, origin=(1000000.0, -3500000.0)) -> tuple:
+        """(left, bottom, right, top) of the rasters written by write_rasters"""
+        (rows, cols) = self.shape
+        return (origin[0], origin[1] - rows * self.cell_size, origin[0] + cols * self.cell_size, origin[1])
+
+    def thalweg_coordinates(self, valley=0, count=2, crs='EPSG:3577', origin=(1000000.0, -3500000.0)) -> list:
+        """(longitude, latitude) of points spread down the floor of a valley of the rasters written by
+        write_rasters (e.g. the sample points of TvdOutputs)"""
+        parameters = self.valley_parameters()[valley]
+        rows = np.linspace(0.1, 0.9, count) * self.shape[0]
+        cols = parameters['centre'] + parameters['amplitude'] * np.sin(
+            2 * np.pi * rows / parameters['wavelength'] + parameters['phase'])
+        transformer = Transformer.from_crs(crs, 'EPSG:4326', always_xy=True)
+        return [transformer.transform(origin[0] + (col + 0.5) * self.cell_size, origin[1] - (row + 0.5) * self.cell_size)
+                for (row, col) in zip(rows, cols)]
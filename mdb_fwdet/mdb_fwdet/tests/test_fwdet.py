@@ -2,18 +2,43 @@ import logging
 import unittest
 from pathlib import Path
 import os
+import pickle
+import tempfile
 import numpy as np
+import rasterio
+import pandas
 import xarray as xr
+import zarr
+from scipy.spatial import cKDTree
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import RBF
 
 from mdb_fwdet.bimonth_time_range import BimonthTimeRange
+from mdb_fwdet.cog_writer import CogWriter
+from mdb_fwdet.configuration import Configuration
 from mdb_fwdet.delaunay_triangulation_interpolation_strategy import DelaunayTriangulationInterpolationStrategy
+from mdb_fwdet.euclidean_allocation_interpolation_strategy import EuclideanAllocationInterpolationStrategy
 from mdb_fwdet.flood_depth_engine import FloodDepthEngine
 from mdb_fwdet.fwdet_estimator import FwdetEstimator
+from mdb_fwdet.geotiff_utils import GeotiffUtils
+from mdb_fwdet.interpolation_budget import InterpolationBudget
 from mdb_fwdet.kriging_interpolation_strategy import KrigingInterpolationStrategy
+from mdb_fwdet.lattice_upsampler import LatticeUpsampler
+from mdb_fwdet.local_kriging_engine import LocalKrigingEngine
+from mdb_fwdet.local_static_input_store import LocalStaticInputStore, MemmapArray
+from mdb_fwdet.lumped_lattice import LumpedLattice
+from mdb_fwdet.perimeter_points import PerimeterPoints
 from mdb_fwdet.region import Region
 from mdb_fwdet.region_definition import RegionDefinition
+from mdb_fwdet.region_depth_cache import RegionDepthCache
+from mdb_fwdet.region_tiler import RegionTiler
 from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
+from mdb_fwdet.spatial_input_helper import SpatialInputHelper
+from mdb_fwdet.stage_profiler import StageProfiler
+from mdb_fwdet.synthetic_scene import SyntheticScene
+from mdb_fwdet.tiled_tps_interpolation_strategy import TiledTpsInterpolationStrategy
 from mdb_fwdet.tps_interpolation_strategy import TpsInterpolationStrategy
+from mdb_fwdet.zarr_format import ZarrFormat
 
 logging.getLogger().setLevel('INFO')
 
@@ -77,6 +102,86 @@ class TestFwdetInterp(unittest.TestCase):
         self.assertTrue(np.array_equal(mock_spatial_inputs.channel.to_numpy(),
                                        cropped_spatial_inputs.channel.to_numpy(), True), "Should be same data - Channel")
 
+    def test_perimeter_points(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        perimeter_points = PerimeterPoints.from_flood_extent(
+            mock_spatial_inputs.mim_array, mock_spatial_inputs.dem, chunks=6)
+
+        wet = mock_spatial_inputs.mim_array.to_numpy() == SpatialFloodExtentInputs.WOFS_WET_VALUE
+        border = np.zeros_like(wet)
+        for (row, col) in zip(*np.nonzero(wet)):
+            border[max(row-1, 0):row+2, max(col-1, 0):col+2] = True
+        border = border & ~wet
+        dem_extract = np.where(border, mock_spatial_inputs.dem.to_numpy(), 0)
+        expected_points = PerimeterPoints.from_dem_extract(dem_extract)
+
+        self.assertEqual(perimeter_points.shape, (25, 25))
+        self.assertEqual(perimeter_points.rows.dtype, np.int32)
+        self.assertEqual(perimeter_points.elevations.dtype, np.float32)
+        self.assertEqual(len(perimeter_points), np.count_nonzero(border))
+        order = np.lexsort((perimeter_points.cols, perimeter_points.rows))
+        self.assertTrue(np.array_equal(perimeter_points.rows[order], expected_points.rows))
+        self.assertTrue(np.array_equal(perimeter_points.cols[order], expected_points.cols))
+        self.assertTrue(np.array_equal(perimeter_points.elevations[order], expected_points.elevations))
+
+        # border cells at an elevation of 0.0 are dropped from the flood extent as from the dense extract
+        dem = mock_spatial_inputs.dem.copy()
+        (row, col) = np.argwhere(border)[3]
+        dem[row, col] = 0.0
+        perimeter_points = PerimeterPoints.from_flood_extent(mock_spatial_inputs.mim_array, dem, chunks=6)
+        expected_points = PerimeterPoints.from_dem_extract(np.where(border, dem.to_numpy(), 0))
+        self.assertEqual(len(perimeter_points), np.count_nonzero(border) - 1)
+        order = np.lexsort((perimeter_points.cols, perimeter_points.rows))
+        self.assertTrue(np.array_equal(perimeter_points.rows[order], expected_points.rows))
+        self.assertTrue(np.array_equal(perimeter_points.cols[order], expected_points.cols))
+
+    def test_lumped_lattice(self):
+        averaging_constant = 7
+        random = np.random.default_rng(42)
+        rows = random.integers(0, 95, 500)
+        cols = random.integers(0, 61, 500)
+        elevations = random.uniform(100, 110, 500)
+        perimeter_points = PerimeterPoints(rows, cols, elevations, (95, 61))
+        lattice = LumpedLattice(perimeter_points.shape, averaging_constant)
+        (coords, means) = lattice.lump(perimeter_points)
+
+        # Compare with a pandas groupby over every point/pixel
+        lumped_df = pandas.DataFrame({"X": (perimeter_points.cols+averaging_constant//2)//averaging_constant,
+                                      "Y": (perimeter_points.rows+averaging_constant//2)//averaging_constant,
+                                      "Z": perimeter_points.elevations.astype(np.float64)})
+        expected = lumped_df.groupby(['X', 'Y']).mean().reset_index().to_numpy()
+        self.assertTrue(np.array_equal(coords, expected[:, [0, 1]]))
+        self.assertTrue(np.allclose(means, expected[:, [2]], rtol=0, atol=1e-9))
+
+        xx, yy = np.meshgrid(np.arange(0, 61), np.arange(0, 95))
+        entire_region_df = pandas.DataFrame({"X": (xx.ravel()+averaging_constant//2)//averaging_constant,
+                                             "Y": (yy.ravel()+averaging_constant//2)//averaging_constant})
+        expected_lattice = entire_region_df.groupby(['X', 'Y']).size().reset_index().to_numpy()[:, 0:2]
+        self.assertTrue(np.array_equal(lattice.coordinates(), expected_lattice))
+
+    def test_lattice_upsampler(self):
+        lattice = LumpedLattice((47, 33), 5)
+        coordinates = lattice.coordinates()
+        # a plane is reproduced exactly by bilinear interpolation
+        plane = 100 + 0.5 * coordinates[:, 0] - 0.25 * coordinates[:, 1]
+
+        upsampler = LatticeUpsampler(lattice, 'linear', np.float64, rows_per_block=10)
+        filled = upsampler.upsample(plane)
+        xx, yy = np.meshgrid(np.arange(0, 33), np.arange(0, 47))
+        expected = 100 + 0.5 * xx / 5 - 0.25 * yy / 5
+        # nan beyond the last lattice node (the same as griddata)
+        expected[yy > 45] = np.nan
+        expected[xx > 30] = np.nan
+        self.assertTrue(np.allclose(filled, expected, equal_nan=True))
+
+        filled_dask = upsampler.upsample_dask(plane, (9, 8)).compute()
+        self.assertTrue(np.array_equal(filled, filled_dask, equal_nan=True))
+
+        nearest = LatticeUpsampler(lattice, 'nearest').upsample(plane)
+        self.assertEqual(nearest.dtype, np.float64)
+        self.assertFalse(np.any(np.isnan(nearest)))
+        self.assertTrue(np.allclose(nearest[::5, ::5], plane.reshape((7, 10)).T))
+
     def test_fwdet_estimator_tps(self):
         mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
         mock_region = Region(0, (0, 25, 0, 25))
@@ -87,6 +192,51 @@ class TestFwdetInterp(unittest.TestCase):
             mock_spatial_inputs, [mock_region])
         logging.info(str(water_depth.to_numpy()))
 
+    def test_tiled_tps(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        perimeter_points = PerimeterPoints.from_flood_extent(
+            mock_spatial_inputs.mim_array, mock_spatial_inputs.dem)
+        wet = mock_spatial_inputs.mim_array.to_numpy() == SpatialFloodExtentInputs.WOFS_WET_VALUE
+
+        global_surface = TpsInterpolationStrategy(1, None).interpolate(perimeter_points)
+        tiled_tps_interpolation_strategy = TiledTpsInterpolationStrategy(
+            1, tile_size=8, overlap=3, max_points_per_tile=100, min_points_per_tile=8, max_workers=2)
+        tiled_surface = tiled_tps_interpolation_strategy.interpolate(perimeter_points)
+
+        logging.info(str(np.abs(global_surface - tiled_surface)[wet]))
+        self.assertFalse(np.any(np.isnan(tiled_surface[wet])))
+        self.assertTrue(np.allclose(global_surface[wet], tiled_surface[wet], atol=0.05),
+                        "Tiled thin plate spline should be close to the global solution")
+
+        fwdet_estimator = FwdetEstimator(tiled_tps_interpolation_strategy)
+        water_depth = fwdet_estimator.calculate(
+            mock_spatial_inputs, [Region(0, (0, 25, 0, 25))])
+        logging.info(str(water_depth.to_numpy()))
+
+    def test_tiled_tps_collinear(self):
+        # a straight channel across the top, scattered perimeter points across the bottom
+        border_elevations = np.full((40, 40), np.nan)
+        border_elevations[5, :] = 1 + 0.01 * np.arange(40)
+        generator = np.random.default_rng(0)
+        (rows, cols) = (generator.integers(25, 40, 60), generator.integers(0, 40, 60))
+        border_elevations[rows, cols] = 2 + 0.01 * rows
+        tiled_tps_interpolation_strategy = TiledTpsInterpolationStrategy(
+            1, tile_size=10, overlap=2, min_points_per_tile=5)
+        with self.assertLogs(level='WARNING') as logs:
+            surface = tiled_tps_interpolation_strategy.interpolate(border_elevations)
+        self.assertTrue(any('collinear' in message for message in logs.output))
+        # the tiles along the channel borrow points from further away rather than being left empty
+        self.assertFalse(np.any(np.isnan(surface)))
+        self.assertTrue(np.allclose(surface[5, :], border_elevations[5, :]))
+
+        # with nothing but the channel the tiles take the nearest point's elevation
+        channel_only = np.where(np.arange(40)[:, None] == 5, border_elevations, np.nan)
+        with self.assertLogs(level='WARNING') as logs:
+            surface = tiled_tps_interpolation_strategy.interpolate(channel_only)
+        self.assertTrue(any('nearest point' in message for message in logs.output))
+        self.assertFalse(np.any(np.isnan(surface)))
+        self.assertTrue(np.allclose(surface[20, :], border_elevations[5, :]))
+
     def test_fwdet_estimator_kriging(self):
         mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
         mock_region = Region(0, (0, 25, 0, 25))
@@ -98,6 +248,27 @@ class TestFwdetInterp(unittest.TestCase):
 
         logging.info(str(water_depth.to_numpy()))
 
+    def test_local_kriging(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        perimeter_points = PerimeterPoints.from_flood_extent(
+            mock_spatial_inputs.mim_array, mock_spatial_inputs.dem)
+
+        exact_surface = KrigingInterpolationStrategy(1).interpolate(perimeter_points)
+        local_surface = KrigingInterpolationStrategy(
+            1, 'local', tile_size=8).interpolate(perimeter_points)
+        self.assertTrue(np.allclose(exact_surface, local_surface, atol=0.001))
+
+        # with fixed hyper-parameters the tiled neighbourhoods approximate the exact gaussian process
+        lattice = LumpedLattice(perimeter_points.shape, 1)
+        (coords, actual) = lattice.lump(perimeter_points)
+        residual = actual - actual.mean()
+        exact = GaussianProcessRegressor(kernel=RBF(1.5), alpha=1e-4, optimizer=None).fit(coords, residual)
+        local = LocalKrigingEngine(RBF(1.5), tile_size=4, search_radius=12, alpha=1e-4)
+        local.fit(coords, residual)
+        local.kernel_ = RBF(1.5)
+        self.assertTrue(np.allclose(exact.predict(lattice.coordinates()).ravel(),
+                                    local.predict(lattice.coordinates()), atol=0.001))
+
     def test_fwdet_estimator_delaunay(self):
         mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
         mock_region = Region(0, (0, 25, 0, 25))
@@ -108,6 +279,130 @@ class TestFwdetInterp(unittest.TestCase):
             mock_spatial_inputs, [mock_region])
         logging.info(str(water_depth.to_numpy()))
 
+    def test_fwdet_estimator_chunked(self):
+        mock_region = Region(0, (0, 25, 0, 25))
+        for interpolation_strategy in [TpsInterpolationStrategy(1, 7), DelaunayTriangulationInterpolationStrategy()]:
+            fwdet_estimator = FwdetEstimator(interpolation_strategy)
+            water_depth = fwdet_estimator.calculate(
+                TestFwdetInterp.generate_mock_spatial_inputs(), [mock_region])
+
+            chunked_fwdet_estimator = FwdetEstimator(
+                interpolation_strategy, chunked=True, chunks=7)
+            chunked_water_depth = chunked_fwdet_estimator.calculate(
+                TestFwdetInterp.generate_mock_spatial_inputs(), [mock_region])
+
+            self.assertEqual(chunked_water_depth.dtype, np.uint16)
+            self.assertTrue(np.array_equal(water_depth.to_numpy(), chunked_water_depth.to_numpy()),
+                            f"Chunked and whole of region depths should be the same ({type(interpolation_strategy).__name__})")
+
+    def baseline_encoding(filled, spatial_inputs: SpatialFloodExtentInputs):
+        """The uint16 mm encoding of the original FwdetEstimator (a chain of xarray.where over float64 arrays),
+        and the depth in mm it was rounded from"""
+        mim = spatial_inputs.mim_array
+        water_depth = filled - spatial_inputs.dem.astype(np.float64)
+        water_depth = xr.where(mim == SpatialFloodExtentInputs.WOFS_WET_VALUE, water_depth, np.nan)
+        channel = xr.where(np.isnan(spatial_inputs.channel), 0, spatial_inputs.channel.astype(np.float64))
+        water_depth = xr.where(~np.isnan(water_depth), water_depth + channel, np.nan)
+        water_depth = xr.where(water_depth <= 0, 0.001, water_depth)
+        water_depth = xr.where(water_depth > 65.534, 65.534, water_depth)
+        water_depth = xr.where(np.isnan(water_depth), 65.535, water_depth)
+        water_depth = xr.where(mim == SpatialFloodExtentInputs.WOFS_DRY_VALUE, 0, water_depth)
+        return (np.rint(water_depth * 1000).astype(np.uint16).to_numpy(), (water_depth * 1000).to_numpy())
+
+    def test_fwdet_estimator_dtypes(self):
+        # a floodplain at 150m (where float32 resolves about 0.008mm) with a float32 DEM and channel, as read
+        # from their rasters
+        n = 60
+        coords = np.arange(n) - n / 2
+        (xx, yy) = np.meshgrid(coords, coords)
+        generator = np.random.default_rng(0)
+        dem = (152.37 + 1.3 * ((xx / 9) ** 2 + (yy / 11) ** 2) + generator.normal(0, 0.05, (n, n))).astype(np.float32)
+        mim = np.where(dem < 153.5, SpatialFloodExtentInputs.WOFS_WET_VALUE,
+                       SpatialFloodExtentInputs.WOFS_DRY_VALUE).astype(np.uint8)
+        mim[:3, :5] = SpatialFloodExtentInputs.WOFS_NODATA_VALUE
+        channel = np.where(dem < 152.6, generator.uniform(0.1, 0.6, (n, n)), np.nan).astype(np.float32)
+        spatial_inputs = SpatialFloodExtentInputs(*[xr.DataArray(array, coords={'y': coords, 'x': coords},
+                                                                 dims=['y', 'x']) for array in (mim, dem, channel)])
+        region = Region(0, (0, n, 0, n))
+        perimeter_points = PerimeterPoints.from_flood_extent(spatial_inputs.mim_array, spatial_inputs.dem)
+
+        # by default the estimator encodes exactly as the original, whatever the blocks and masks
+        tps_interpolation_strategy = TpsInterpolationStrategy(1, 30)
+        (lattice, lattice_values) = tps_interpolation_strategy.interpolate_lattice(perimeter_points)
+        float64_surfaces = [
+            (tps_interpolation_strategy, LatticeUpsampler(lattice).upsample(lattice_values)),
+            (DelaunayTriangulationInterpolationStrategy(), DelaunayTriangulationInterpolationStrategy().interpolate(
+                perimeter_points))]
+        for (interpolation_strategy, float64_surface) in float64_surfaces:
+            name = type(interpolation_strategy).__name__
+            self.assertEqual(float64_surface.dtype, np.float64)
+            (reference, _) = TestFwdetInterp.baseline_encoding(float64_surface, spatial_inputs)
+            for fwdet_estimator in [FwdetEstimator(interpolation_strategy),
+                                    FwdetEstimator(interpolation_strategy, chunks=7, pack_masks=True),
+                                    FwdetEstimator(interpolation_strategy, chunked=True, chunks=7)]:
+                water_depth = fwdet_estimator.calculate(spatial_inputs, region).to_numpy()
+                self.assertEqual(water_depth.dtype, np.uint16)
+                self.assertTrue(np.array_equal(water_depth, reference), name)
+
+        # float32 surfaces (opted in to) differ by at most a mm, where the depth is within float32 rounding of
+        # half a mm
+        float32_strategies = [tps_interpolation_strategy, DelaunayTriangulationInterpolationStrategy(dtype=np.float32)]
+        for (interpolation_strategy, (_, float64_surface)) in zip(float32_strategies, float64_surfaces):
+            name = type(interpolation_strategy).__name__
+            (reference, reference_mm) = TestFwdetInterp.baseline_encoding(float64_surface, spatial_inputs)
+            for fwdet_estimator in [FwdetEstimator(interpolation_strategy, dtype=np.float32),
+                                    FwdetEstimator(interpolation_strategy, dtype=np.float32, chunks=7,
+                                                   pack_masks=True),
+                                    FwdetEstimator(interpolation_strategy, dtype=np.float32, chunked=True, chunks=7)]:
+                water_depth = fwdet_estimator.calculate(spatial_inputs, region).to_numpy()
+                changed = water_depth != reference
+                self.assertLessEqual(np.abs(water_depth.astype(int) - reference)[changed].max(initial=0), 1, name)
+                self.assertTrue((np.abs(reference_mm[changed] % 1 - 0.5) < 0.02).all(), name)
+                self.assertLess(changed.mean(), 0.01, name)
+
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        # packed masks unpack to the boolean masks (including a partial byte at the end of each row)
+        mim = mock_spatial_inputs.mim_array.to_numpy()
+        masks = FwdetEstimator.flood_masks(mim, 10, pack_masks=True)
+        self.assertEqual(masks[0].shape, (25, 4))
+        (wet, dry) = FwdetEstimator.mask_rows(masks, slice(5, 20), 25)
+        self.assertEqual(wet.dtype, bool)
+        self.assertTrue(np.array_equal(wet, mim[5:20] == SpatialFloodExtentInputs.WOFS_WET_VALUE))
+        self.assertTrue(np.array_equal(dry, mim[5:20] == SpatialFloodExtentInputs.WOFS_DRY_VALUE))
+
+    def test_stage_profiler(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_list = RegionDefinition.dict_to_regions(
+            RegionDefinition.MOCK_REGIONS)
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(mock_region_list,
+                                                                        mock_spatial_inputs.channel)
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = StageProfiler(directory, trace_memory=True).with_context(image_date='2011-01-01')
+            fwdet_estimator = FwdetEstimator(DelaunayTriangulationInterpolationStrategy())
+            fwdet_estimator.profiler = profiler
+            flood_depth_engine = FloodDepthEngine(
+                mock_spatial_inputs, RegionDefinition(mock_region_list, mock_region_grid), fwdet_estimator, profiler)
+            flood_depth_engine.merge_results_into_one_raster(flood_depth_engine.calculate())
+
+            spans = StageProfiler.load(directory)
+            self.assertEqual(len(spans), 4 * 3 + 1)
+            self.assertEqual(set(spans['image_date']), {'2011-01-01'})
+            self.assertEqual(sorted(spans[spans['stage'] == 'interpolation']['region']), [0, 1, 2, 3])
+            self.assertTrue((spans['wall_seconds'] >= 0).all() and (spans['traced_peak_bytes'] > 0).all())
+
+            summary = StageProfiler.summary(spans)
+            self.assertEqual(set(summary.index), {'border_extraction', 'interpolation', 'encode', 'merge'})
+            self.assertEqual(summary.loc['interpolation', 'count'], 4)
+            self.assertAlmostEqual(summary['share_of_wall_time'].sum(), 1)
+            self.assertEqual(len(StageProfiler.summary(spans, by=('stage', 'region'))), 4 * 3 + 1)
+            self.assertEqual(len(StageProfiler.slowest(spans, 'encode', 2)), 2)
+
+        # a disabled profiler records nothing
+        disabled = StageProfiler(enabled=False)
+        with disabled.span('interpolation') as span:
+            span['array_bytes'] = 1
+        self.assertEqual(disabled.spans, [])
+
     def test_fwdet_engine(self):
         mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
         mock_region_list = RegionDefinition.dict_to_regions(
@@ -141,6 +436,325 @@ class TestFwdetInterp(unittest.TestCase):
         self.assertTrue(not (np.array_equal(whole_of_region_depth.to_numpy()[0:12, 0:25],
                                             global_water_depth.to_numpy()[0:12, 0:25], True)), "Data for the lower half should be the same - compute by region vs compute altogether")
 
+    def test_cog_writer(self):
+        (height, width) = (300, 411)
+        data = np.random.default_rng(0).integers(
+            0, 3000, (height, width)).astype(np.uint16)
+        raster = xr.DataArray(data, coords={'y': np.arange(height) * -25.0, 'x': np.arange(width) * 25.0},
+                              dims=["y", "x"])
+        with tempfile.TemporaryDirectory() as directory:
+            # in memory and dask backed (with blocks that don't line up with the tiles or overviews)
+            for (name, source) in [('numpy.tif', raster), ('dask.tif', raster.chunk(97))]:
+                path = os.path.join(directory, name)
+                CogWriter(path, blocksize=64, overview_levels=(2, 4, 8)).write(
+                    GeotiffUtils.add_georef(source))
+                with rasterio.open(path) as cog:
+                    self.assertTrue(np.array_equal(cog.read(1), data))
+                    self.assertEqual(cog.overviews(1), [2, 4, 8])
+                    self.assertEqual(cog.nodata, 65535)
+                    for factor in cog.overviews(1):
+                        overview = cog.read(1, out_shape=(-(-height // factor), -(-width // factor)))
+                        self.assertTrue(np.array_equal(overview, data[::factor, ::factor]))
+
+    def test_region_tiler(self):
+        # two irregular regions (labels 1 and 2) with nodata around them
+        (height, width) = (200, 300)
+        (yy, xx) = np.mgrid[0:height, 0:width]
+        grid = np.full((height, width), 65535, dtype=np.uint16)
+        grid[(yy - 100) ** 2 + (xx - 90) ** 2 < 80 ** 2] = 1
+        grid[(yy > 30) & (yy < 190) & (xx >= 170) & (xx < 290)] = 2
+        grid_xr = xr.DataArray(grid, dims=["y", "x"])
+
+        tiler = RegionTiler(target_tiles=8, halo=5, cell_size=8, min_tile_size=16)
+        for region_grid in [grid_xr, grid_xr.chunk(64)]:
+            regions = tiler.tile(region_grid)
+            self.assertEqual(len(regions), 8)
+            self.assertEqual([region.region_number for region in regions], list(range(8)))
+            for label in [1, 2]:
+                # the cores of a label's tiles cover each of its pixels exactly once
+                coverage = np.zeros((height, width), dtype=int)
+                for region in regions:
+                    if region.label == label:
+                        (row0, row1, col0, col1) = region.core_box
+                        coverage[row0:row1, col0:col1] += 1
+                        self.assertEqual(region.bounding_box, (max(row0 - 5, 0), min(row1 + 5, height),
+                                                               max(col0 - 5, 0), min(col1 + 5, width)))
+                self.assertTrue(np.all(coverage[grid == label] == 1))
+            areas = [(region.core_box[1] - region.core_box[0]) * (region.core_box[3] - region.core_box[2])
+                     for region in regions]
+            self.assertLess(max(areas), 3 * min(areas))
+
+    def test_fwdet_engine_tiles(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(
+            RegionDefinition.dict_to_regions(RegionDefinition.MOCK_REGIONS), mock_spatial_inputs.channel)
+        # halos as big as the grid - every tile sees everything so the seams match the global calculation
+        tiles = RegionTiler(target_tiles=6, halo=25, cell_size=4, min_tile_size=4).tile(mock_region_grid)
+        self.assertEqual(len(tiles), 6)
+
+        fwdet_estimator = FwdetEstimator(DelaunayTriangulationInterpolationStrategy())
+        flood_depth_engine = FloodDepthEngine(
+            mock_spatial_inputs, RegionDefinition(tiles, mock_region_grid), fwdet_estimator)
+        whole_of_region_depth = flood_depth_engine.merge_results_into_one_raster(
+            flood_depth_engine.calculate())
+        global_water_depth = fwdet_estimator.calculate(
+            mock_spatial_inputs, Region(0, (0, 25, 0, 25)))
+        self.assertTrue(np.array_equal(whole_of_region_depth.to_numpy(), global_water_depth.to_numpy()))
+
+    def write_mock_rasters(directory: str):
+        """Regions, DEM and channel rasters (as the inputs on s3) for the mock spatial inputs"""
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(
+            RegionDefinition.dict_to_regions(RegionDefinition.MOCK_REGIONS), mock_spatial_inputs.channel)
+        channel = mock_spatial_inputs.dem.copy(data=np.where(
+            mock_spatial_inputs.dem < 1, 0.123456789, np.nan))
+        locations = {}
+        for (name, raster, dtype, nodata) in [('region', mock_region_grid, 'int32', -1),
+                                              ('dem', mock_spatial_inputs.dem, 'float32', None),
+                                              ('channel', channel, 'float64', None)]:
+            locations[name] = os.path.join(directory, f'{name}.tif')
+            raster = raster.astype(dtype).rio.write_crs("EPSG:4326")
+            if nodata is not None:
+                raster = raster.rio.write_nodata(nodata, encoded=False)
+            raster.rio.to_raster(locations[name])
+        return (locations, mock_region_grid, channel)
+
+    def test_spatial_input_cache(self):
+        original_locations = (Configuration.region_raster_location, Configuration.dem_raster_location,
+                              Configuration.channel_raster_location)
+        with tempfile.TemporaryDirectory() as directory:
+            (locations, mock_region_grid, channel) = TestFwdetInterp.write_mock_rasters(directory)
+            try:
+                (Configuration.region_raster_location, Configuration.dem_raster_location,
+                 Configuration.channel_raster_location) = (locations['region'], locations['dem'], locations['channel'])
+                cache_location = os.path.join(directory, 'inputs.zarr')
+                static_input_versions = []
+                for channel_encoding in ['float32', 'scaled']:
+                    spatial_input_helper = SpatialInputHelper(cache_location, channel_encoding=channel_encoding)
+                    cached = spatial_input_helper.input_dataset
+                    static_input_versions.append(spatial_input_helper.static_input_version)
+                    self.assertEqual(cached.attrs['complete'], 1)
+                    self.assertEqual(cached.attrs['channel_encoding'], channel_encoding)
+                    compressor = ZarrFormat.array_compressor(zarr.open_array(cache_location, path='dem', mode='r'))
+                    self.assertEqual((compressor.cname, compressor.clevel), ('zstd', 3))
+                    self.assertEqual(cached.dem.dtype, np.float32)
+                    self.assertTrue(np.array_equal(cached.regions.to_numpy(), mock_region_grid.to_numpy()))
+                    np.testing.assert_allclose(cached.channel.to_numpy(), channel.to_numpy(), atol=0.0005)
+
+                # the memory mapped copy reads the same values as the cache
+                local_helper = SpatialInputHelper(cache_location, channel_encoding='scaled',
+                                                  local_store_location=os.path.join(directory, 'static'))
+                self.assertIsNotNone(local_helper.local_store)
+                self.assertTrue(local_helper.input_dataset.dem.equals(cached.dem))
+
+                # the version of the cache changes when it is rebuilt in place, not when it is reused
+                self.assertNotEqual(static_input_versions[0], static_input_versions[1])
+                self.assertEqual(local_helper.static_input_version, static_input_versions[1])
+
+                # a cache for another format is rebuilt, a valid one is reused
+                self.assertFalse(spatial_input_helper._is_valid(cached.assign_attrs(cache_format_version=1)))
+                self.assertTrue(spatial_input_helper._is_valid(cached))
+            finally:
+                (Configuration.region_raster_location, Configuration.dem_raster_location,
+                 Configuration.channel_raster_location) = original_locations
+
+    def test_ingest_mim_input(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        original_format_strings = (Configuration.image_date_format_string, Configuration.mim_store_format_string)
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                Configuration.image_date_format_string = os.path.join(directory, 'mim_{image_date}.tif')
+                Configuration.mim_store_format_string = os.path.join(directory, 'mim_{image_date}.zarr')
+                mock_spatial_inputs.mim_array.astype('uint8').rio.write_crs("EPSG:4326").rio.to_raster(
+                    SpatialFloodExtentInputs.mim_input_location('2011-01-01'))
+                from_raster = SpatialFloodExtentInputs.load_mim_input('2011-01-01')
+                self.assertFalse(SpatialFloodExtentInputs.is_ingested(
+                    SpatialFloodExtentInputs.mim_store_location('2011-01-01')))
+
+                SpatialFloodExtentInputs.ingest_mim_input('2011-01-01', chunk_size=10)
+                self.assertTrue(SpatialFloodExtentInputs.is_ingested(
+                    SpatialFloodExtentInputs.mim_store_location('2011-01-01')))
+                from_store = SpatialFloodExtentInputs.load_mim_input('2011-01-01')
+                self.assertEqual(from_store.chunks, ((10, 10, 5), (10, 10, 5)))
+                self.assertEqual(from_store.dtype, np.uint8)
+                self.assertEqual(from_store.attrs['image_date'], '2011-01-01')
+                window = SpatialFloodExtentInputs.read_window(from_store[5:20, 3:18])
+                self.assertTrue(np.array_equal(window.to_numpy(), from_raster[5:20, 3:18].to_numpy()))
+            finally:
+                (Configuration.image_date_format_string, Configuration.mim_store_format_string) = \
+                    original_format_strings
+
+    def test_aligned_chunk_size(self):
+        regions = RegionDefinition.dict_to_regions(RegionDefinition.MDB_REGIONS)
+        chunk_size = SpatialInputHelper.aligned_chunk_size(regions)
+        self.assertIn(chunk_size, range(1024, 4097, 512))
+        # one region on a chunk boundary reads just its own chunks
+        self.assertEqual(SpatialInputHelper.aligned_chunk_size([Region(0, (2048, 4096, 0, 2048))]), 2048)
+
+    def test_local_static_input_store(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(
+            RegionDefinition.dict_to_regions(RegionDefinition.MOCK_REGIONS), mock_spatial_inputs.channel)
+        input_dataset = xr.Dataset({'regions': mock_region_grid.astype(np.uint16), 'dem': mock_spatial_inputs.dem,
+                                    'channel': mock_spatial_inputs.channel}).rename({'x': 'longitude', 'y': 'latitude'})
+        input_dataset.attrs['cache_format_version'] = 2
+        with tempfile.TemporaryDirectory() as directory:
+            local_store = LocalStaticInputStore(os.path.join(directory, 'static'))
+            self.assertFalse(local_store.is_valid(input_dataset))
+            local_store.materialise(input_dataset.chunk(10))
+            self.assertTrue(local_store.is_valid(input_dataset))
+            self.assertFalse(local_store.is_valid(input_dataset.assign_attrs(cache_format_version=3)))
+
+            stored = local_store.open()
+            self.assertEqual(stored.dem.dtype, np.float32)
+            self.assertTrue(np.array_equal(stored.regions.to_numpy(), input_dataset.regions.to_numpy()))
+            self.assertTrue(np.array_equal(stored.dem.to_numpy(), input_dataset.dem.to_numpy().astype(np.float32)))
+
+            # crops are views of the maps
+            spatial_inputs = SpatialFloodExtentInputs(mock_spatial_inputs.mim_array.rename(
+                {'x': 'longitude', 'y': 'latitude'}), stored.dem, stored.channel)
+            cropped = spatial_inputs.crop(Region(0, (5, 20, 3, 18)))
+            self.assertTrue(np.shares_memory(cropped.dem.data, stored.dem.data))
+            self.assertTrue(np.shares_memory(cropped.channel.data, stored.channel.data))
+
+            # dask backed - only the path is pickled
+            chunked = local_store.open(chunks=10)
+            self.assertTrue(chunked.dem.equals(stored.dem))
+            memmap_array = MemmapArray(local_store.path('dem.npy'), stored.dem.shape, stored.dem.dtype)
+            memmap_array[0:2, 0:2]
+            self.assertLess(len(pickle.dumps(memmap_array)), 1000)
+            self.assertTrue(np.array_equal(pickle.loads(pickle.dumps(memmap_array))[0:2, 0:2],
+                                           stored.dem.to_numpy()[0:2, 0:2]))
+
+    def test_synthetic_scene(self):
+        scene = SyntheticScene((300, 200), rows_per_strip=64)
+        arrays = scene.generate()
+        # the same scene whatever the strips it is generated in
+        same_scene = SyntheticScene((300, 200), rows_per_strip=1024).generate()
+        for name in ('dem', 'mim', 'channel', 'truth'):
+            self.assertTrue(np.array_equal(arrays[name], same_scene[name], equal_nan=True))
+        self.assertFalse(np.array_equal(arrays['dem'], SyntheticScene((300, 200), seed=1).generate()['dem']))
+
+        wet = arrays['mim'] == SpatialFloodExtentInputs.WOFS_WET_VALUE
+        self.assertEqual(arrays['dem'].dtype, np.float32)
+        self.assertEqual(set(np.unique(arrays['mim'])), {0, 2, 3})
+        self.assertTrue(0 < wet.mean() < 0.5)
+        # the truth includes the water hidden by cloud
+        self.assertTrue((wet <= ~np.isnan(arrays['truth'])).all())
+        self.assertTrue((np.isnan(arrays['truth'][arrays['mim'] == SpatialFloodExtentInputs.WOFS_DRY_VALUE])).all())
+        self.assertTrue((arrays['truth'][wet] > 0).all())
+        # the channel runs along the flooded valley floors
+        self.assertTrue((~np.isnan(arrays['truth'][~np.isnan(arrays['channel'])])).mean() > 0.95)
+
+        regions = scene.regions(per_side=2, halo=5)
+        self.assertEqual(regions[3].core_box, (150, 300, 100, 200))
+        self.assertEqual(regions[3].bounding_box, (145, 300, 95, 200))
+        self.assertEqual(set(np.unique(scene.region_grid(regions))), {1, 2, 3, 4})
+
+        depth = FwdetEstimator(DelaunayTriangulationInterpolationStrategy()).calculate(
+            scene.spatial_inputs(), Region(0, (0, 300, 0, 200)))
+        self.assertEqual(depth.shape, (300, 200))
+
+        with tempfile.TemporaryDirectory() as directory:
+            paths = scene.write_rasters(directory)
+            with rasterio.open(paths['dem']) as dem_raster:
+                self.assertEqual(dem_raster.crs.to_epsg(), 3577)
+                self.assertEqual(tuple(dem_raster.bounds), scene.bounds())
+                self.assertTrue(np.array_equal(dem_raster.read(1), arrays['dem']))
+
+    def test_interpolation_budget(self):
+        scene = SyntheticScene((400, 400), valleys=6)
+        spatial_inputs = scene.spatial_inputs()
+        region = Region(0, (0, 400, 0, 400))
+        perimeter_points = PerimeterPoints.from_flood_extent(spatial_inputs.mim_array, spatial_inputs.dem)
+
+        budget = InterpolationBudget(max_averaging_constant=200)
+        self.assertEqual(budget.averaging_constants(4), [4, 6, 8, 11, 16, 23, 33, 47, 66, 93, 132, 187, 200])
+        self.assertEqual(budget.neighbor_counts(200, 1000), [200, 100, 50])
+        self.assertEqual(budget.neighbor_counts(200, 80), [80])
+
+        # a generous budget keeps the configured lumping and neighbors
+        unbounded = TpsInterpolationStrategy(averaging_constant=4, neighbors=100, budget=InterpolationBudget())
+        fixed = TpsInterpolationStrategy(averaging_constant=4, neighbors=100)
+        self.assertTrue(np.array_equal(unbounded.interpolate(perimeter_points), fixed.interpolate(perimeter_points),
+                                       equal_nan=True))
+        self.assertEqual(unbounded.last_interpolation_parameters['averaging_constant'], 4)
+        self.assertEqual(unbounded.last_interpolation_parameters['neighbors'], 100)
+        self.assertTrue(unbounded.last_interpolation_parameters['within_budget'])
+
+        # a tight one uses fewer neighbors, then coarser lumping
+        for strategy in [TpsInterpolationStrategy(averaging_constant=4, neighbors=100,
+                                                  budget=InterpolationBudget(max_seconds=0.1)),
+                         KrigingInterpolationStrategy(averaging_constant=4, engine='local',
+                                                      budget=InterpolationBudget(max_seconds=1)),
+                         KrigingInterpolationStrategy(averaging_constant=4, budget=InterpolationBudget(
+                             max_seconds=1e6, max_memory_bytes=10 ** 7))]:
+            depth = FwdetEstimator(strategy).calculate(spatial_inputs, region)
+            parameters = depth.attrs['interpolation_parameters']
+            self.assertEqual(parameters, strategy.last_interpolation_parameters)
+            self.assertGreater(parameters['averaging_constant'], 4)
+            self.assertTrue(parameters['within_budget'])
+            self.assertLessEqual(parameters['estimated_bytes'], strategy.budget.max_memory_bytes)
+            self.assertEqual(parameters['perimeter_points'], len(perimeter_points))
+        self.assertEqual(depth.shape, (400, 400))
+        self.assertEqual(InterpolationBudget(max_seconds=1).choose(perimeter_points, 4, 100, InterpolationBudget.tps_cost)[
+            'neighbors'], 50)
+
+        # the budget is part of the region depth cache's fingerprint, the choice isn't
+        with tempfile.TemporaryDirectory() as directory:
+            cache = RegionDepthCache(directory, static_input_version='test')
+            estimator = FwdetEstimator(TpsInterpolationStrategy(budget=InterpolationBudget(max_seconds=1)))
+            fingerprint = cache.fingerprint(estimator, region)
+            depth = estimator.calculate(spatial_inputs, region)
+            self.assertEqual(cache.fingerprint(estimator, region), fingerprint)
+            self.assertNotEqual(cache.fingerprint(FwdetEstimator(TpsInterpolationStrategy(
+                budget=InterpolationBudget(max_seconds=2))), region), fingerprint)
+
+            # the choice is stored with the depth and loaded with it
+            region_hash = RegionDepthCache.region_hash(spatial_inputs.mim_array, fingerprint)
+            cache.store(region_hash, depth.values,
+                        {'interpolation_parameters': depth.attrs['interpolation_parameters']})
+            (cached_depth, cached_attrs) = cache.load(region_hash)
+            self.assertTrue(np.array_equal(cached_depth, depth.values))
+            self.assertEqual(cached_attrs['interpolation_parameters'], depth.attrs['interpolation_parameters'])
+
+    def test_euclidean_allocation_interpolation_strategy(self):
+        scene = SyntheticScene((300, 250), valleys=3)
+        spatial_inputs = scene.spatial_inputs()
+        perimeter_points = PerimeterPoints.from_flood_extent(spatial_inputs.mim_array, spatial_inputs.dem)
+        (rows, cols) = np.indices(perimeter_points.shape)
+        pixels = np.column_stack([rows.ravel(), cols.ravel()])
+
+        # each pixel takes the elevation of one of its nearest perimeter cells (equidistant ones can be chosen
+        # differently), whether the region is allocated whole or in blocks whose windows miss the nearest cell
+        (distances, nearest) = cKDTree(np.column_stack([perimeter_points.rows, perimeter_points.cols])).query(
+            pixels, k=8)
+        tied = np.isclose(distances, distances[:, :1])
+        for strategy in [EuclideanAllocationInterpolationStrategy(smoothing=None),
+                         EuclideanAllocationInterpolationStrategy(smoothing=None, block_size=64, halo=4)]:
+            allocated = strategy.interpolate(perimeter_points)
+            self.assertEqual(allocated.dtype, np.float64)
+            self.assertTrue(((perimeter_points.elevations[nearest] == allocated.ravel()[:, None]) & tied).any(
+                axis=1).all(), f"block_size {strategy.block_size}")
+
+        # smoothing the blocks reads the allocation beyond them, so matches smoothing the whole region
+        for smoothing in ['gaussian', 'mean']:
+            whole = EuclideanAllocationInterpolationStrategy(smoothing=smoothing).interpolate(perimeter_points)
+            blocked = EuclideanAllocationInterpolationStrategy(smoothing=smoothing, block_size=64, halo=4)
+            self.assertLess(np.nanmean(np.abs(blocked.interpolate(perimeter_points) - whole)), 0.01)
+            self.assertFalse(np.isnan(whole).any())
+        self.assertTrue(np.isnan(EuclideanAllocationInterpolationStrategy().interpolate(
+            PerimeterPoints.from_dem_extract(np.full((20, 20), np.nan)))).all())
+        with self.assertRaises(ValueError):
+            EuclideanAllocationInterpolationStrategy(smoothing='median')
+
+        depth = FwdetEstimator(EuclideanAllocationInterpolationStrategy()).calculate(
+            spatial_inputs, Region(0, (0, 300, 0, 250)))
+        self.assertEqual(depth.shape, (300, 250))
+        mim = spatial_inputs.mim_array.to_numpy()
+        self.assertTrue((depth.to_numpy()[mim == SpatialFloodExtentInputs.WOFS_DRY_VALUE] == 0).all())
+        self.assertGreater((depth.to_numpy()[mim == SpatialFloodExtentInputs.WOFS_WET_VALUE] > 0).mean(), 0.5)
+
 
 if __name__ == '__main__':
     unittest.main()
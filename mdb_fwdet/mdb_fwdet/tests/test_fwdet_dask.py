@@ -4,9 +4,11 @@ from dask.distributed import Client
 from mdb_fwdet.bimonth_time_range import BimonthTimeRange
 from mdb_fwdet.configuration import Configuration
 from mdb_fwdet.flood_depth_layer import FloodDepthLayer
+from mdb_fwdet.flood_depth_pipeline import FloodDepthPipeline
 from mdb_fwdet.geotiff_utils import GeotiffUtils
 from mdb_fwdet.spatial_flood_extent_inputs import SpatialFloodExtentInputs
 from mdb_fwdet.spatial_input_helper import SpatialInputHelper
+from mdb_fwdet.static_input_cache import StaticInputCache
 from mdb_fwdet.tests.test_fwdet import TestFwdetInterp
 import logging
 import unittest
@@ -17,7 +19,12 @@ from mdb_fwdet.flood_depth_engine import FloodDepthEngine
 from mdb_fwdet.fwdet_estimator import FwdetEstimator
 from mdb_fwdet.region import Region
 from mdb_fwdet.region_definition import RegionDefinition
+from mdb_fwdet.region_depth_cache import RegionDepthCache
 import s3fs
+import boto3
+import rasterio
+import tempfile
+from moto import mock_aws
 
 from mdb_fwdet.dask_install_worker_plugin import DaskInstallWorkerPlugin
 
@@ -94,6 +101,26 @@ class TestFwdetDaskInterp(unittest.TestCase):
         logging.info(f"Result of geotiff save '{status}'")
         self.assertTrue(status!='error', "Error raised when saving geotiff, see the test python test logs.")
 
+    def test_save_cog_s3(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        depth = (mock_spatial_inputs.dem * 1000).astype(np.uint16)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        with mock_aws():
+            boto3.client('s3').create_bucket(Bucket='test-bucket')
+            # moto only patches this process so the workers are threads
+            client = Client(processes=False)
+            result = GeotiffUtils.save_geotiff(
+                client, depth.chunk(10), 'test-bucket', 'prefix', 'test_depth.tif')
+            wait(result)
+            self.assertTrue(result.status != 'error', str(result.exception()) if result.status == 'error' else '')
+            TestFwdetDaskInterp.teardown_small_client(client)
+            cog = boto3.client('s3').get_object(Bucket='test-bucket', Key='prefix/test_depth.tif')['Body'].read()
+        with tempfile.NamedTemporaryFile(suffix='.tif') as cog_file:
+            cog_file.write(cog)
+            cog_file.flush()
+            with rasterio.open(cog_file.name) as saved:
+                self.assertTrue(np.array_equal(saved.read(1), depth.to_numpy()))
+
     def test_fwdet_engine_dask(self):
         mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
         mock_region_list = RegionDefinition.dict_to_regions(
@@ -132,6 +159,221 @@ class TestFwdetDaskInterp(unittest.TestCase):
                                             global_water_depth.to_numpy()[0:12, 0:25], True)), "Data for the lower half should be the same - compute by region vs compute altogether")
         TestFwdetDaskInterp.teardown_small_client(client)
 
+    def test_mosaic_blocks(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_list = RegionDefinition.dict_to_regions(
+            RegionDefinition.MOCK_REGIONS)
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(mock_region_list,
+                                                                        mock_spatial_inputs.channel)
+        mock_regions = RegionDefinition(mock_region_list, mock_region_grid)
+        fwdet_estimator = FwdetEstimator(DelaunayTriangulationInterpolationStrategy())
+        flood_depth_engine = FloodDepthEngine(
+            mock_spatial_inputs, mock_regions, fwdet_estimator)
+
+        client = TestFwdetDaskInterp.setup_small_client()
+        result_list = flood_depth_engine.calculate_dask(client)
+        # blocks that cut across the regions give the same mosaic as a single block
+        single_block = flood_depth_engine.merge_results_into_one_raster_dask(
+            client, result_list, chunks=25).result()
+        small_blocks = flood_depth_engine.merge_results_into_one_raster_dask(
+            client, result_list, chunks=7).result()
+        self.assertTrue(np.array_equal(single_block.to_numpy(), small_blocks.to_numpy()))
+        for region in mock_region_list:
+            (row0, row1, col0, col1) = region.bounding_box
+            self.assertTrue(np.array_equal(single_block.to_numpy()[row0:row1, col0:col1],
+                                           result_list[region].result().to_numpy()))
+        TestFwdetDaskInterp.teardown_small_client(client)
+
+    def test_static_input_cache(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_list = RegionDefinition.dict_to_regions(
+            RegionDefinition.MOCK_REGIONS)
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(mock_region_list,
+                                                                        mock_spatial_inputs.channel)
+        mock_regions = RegionDefinition(mock_region_list, mock_region_grid)
+        fwdet_estimator = FwdetEstimator(DelaunayTriangulationInterpolationStrategy())
+        static_input_cache = StaticInputCache(mock_spatial_inputs.dem, mock_spatial_inputs.channel)
+
+        client = TestFwdetDaskInterp.setup_small_client()
+        # two dates sharing the static inputs
+        first_date = FloodDepthEngine(mock_spatial_inputs, mock_regions, fwdet_estimator).calculate_dask(
+            client, static_input_cache=static_input_cache)
+        cached_keys = [future.key for future in static_input_cache.futures.values()]
+        second_date = FloodDepthEngine(mock_spatial_inputs, mock_regions, fwdet_estimator).calculate_dask(
+            client, static_input_cache=static_input_cache)
+        self.assertEqual(cached_keys, [future.key for future in static_input_cache.futures.values()])
+        self.assertEqual(len(cached_keys), 4)
+
+        for region in mock_region_list:
+            (row0, row1, col0, col1) = region.bounding_box
+            expected = fwdet_estimator.calculate(mock_spatial_inputs.crop(region), region)
+            self.assertTrue(np.array_equal(first_date[region].result().to_numpy(), expected.to_numpy()))
+            self.assertTrue(np.array_equal(second_date[region].result().to_numpy(), expected.to_numpy()))
+            # the cached inputs are untouched by the estimator
+            (dem, channel) = static_input_cache.futures[StaticInputCache.entry(region)].result()
+            self.assertTrue(np.array_equal(dem.to_numpy(), mock_spatial_inputs.dem.to_numpy()[row0:row1, col0:col1]))
+        TestFwdetDaskInterp.teardown_small_client(client)
+
+    def test_static_input_cache_retiled(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        static_input_cache = StaticInputCache(mock_spatial_inputs.dem, mock_spatial_inputs.channel)
+        # the regions of two dates tiled differently - the same numbers cover other boxes
+        first_regions = [Region(0, (0, 13, 0, 25)), Region(1, (12, 25, 0, 25))]
+        second_regions = [Region(0, (0, 25, 0, 13)), Region(1, (0, 25, 12, 25))]
+
+        client = TestFwdetDaskInterp.setup_small_client()
+        for regions in [first_regions, second_regions, first_regions]:
+            for region in regions:
+                (static_inputs, worker) = static_input_cache.get(client, region)
+                (row0, row1, col0, col1) = region.bounding_box
+                (dem, channel) = static_inputs.result()
+                self.assertTrue(np.array_equal(dem.to_numpy(),
+                                               mock_spatial_inputs.dem.to_numpy()[row0:row1, col0:col1]))
+        self.assertEqual(len(static_input_cache.futures), 4)
+        self.assertEqual(sum(static_input_cache.pixels.values()), 4 * 13 * 25)
+
+        # releasing a region frees the pixels it was cached with
+        for region in first_regions + second_regions:
+            static_input_cache.release(region)
+        self.assertEqual(sum(static_input_cache.pixels.values()), 0)
+        TestFwdetDaskInterp.teardown_small_client(client)
+
+    def test_region_depth_cache(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_list = RegionDefinition.dict_to_regions(
+            RegionDefinition.MOCK_REGIONS)
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(mock_region_list,
+                                                                        mock_spatial_inputs.channel)
+        mock_regions = RegionDefinition(mock_region_list, mock_region_grid)
+        fwdet_estimator = FwdetEstimator(DelaunayTriangulationInterpolationStrategy())
+
+        client = TestFwdetDaskInterp.setup_small_client()
+        with tempfile.TemporaryDirectory() as directory:
+            region_depth_cache = RegionDepthCache(directory, static_input_version='test')
+            flood_depth_engine = FloodDepthEngine(mock_spatial_inputs, mock_regions, fwdet_estimator)
+            first_run = flood_depth_engine.calculate_dask(client, region_depth_cache=region_depth_cache)
+            second_run = flood_depth_engine.calculate_dask(client, region_depth_cache=region_depth_cache)
+            for region in mock_region_list:
+                self.assertFalse(first_run[region].result().attrs['from_cache'])
+                self.assertTrue(second_run[region].result().attrs['from_cache'])
+                self.assertTrue(first_run[region].result().equals(second_run[region].result()))
+
+            # change the flood extent of one region - only it is recalculated
+            changed_mim = mock_spatial_inputs.mim_array.copy()
+            changed_mim[0:2, 0:2] = SpatialFloodExtentInputs.WOFS_WET_VALUE
+            changed_inputs = SpatialFloodExtentInputs(
+                changed_mim, mock_spatial_inputs.dem, mock_spatial_inputs.channel)
+            third_run = FloodDepthEngine(changed_inputs, mock_regions, fwdet_estimator).calculate_dask(
+                client, region_depth_cache=region_depth_cache)
+            self.assertEqual([not third_run[region].result().attrs['from_cache'] for region in mock_region_list],
+                             [True, False, False, False])
+        TestFwdetDaskInterp.teardown_small_client(client)
+
+    def test_lazy_mim_input(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_list = RegionDefinition.dict_to_regions(
+            RegionDefinition.MOCK_REGIONS)
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(mock_region_list,
+                                                                        mock_spatial_inputs.channel)
+        mock_regions = RegionDefinition(mock_region_list, mock_region_grid)
+        fwdet_estimator = FwdetEstimator(DelaunayTriangulationInterpolationStrategy())
+
+        original_format_string = Configuration.image_date_format_string
+        client = TestFwdetDaskInterp.setup_small_client()
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                Configuration.image_date_format_string = os.path.join(directory, 'mim_{image_date}.tif')
+                mock_spatial_inputs.mim_array.astype('uint8').rio.write_crs("EPSG:4326").rio.to_raster(
+                    SpatialFloodExtentInputs.mim_input_location('2011-01-01'))
+                for chunks in [None, 10]:
+                    mim_input = SpatialFloodExtentInputs.load_mim_input('2011-01-01', chunks=chunks, use_store=False)
+                    self.assertFalse(mim_input.variable._in_memory)
+                    lazy_inputs = SpatialFloodExtentInputs(
+                        mim_input, mock_spatial_inputs.dem, mock_spatial_inputs.channel)
+                    depth_by_region = FloodDepthEngine(lazy_inputs, mock_regions, fwdet_estimator).calculate_dask(client)
+                    for region in mock_region_list:
+                        expected = fwdet_estimator.calculate(mock_spatial_inputs.crop(region), region)
+                        self.assertTrue(np.array_equal(depth_by_region[region].result().to_numpy(), expected.to_numpy()))
+                    # nothing was read here
+                    self.assertFalse(mim_input.variable._in_memory)
+            finally:
+                Configuration.image_date_format_string = original_format_string
+        TestFwdetDaskInterp.teardown_small_client(client)
+
+    class MockSpatialInputHelper():
+        """The parts of SpatialInputHelper a FloodDepthLayer uses, over the mock inputs"""
+
+        def __init__(self, mock_spatial_inputs, mock_region_grid):
+            self.dem = mock_spatial_inputs.dem
+            self.channel = mock_spatial_inputs.channel
+            self.input_dataset = {'regions': mock_region_grid}
+            self.static_input_cache = StaticInputCache(self.dem, self.channel)
+
+        def get_spatial_flood_extents(self, mim_array):
+            return SpatialFloodExtentInputs(mim_array, self.dem, self.channel)
+
+    class CountingPipeline(FloodDepthPipeline):
+        """Records the most dates submitted and not yet done"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.dates_in_flight = 0
+            self.most_dates_in_flight = 0
+
+        def submit(self, client, image_date, priority):
+            submitted = super().submit(client, image_date, priority)
+            self.dates_in_flight += 1
+            self.most_dates_in_flight = max(self.most_dates_in_flight, self.dates_in_flight)
+            return submitted
+
+        def wait_for_any(self, in_flight, status_by_date):
+            before = len(in_flight)
+            super().wait_for_any(in_flight, status_by_date)
+            self.dates_in_flight -= before - len(in_flight)
+
+    def test_fwdet_pipeline(self):
+        mock_spatial_inputs = TestFwdetInterp.generate_mock_spatial_inputs()
+        mock_region_list = RegionDefinition.dict_to_regions(
+            RegionDefinition.MOCK_REGIONS)
+        mock_region_grid = RegionDefinition.generate_mock_spatial_array(mock_region_list,
+                                                                        mock_spatial_inputs.channel)
+        image_dates = ['2011-01-01', '2011-03-01', '2011-05-01', '2011-07-01']
+        # no flood extent for this date - it fails without stopping the others
+        missing_date = '2011-05-01'
+
+        original_format_strings = (Configuration.image_date_format_string, Configuration.mim_store_format_string)
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        with tempfile.TemporaryDirectory() as directory, mock_aws():
+            try:
+                Configuration.image_date_format_string = os.path.join(directory, 'mim_{image_date}.tif')
+                Configuration.mim_store_format_string = os.path.join(directory, 'mim_{image_date}.zarr')
+                for image_date in image_dates:
+                    if image_date != missing_date:
+                        mock_spatial_inputs.mim_array.astype('uint8').rio.write_crs("EPSG:4326").rio.to_raster(
+                            SpatialFloodExtentInputs.mim_input_location(image_date))
+                boto3.client('s3').create_bucket(Bucket='test-bucket')
+                # moto only patches this process so the workers are threads
+                client = Client(processes=False)
+                for max_dates_in_flight in [1, 2]:
+                    pipeline = TestFwdetDaskInterp.CountingPipeline(
+                        TestFwdetDaskInterp.MockSpatialInputHelper(mock_spatial_inputs, mock_region_grid),
+                        mock_region_list, 'test-bucket', f'prefix_{max_dates_in_flight}', 'depth_{image_date}.tif',
+                        max_dates_in_flight=max_dates_in_flight)
+                    status_by_date = pipeline.run(client, image_dates)
+                    self.assertEqual(status_by_date, {image_date: 'error' if image_date == missing_date else 'finished'
+                                                      for image_date in image_dates})
+                    self.assertEqual(pipeline.most_dates_in_flight, max_dates_in_flight)
+                    self.assertEqual(pipeline.dates_in_flight, 0)
+                    saved = boto3.client('s3').list_objects_v2(
+                        Bucket='test-bucket', Prefix=f'prefix_{max_dates_in_flight}/')['Contents']
+                    self.assertEqual(sorted(content['Key'] for content in saved),
+                                     [f'prefix_{max_dates_in_flight}/depth_{image_date}.tif'
+                                      for image_date in image_dates if image_date != missing_date])
+                TestFwdetDaskInterp.teardown_small_client(client)
+            finally:
+                (Configuration.image_date_format_string, Configuration.mim_store_format_string) = \
+                    original_format_strings
+
     def test_file_exists(self):     
         configure_s3_access()
         s3 = s3fs.S3FileSystem()
@@ -219,5 +461,25 @@ class TestFwdetDaskInterp(unittest.TestCase):
             # logging.info(client.get_worker_logs())
             TestFwdetDaskInterp.teardown_large_cluster(cluster, client) 
 
+    def test_fwdet_pipeline_large_process(self):
+        (cluster, client) = TestFwdetDaskInterp.setup_large_cluster()
+        client.wait_for_workers(n_workers=23)
+        DaskInstallWorkerPlugin.install_package(client, [r"/home/jovyan/MDB_FwDET/dist/mdb_fwdet-1.0.17-py3-none-any.whl"]) # use wheel
+
+        try:
+            bimonth_time_range = BimonthTimeRange(start='1988-01-01', end='2022-12-31')
+            mdb_region_bounds_list = RegionDefinition.dict_to_regions(
+                RegionDefinition.MDB_REGIONS)
+            spatial_raster_inputs = SpatialInputHelper(Configuration.input_cache_location)  # (lazy) loads data
+
+            pipeline = FloodDepthPipeline(spatial_raster_inputs, mdb_region_bounds_list, Configuration.bucket,
+                                          Configuration.prefix, Configuration.save_file_format_string,
+                                          max_dates_in_flight=3)
+            status_by_date = pipeline.run(client, bimonth_time_range.full_date_range, s3fs.S3FileSystem())
+            failed = [image_date for (image_date, status) in status_by_date.items() if status == 'error']
+            self.assertEqual(failed, [], f"Failed to produce: {failed}")
+        finally:
+            TestFwdetDaskInterp.teardown_large_cluster(cluster, client)
+
 if __name__ == '__main__':
     unittest.main()
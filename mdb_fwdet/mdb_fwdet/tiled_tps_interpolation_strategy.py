@@ -0,0 +1,179 @@
+import logging
+
+import numpy
+from concurrent.futures import ThreadPoolExecutor
+from scipy.interpolate import RBFInterpolator
+from scipy.spatial import cKDTree
+
+from mdb_fwdet.lattice_upsampler import LatticeUpsampler
+from mdb_fwdet.lumped_lattice import LumpedLattice
+from mdb_fwdet.perimeter_points import PerimeterPoints
+
+
+class TiledTpsInterpolationStrategy():
+    """Thin Plate Spline fitted independently on overlapping tiles of the lumped lattice, with the overlaps
+    feather-blended together. Tiles are split (quadtree) until each holds a bounded number of perimeter
+    points so the cost grows close to linearly with the number of perimeter points"""
+
+    def __init__(self, averaging_constant=60, tile_size=128, overlap=16, max_points_per_tile=2000,
+                 min_points_per_tile=50, max_workers=None) -> None:
+        self.averaging_constant = averaging_constant
+        """averaging constant is the area to assume low surface water elevation difference. For
+        example 60 for 25m resolution product or 300 for 5m resolution product"""
+        self.tile_size = tile_size
+        """the largest tile (in lattice nodes)"""
+        self.overlap = overlap
+        """the number of lattice nodes each tile extends into its neighbours (the blending width)"""
+        self.max_points_per_tile = max_points_per_tile
+        """tiles with more lumped perimeter points than this (including the overlap) are split in four"""
+        self.min_points_per_tile = min_points_per_tile
+        """tiles with fewer lumped perimeter points than this borrow the nearest points from outside"""
+        self.max_workers = max_workers
+        """the number of threads solving tiles in parallel (None is the ThreadPoolExecutor default)"""
+        self.upsampling_method = 'linear'
+        """How the lattice is upsampled to the pixels of the region (see LatticeUpsampler)"""
+
+    def interpolate(self, perimeter_points):
+        """Interpolate across the perimeter points (a dense raster of border elevations is also accepted)"""
+        (lattice, lattice_values) = self.interpolate_lattice(perimeter_points)
+        return LatticeUpsampler(lattice, self.upsampling_method).upsample(lattice_values)
+
+    def interpolate_lattice(self, perimeter_points):
+        """Interpolate the water surface on the nodes of the lumped lattice"""
+        if not isinstance(perimeter_points, PerimeterPoints):
+            perimeter_points = PerimeterPoints.from_dem_extract(
+                perimeter_points)
+        lattice = LumpedLattice(
+            perimeter_points.shape, self.averaging_constant)
+        (coords, actual) = lattice.lump(perimeter_points)
+        del perimeter_points
+
+        (nrow_lumped, ncol_lumped) = lattice.lattice_shape
+        weighted_sum = numpy.zeros((nrow_lumped, ncol_lumped))
+        weights = numpy.zeros((nrow_lumped, ncol_lumped))
+        if len(coords) == 0:
+            return (lattice, numpy.full(lattice.node_count(), numpy.nan))
+
+        tree = cKDTree(coords)
+        tiles = self.split_tiles(tree, (0, nrow_lumped), (0, ncol_lumped))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            tile_results = executor.map(
+                lambda tile: self.solve_tile(tree, coords, actual, tile, lattice.lattice_shape), tiles)
+            for ((rows, cols), values, weight) in tile_results:
+                weighted_sum[rows[0]:rows[1], cols[0]:cols[1]] += values * weight
+                weights[rows[0]:rows[1], cols[0]:cols[1]] += weight
+
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            surface = weighted_sum / weights
+        # back to the X-major order of LumpedLattice.coordinates
+        return (lattice, surface.T.ravel())
+
+    def extended(self, extent: tuple, node_count: int) -> tuple:
+        """Extend a tile range by the overlap (within the lattice)"""
+        return (max(extent[0] - self.overlap, 0), min(extent[1] + self.overlap, node_count))
+
+    def points_in(self, tree: cKDTree, rows: tuple, cols: tuple) -> numpy.ndarray:
+        """Index of the lumped points (X, Y) within the lattice ranges"""
+        centre = ((cols[0] + cols[1] - 1) / 2, (rows[0] + rows[1] - 1) / 2)
+        half_size = max(cols[1] - cols[0], rows[1] - rows[0]) / 2
+        candidates = numpy.array(tree.query_ball_point(
+            centre, half_size, p=numpy.inf), dtype=numpy.int64)
+        if len(candidates) == 0:
+            return candidates
+        points = tree.data[candidates]
+        inside = ((points[:, 0] >= cols[0]) & (points[:, 0] < cols[1]) &
+                  (points[:, 1] >= rows[0]) & (points[:, 1] < rows[1]))
+        return candidates[inside]
+
+    def split_tiles(self, tree: cKDTree, rows: tuple, cols: tuple) -> list:
+        """Cover the lattice with tiles of at most tile_size nodes, split further where they are crowded"""
+        tiles = []
+        for row_start in range(rows[0], rows[1], self.tile_size):
+            for col_start in range(cols[0], cols[1], self.tile_size):
+                tiles.extend(self.split_tile(tree, (row_start, min(row_start + self.tile_size, rows[1])),
+                                             (col_start, min(col_start + self.tile_size, cols[1])),
+                                             (rows[1], cols[1])))
+        return tiles
+
+    def split_tile(self, tree: cKDTree, rows: tuple, cols: tuple, lattice_shape: tuple) -> list:
+        extended_rows = self.extended(rows, lattice_shape[0])
+        extended_cols = self.extended(cols, lattice_shape[1])
+        point_count = len(self.points_in(tree, extended_rows, extended_cols))
+        if point_count <= self.max_points_per_tile or (rows[1] - rows[0] <= 1 and cols[1] - cols[0] <= 1):
+            return [(rows, cols)]
+        row_middle = (rows[0] + rows[1] + 1) // 2
+        col_middle = (cols[0] + cols[1] + 1) // 2
+        quarters = [((rows[0], row_middle), (cols[0], col_middle)), ((rows[0], row_middle), (col_middle, cols[1])),
+                    ((row_middle, rows[1]), (cols[0], col_middle)), ((row_middle, rows[1]), (col_middle, cols[1]))]
+        tiles = []
+        for (quarter_rows, quarter_cols) in quarters:
+            if quarter_rows[1] > quarter_rows[0] and quarter_cols[1] > quarter_cols[0]:
+                tiles.extend(self.split_tile(
+                    tree, quarter_rows, quarter_cols, lattice_shape))
+        return tiles
+
+    def feather(self, extent: tuple, extended: tuple, node_count: int) -> numpy.ndarray:
+        """Blending weights along one axis of an extended tile - 1 across the tile, ramping down across
+        the overlap (except at the edge of the lattice where there is nothing to blend with)"""
+        nodes = numpy.arange(extended[0], extended[1])
+        ramp = self.overlap + 1
+        weight = numpy.ones(len(nodes))
+        if extent[0] > 0:
+            weight = numpy.minimum(weight, (nodes - extended[0] + 1) / ramp)
+        if extent[1] < node_count:
+            weight = numpy.minimum(weight, (extended[1] - nodes) / ramp)
+        return weight
+
+    def solve_tile(self, tree: cKDTree, coords: numpy.ndarray, actual: numpy.ndarray, tile: tuple, lattice_shape: tuple):
+        """Fit a thin plate spline to the points in (and around) a tile and evaluate it on the extended tile"""
+        (rows, cols) = tile
+        extended_rows = self.extended(rows, lattice_shape[0])
+        extended_cols = self.extended(cols, lattice_shape[1])
+        selected = self.points_in(tree, extended_rows, extended_cols)
+
+        if len(selected) < self.min_points_per_tile:
+            # Borrow the nearest points to the tile (e.g. in the middle of a large lake)
+            centre = ((extended_cols[0] + extended_cols[1] - 1) / 2,
+                      (extended_rows[0] + extended_rows[1] - 1) / 2)
+            (_, nearest) = tree.query(
+                centre, k=min(self.min_points_per_tile, len(coords)))
+            selected = numpy.union1d(selected, numpy.atleast_1d(nearest))
+
+        (tile_rows, tile_cols) = numpy.meshgrid(numpy.arange(*extended_rows),
+                                                numpy.arange(*extended_cols), indexing='ij')
+        tile_nodes = numpy.column_stack(
+            [tile_cols.ravel(), tile_rows.ravel()]).astype(numpy.float64)
+        values = self.fit_tile(tree, coords, actual, selected, tile_nodes, (extended_rows, extended_cols)).reshape(
+            tile_rows.shape)
+
+        weight = numpy.outer(self.feather(rows, extended_rows, lattice_shape[0]),
+                             self.feather(cols, extended_cols, lattice_shape[1]))
+        return ((extended_rows, extended_cols), values, weight)
+
+    def fit_tile(self, tree: cKDTree, coords: numpy.ndarray, actual: numpy.ndarray, selected: numpy.ndarray,
+                 tile_nodes: numpy.ndarray, extent: tuple) -> numpy.ndarray:
+        """The thin plate spline of the selected points at the tile's nodes. A spline can't be fitted to
+        collinear points (e.g. along a straight channel or levee) so the nearest points from further afield
+        are added (twice min_points_per_tile, doubling) until one can, and failing that the tile takes the
+        elevation of the nearest point"""
+        centre = tile_nodes.mean(axis=0)
+        neighbors = 2 * max(self.min_points_per_tile, 1)
+        widened = False
+        while True:
+            try:
+                values = RBFInterpolator(coords[selected], actual[selected], kernel='thin_plate_spline',
+                                         smoothing=0)(tile_nodes)
+                if widened:
+                    logging.warning(f"Thin plate spline of tile {extent} fitted with the nearest {len(selected)} "
+                                    f"points (the points around it are collinear)")
+                return values
+            except (numpy.linalg.LinAlgError, ValueError):
+                if len(selected) == len(coords):
+                    break
+            (_, nearest) = tree.query(centre, k=min(neighbors, len(coords)))
+            selected = numpy.union1d(selected, numpy.atleast_1d(nearest))
+            neighbors *= 2
+            widened = True
+        logging.warning(f"No thin plate spline fits tile {extent} - using the nearest point's elevation")
+        (_, nearest) = tree.query(tile_nodes)
+        return actual[nearest]
@@ -0,0 +1,46 @@
+import contextlib
+import xarray
+import zarr
+from numcodecs import Blosc
+
+
+class ZarrFormat():
+    """Writes the zarr stores (the spatial input cache and the ingested flood extents) in the zarr v2 format with
+    numcodecs compressors on either version of zarr - xarray takes the compressor encoding in the v2 form
+    ('compressor') with zarr v2 and in the v3 form ('compressors') with zarr v3, which writes the v2 format as well"""
+
+    ZARR_V3 = int(zarr.__version__.split('.')[0]) >= 3
+    """Whether the installed zarr is v3 (which otherwise writes the v3 format)"""
+
+    def writing():
+        """Context to write a store in - on zarr v3 new groups and arrays are created in the v2 format"""
+        if ZarrFormat.ZARR_V3:
+            return zarr.config.set({'default_zarr_format': 2})
+        return contextlib.nullcontext()
+
+    def without_scalar_coords(dataset: xarray.Dataset) -> xarray.Dataset:
+        """The dataset without its 0-d variables (the band and the spatial_ref holding the CRS, which is written to
+        the outputs again as they are saved) - xarray before its zarr v3 support can't write them with zarr v3"""
+        return dataset.drop_vars([name for (name, variable) in dataset.variables.items() if variable.ndim == 0])
+
+    def full_encoding(dataset: xarray.Dataset, encoding: dict) -> dict:
+        """The encoding with the chunks of the numpy backed variables (the coordinates) given as a single chunk -
+        xarray before its zarr v3 support leaves them to zarr, and zarr v3 requires them"""
+        full_encoding = {name: {'chunks': variable.shape} for (name, variable) in dataset.variables.items()
+                         if variable.chunks is None}
+        full_encoding.update(encoding)
+        return full_encoding
+
+    def compressor(shuffle=Blosc.SHUFFLE) -> Blosc:
+        """zstd (level 3) with byte (or bit) shuffling"""
+        return Blosc(cname='zstd', clevel=3, shuffle=shuffle)
+
+    def compressor_encoding(shuffle=Blosc.SHUFFLE) -> dict:
+        """The encoding of a variable's compressor in the form xarray expects for the installed zarr"""
+        if ZarrFormat.ZARR_V3:
+            return {'compressors': (ZarrFormat.compressor(shuffle),)}
+        return {'compressor': ZarrFormat.compressor(shuffle)}
+
+    def array_compressor(array):
+        """The compressor of a zarr array opened with either version of zarr"""
+        return array.compressors[0] if ZarrFormat.ZARR_V3 else array.compressor